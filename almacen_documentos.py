@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+from array import array
+
+import numpy as np
+
+from base_conocimientos import ESTADOS, RecursoPorHuella, calificar, id_sintoma
+from contexto_clinico import estado_en, hay_disparadores, palabras_contexto
+from extractor_rapido import TrieFrases
+from sistema_experto import (
+    MODELO_SPACY,
+    NLP_LIGERO,
+    _recursos,
+    _sintomas_de_doc,
+    normalizar_sintomas,
+    obtener_base,
+)
+
+logger = logging.getLogger(__name__)
+
+# Cambiar al modificar el formato de los ficheros del almacén
+VERSION_ALMACEN = 1
+
+# Categorías gramaticales que extraer_sintomas normaliza como posibles síntomas
+CATEGORIAS_SINTOMA = ("NOUN", "ADJ")
+
+_TIPO_INDICE = np.dtype([("clave", "<u8"), ("inicio", "<u8"), ("longitud", "<u4")])
+
+
+def _clave(texto):
+    """Hash de 64 bits del texto tal como lo procesa spaCy (en minúsculas)"""
+    return int.from_bytes(hashlib.blake2b(texto.lower().encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _leer_json(ruta, defecto):
+    try:
+        with open(ruta, encoding="utf-8") as fichero:
+            return json.load(fichero)
+    except FileNotFoundError:
+        return defecto
+
+
+def _escribir_atomico(ruta, escribir):
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as fichero:
+        escribir(fichero)
+        fichero.flush()
+        os.fsync(fichero.fileno())
+    os.replace(temporal, ruta)
+
+
+class AlmacenDocumentos:
+    """
+    Almacén en disco de los documentos ya analizados por spaCy, indexado por el hash
+    del texto. De cada documento se guardan solo los tokens (como ids de una tabla de
+    cadenas) y una marca de si son NOUN/ADJ: es todo lo que necesita la normalización.
+
+    Los tokens y las marcas se añaden al final de dos ficheros binarios y el índice
+    (hash, inicio, longitud) se mantiene ordenado por hash; los tres se abren con
+    memory-mapping, así que reabrir un almacén grande es inmediato. Los documentos
+    nuevos quedan en memoria hasta guardar(). Pensado para un único proceso escritor.
+    Si cambia el modelo de spaCy o su versión, el almacén se vacía.
+    """
+
+    def __init__(self, ruta, ligero=None):
+        import spacy
+
+        self.ruta = ruta
+        os.makedirs(ruta, exist_ok=True)
+        self.meta = {"version": VERSION_ALMACEN, "modelo": MODELO_SPACY, "spacy": spacy.__version__,
+                     "ligero": NLP_LIGERO if ligero is None else ligero}
+        if _leer_json(self._fichero("meta.json"), self.meta) != self.meta:
+            logger.warning("El almacén %s se creó con otro modelo o formato; se vacía", ruta)
+            for nombre in ("indice.npy", "tokens.u32", "marcas.u8", "cadenas.json"):
+                if os.path.exists(self._fichero(nombre)):
+                    os.remove(self._fichero(nombre))
+        _escribir_atomico(self._fichero("meta.json"), lambda f: f.write(json.dumps(self.meta).encode("utf-8")))
+
+        self.cadenas = _leer_json(self._fichero("cadenas.json"), [])
+        self._ids_cadenas = {cadena: i for i, cadena in enumerate(self.cadenas)}
+        self._nuevos = {}
+        self._abrir()
+
+    def _fichero(self, nombre):
+        return os.path.join(self.ruta, nombre)
+
+    def _abrir(self):
+        """Proyecta en memoria el índice y los ficheros de tokens y marcas"""
+        ruta_indice = self._fichero("indice.npy")
+        self._indice = np.load(ruta_indice, mmap_mode="r") if os.path.exists(ruta_indice) else np.empty(0, _TIPO_INDICE)
+        self._tokens = self._proyectar("tokens.u32", np.uint32)
+        self._marcas = self._proyectar("marcas.u8", np.uint8)
+
+    def _proyectar(self, nombre, tipo):
+        ruta = self._fichero(nombre)
+        if not os.path.exists(ruta) or os.path.getsize(ruta) == 0:
+            return np.empty(0, tipo)
+        return np.memmap(ruta, dtype=tipo, mode="r")
+
+    def __len__(self):
+        return len(self._indice) + len(self._nuevos)
+
+    def obtener(self, texto):
+        """Devuelve (tokens, marcas) del texto si ya se analizó, o None"""
+        clave = _clave(texto)
+        nuevo = self._nuevos.get(clave)
+        if nuevo is not None:
+            ids, marcas = nuevo
+        else:
+            posicion = int(np.searchsorted(self._indice["clave"], clave))
+            if posicion == len(self._indice) or int(self._indice["clave"][posicion]) != clave:
+                return None
+            inicio, longitud = int(self._indice["inicio"][posicion]), int(self._indice["longitud"][posicion])
+            ids = self._tokens[inicio:inicio + longitud].tolist()
+            marcas = self._marcas[inicio:inicio + longitud].tolist()
+        return [self.cadenas[i] for i in ids], marcas
+
+    def agregar(self, texto, doc):
+        """Guarda (en memoria hasta guardar()) los tokens de un documento de spaCy"""
+        ids = array("I")
+        for token in doc:
+            id_cadena = self._ids_cadenas.get(token.text)
+            if id_cadena is None:
+                id_cadena = self._ids_cadenas[token.text] = len(self.cadenas)
+                self.cadenas.append(token.text)
+            ids.append(id_cadena)
+        marcas = bytes(token.pos_ in CATEGORIAS_SINTOMA for token in doc)
+        self._nuevos[_clave(texto)] = (ids, marcas)
+
+    def guardar(self):
+        """
+        Escribe en disco los documentos nuevos. Primero se añaden los datos y después se
+        sustituyen la tabla de cadenas y el índice, de modo que un corte a mitad deja el
+        almacén en su estado anterior.
+        """
+        if not self._nuevos:
+            return
+        inicio = len(self._tokens)
+        nuevas = np.empty(len(self._nuevos), _TIPO_INDICE)
+        with open(self._fichero("tokens.u32"), "ab") as tokens, open(self._fichero("marcas.u8"), "ab") as marcas:
+            for fila, (clave, (ids, marcas_doc)) in enumerate(self._nuevos.items()):
+                tokens.write(np.asarray(ids, dtype="<u4").tobytes())
+                marcas.write(marcas_doc)
+                nuevas[fila] = (clave, inicio, len(ids))
+                inicio += len(ids)
+            for fichero in (tokens, marcas):
+                fichero.flush()
+                os.fsync(fichero.fileno())
+
+        _escribir_atomico(self._fichero("cadenas.json"),
+                          lambda f: f.write(json.dumps(self.cadenas, ensure_ascii=False).encode("utf-8")))
+        indice = np.concatenate([np.asarray(self._indice), nuevas])
+        indice = indice[np.argsort(indice["clave"], kind="stable")]
+        _escribir_atomico(self._fichero("indice.npy"), lambda f: np.save(f, indice))
+        self._nuevos.clear()
+        self._abrir()
+
+
+def _construir_trie(base):
+    """
+    Trie de las frases de sinónimos de `base` tokenizadas con el tokenizador de spaCy,
+    para reproducir el PhraseMatcher de extraer_sintomas sobre tokens ya guardados.
+    """
+    import spacy
+
+    tokenizador = spacy.blank("es").tokenizer
+    return TrieFrases(([token.lower_ for token in tokenizador(frase)], id_sintoma(clave))
+                      for clave, lista in base.sinonimos.items() for frase in [clave] + list(lista))
+
+
+# Trie de sinónimos de la base actual; al recargar la base se sustituye
+_trie = RecursoPorHuella(_construir_trie)
+
+
+def _trie_sinonimos():
+    """Trie de sinónimos tokenizados de la base actual (ver _construir_trie)"""
+    return _trie.obtener(obtener_base())
+
+
+def sintomas_de_tokens(tokens, marcas):
+    """Normalización de extraer_sintomas (con el contexto) aplicada a los tokens guardados de un documento"""
+    palabras = palabras_contexto(tokens)
+    if not hay_disparadores(palabras):
+        sintomas = _trie_sinonimos().buscar(tokens)
+        sintomas.update(normalizar_sintomas(token) for token, marca in zip(tokens, marcas) if marca)
+        return list(sintomas)
+    sintomas = {calificar(canonico, ESTADOS[estado_en(palabras, inicio)])
+                for inicio, canonico in _trie_sinonimos().coincidencias(tokens)}
+    sintomas.update(calificar(normalizar_sintomas(token), ESTADOS[estado_en(palabras, i)])
+                    for i, (token, marca) in enumerate(zip(tokens, marcas)) if marca)
+    return list(sintomas)
+
+
+def extraer_sintomas_almacen(textos, almacen, batch_size=64):
+    """
+    Como extraer_sintomas_lote, pero los textos que ya están en `almacen` no pasan por
+    spaCy: solo se repite la normalización con la base actual. Los que faltan se
+    analizan con una sola llamada a nlp.pipe y se añaden al almacén.
+    """
+    resultados = [None] * len(textos)
+    pendientes = []
+    for i, texto in enumerate(textos):
+        guardado = almacen.obtener(texto)
+        if guardado is None:
+            pendientes.append(i)
+        else:
+            resultados[i] = sintomas_de_tokens(*guardado)
+    if pendientes:
+        nlp, matcher = _recursos(almacen.meta["ligero"])
+        docs = nlp.pipe((textos[i].lower() for i in pendientes), batch_size=batch_size)
+        for i, doc in zip(pendientes, docs):
+            resultados[i] = _sintomas_de_doc(doc, matcher)
+            almacen.agregar(textos[i], doc)
+    return resultados
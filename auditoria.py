@@ -0,0 +1,279 @@
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Se activa con activar(ruta) o con la variable de entorno SISTEMA_EXPERTO_AUDITORIA=<ruta>.
+# Desactivada, cada diagnóstico solo comprueba este indicador.
+activa = False
+
+_escritor = None
+
+# Cuándo se fuerza a disco lo escrito: tras cada lote, como mucho cada `intervalo_fsync`
+# segundos, o nunca (lo decide el sistema operativo)
+POLITICAS_FSYNC = ("siempre", "intervalo", "nunca")
+FSYNC = os.environ.get("SISTEMA_EXPERTO_AUDITORIA_FSYNC", "intervalo")
+
+# Qué hacer si la cola está llena: esperar a que el escritor avance o descartar el registro
+POLITICAS_COLA = ("esperar", "descartar")
+
+_FIN = object()
+
+
+def hash_entrada(texto, edad, historial):
+    """Hash SHA-256 de la entrada de un diagnóstico: identifica el caso sin guardar el texto"""
+    datos = json.dumps([texto, edad, sorted(historial)], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(datos.encode("utf-8")).hexdigest()
+
+
+def _fila(registro):
+    """Convierte un registro de la cola en el dict que se guarda (en el hilo escritor)"""
+    fecha, texto, edad, historial, sintomas, reglas, diagnosticos = registro
+    return {
+        "fecha": datetime.datetime.fromtimestamp(fecha, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+        "hash_entrada": hash_entrada(texto, edad, historial),
+        "sintomas": sorted(sintomas),
+        "reglas": list(reglas),
+        "diagnosticos": [{"enfermedad": d["enfermedad"], "certeza": d["certeza"]} for d in diagnosticos],
+    }
+
+
+class _SalidaJsonl:
+    """Fichero JSONL de solo añadir: una línea por diagnóstico"""
+
+    def __init__(self, ruta):
+        self._fichero = open(ruta, "a", encoding="utf-8")
+
+    def escribir(self, filas):
+        self._fichero.write("".join(json.dumps(fila, ensure_ascii=False) + "\n" for fila in filas))
+        self._fichero.flush()
+
+    def sincronizar(self):
+        os.fsync(self._fichero.fileno())
+
+    def cerrar(self):
+        self._fichero.close()
+
+
+class _SalidaSqlite:
+    """Tabla `auditoria` de SQLite en modo WAL; cada lote es una transacción"""
+
+    def __init__(self, ruta, fsync):
+        self._conexion = sqlite3.connect(ruta)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        # Con WAL, NORMAL solo sincroniza en los checkpoints; FULL, en cada commit
+        sincronizacion = {"siempre": "FULL", "intervalo": "NORMAL", "nunca": "OFF"}[fsync]
+        self._conexion.execute(f"PRAGMA synchronous={sincronizacion}")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS auditoria (id INTEGER PRIMARY KEY, fecha TEXT, hash_entrada TEXT, "
+            "sintomas TEXT, reglas TEXT, diagnosticos TEXT)")
+
+    def escribir(self, filas):
+        with self._conexion:
+            self._conexion.executemany(
+                "INSERT INTO auditoria (fecha, hash_entrada, sintomas, reglas, diagnosticos) VALUES (?, ?, ?, ?, ?)",
+                [(fila["fecha"], fila["hash_entrada"], json.dumps(fila["sintomas"], ensure_ascii=False),
+                  json.dumps(fila["reglas"]), json.dumps(fila["diagnosticos"], ensure_ascii=False))
+                 for fila in filas])
+
+    def sincronizar(self):
+        # Pasa el WAL al fichero principal (y lo sincroniza)
+        self._conexion.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def cerrar(self):
+        self._conexion.close()
+
+
+class EscritorAuditoria:
+    """
+    Escritor en segundo plano del registro de auditoría.
+
+    registrar() solo encola una tupla con los datos ya calculados; un hilo propio
+    recoge en cada lote los registros acumulados (hasta `tamano_lote`), calcula los
+    hashes, los serializa y los añade de una vez a un fichero JSONL o a una base
+    SQLite en modo WAL (según la extensión de `ruta`, o `formato`). Sin registros
+    nuevos, el hilo despierta cada `espera` segundos para aplicar el fsync
+    pendiente. La cola tiene como mucho `tamano_cola` registros: llena, registrar()
+    espera o descarta el registro según `al_llenarse`. `fsync` es una de
+    POLITICAS_FSYNC. cerrar() escribe lo pendiente antes de terminar.
+    """
+
+    def __init__(self, ruta, formato=None, fsync=FSYNC, intervalo_fsync=1.0, tamano_cola=10000,
+                 tamano_lote=512, espera=0.2, al_llenarse="esperar"):
+        if fsync not in POLITICAS_FSYNC:
+            raise ValueError(f"Política de fsync desconocida: {fsync!r} (opciones: {', '.join(POLITICAS_FSYNC)})")
+        if al_llenarse not in POLITICAS_COLA:
+            raise ValueError(f"Política de cola desconocida: {al_llenarse!r} (opciones: {', '.join(POLITICAS_COLA)})")
+        self.ruta = ruta
+        self.formato = formato or ("sqlite" if ruta.endswith((".db", ".sqlite", ".sqlite3")) else "jsonl")
+        self.fsync = fsync
+        self.intervalo_fsync = intervalo_fsync
+        self.tamano_lote = tamano_lote
+        self.espera = espera
+        self.al_llenarse = al_llenarse
+        self.escritos = 0
+        self.descartados = 0
+        self.errores = 0
+        self.lotes = 0
+        self._cola = queue.Queue(tamano_cola)
+        self._cerrado = False
+        # La salida se abre en el hilo escritor (una conexión SQLite no se comparte entre hilos)
+        abierta = threading.Event()
+        self._error_apertura = None
+        self._hilo = threading.Thread(target=self._bucle, args=(abierta,), name="auditoria", daemon=True)
+        self._hilo.start()
+        abierta.wait()
+        if self._error_apertura is not None:
+            raise self._error_apertura
+
+    def registrar(self, texto, edad, historial, sintomas, reglas, diagnosticos):
+        """Encola un diagnóstico para auditarlo; no hace E/S. Devuelve False si se descartó"""
+        registro = (time.time(), texto, edad, list(historial), list(sintomas), list(reglas), diagnosticos)
+        if self.al_llenarse == "esperar":
+            self._cola.put(registro)
+            return True
+        try:
+            self._cola.put_nowait(registro)
+            return True
+        except queue.Full:
+            self.descartados += 1
+            if self.descartados == 1 or self.descartados % 1000 == 0:
+                logger.warning("Cola de auditoría llena: %d registros descartados", self.descartados)
+            return False
+
+    def _bucle(self, abierta):
+        try:
+            salida = _SalidaSqlite(self.ruta, self.fsync) if self.formato == "sqlite" else _SalidaJsonl(self.ruta)
+        except (OSError, sqlite3.Error) as e:
+            self._error_apertura = e
+            abierta.set()
+            return
+        abierta.set()
+        ultimo_fsync = time.monotonic()
+        pendiente_fsync = False
+        terminar = False
+        while not terminar:
+            lote = []
+            recibidos = 0
+            try:
+                registro = self._cola.get(timeout=self.espera)
+                while True:
+                    recibidos += 1
+                    if registro is _FIN:
+                        terminar = True
+                        break
+                    lote.append(registro)
+                    if len(lote) == self.tamano_lote:
+                        break
+                    registro = self._cola.get_nowait()
+            except queue.Empty:
+                pass
+            if lote:
+                try:
+                    salida.escribir([_fila(registro) for registro in lote])
+                    self.escritos += len(lote)
+                    self.lotes += 1
+                    pendiente_fsync = True
+                except Exception:
+                    self.errores += len(lote)
+                    logger.exception("No se pudo escribir un lote de %d registros de auditoría", len(lote))
+            if pendiente_fsync and self.fsync != "nunca" and (
+                    terminar or self.fsync == "siempre" or time.monotonic() - ultimo_fsync >= self.intervalo_fsync):
+                try:
+                    salida.sincronizar()
+                except (OSError, sqlite3.Error):
+                    logger.exception("No se pudo sincronizar el registro de auditoría")
+                ultimo_fsync = time.monotonic()
+                pendiente_fsync = False
+            for _ in range(recibidos):
+                self._cola.task_done()
+        salida.cerrar()
+
+    def vaciar(self):
+        """Espera a que se hayan escrito todos los registros encolados hasta ahora"""
+        self._cola.join()
+
+    def cerrar(self):
+        """Escribe (y sincroniza) lo pendiente y detiene el hilo escritor"""
+        if self._cerrado:
+            return
+        self._cerrado = True
+        self._cola.put(_FIN)
+        self._hilo.join()
+
+    def metricas(self):
+        """Devuelve un dict con los contadores del escritor"""
+        return {
+            "en_cola": self._cola.qsize(),
+            "escritos": self.escritos,
+            "descartados": self.descartados,
+            "errores": self.errores,
+            "lotes": self.lotes,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+
+def activar(ruta, **opciones):
+    """Empieza a auditar los diagnósticos en `ruta` (ver EscritorAuditoria para las opciones)"""
+    global activa, _escritor
+    desactivar()
+    _escritor = EscritorAuditoria(ruta, **opciones)
+    activa = True
+    return _escritor
+
+
+def desactivar():
+    """Deja de auditar, escribiendo antes lo pendiente"""
+    global activa, _escritor
+    activa = False
+    escritor, _escritor = _escritor, None
+    if escritor is not None:
+        escritor.cerrar()
+
+
+def registrar(texto, edad, historial, sintomas, reglas, diagnosticos):
+    """Envía un diagnóstico al escritor activo (no hace nada si la auditoría está desactivada)"""
+    escritor = _escritor
+    if escritor is not None:
+        escritor.registrar(texto, edad, historial, sintomas, reglas, diagnosticos)
+
+
+def vaciar():
+    """Espera a que el escritor activo haya escrito todo lo encolado"""
+    escritor = _escritor
+    if escritor is not None:
+        escritor.vaciar()
+
+
+def metricas():
+    """Contadores del escritor activo, o None si la auditoría está desactivada"""
+    escritor = _escritor
+    return escritor.metricas() if escritor is not None else None
+
+
+def _tras_fork():
+    """El hilo escritor no sobrevive a un fork: los procesos hijos no auditan"""
+    global activa, _escritor
+    activa = False
+    _escritor = None
+
+
+atexit.register(desactivar)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_tras_fork)
+
+if os.environ.get("SISTEMA_EXPERTO_AUDITORIA"):
+    activar(os.environ["SISTEMA_EXPERTO_AUDITORIA"])
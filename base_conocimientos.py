@@ -0,0 +1,396 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from array import array
+
+import clips
+
+# Fichero declarativo con sinónimos y reglas
+RUTA_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "base_conocimientos.json")
+
+# Las imágenes binarias de CLIPS se guardan junto a los .pyc, con el hash del fichero como nombre
+DIRECTORIO_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "base_conocimientos")
+
+# Templates del motor de inferencia (el esquema de los hechos no depende de la base)
+PLANTILLAS = [
+    "(deftemplate sintoma (slot nombre) (slot estado (default presente)))",
+    "(deftemplate edad (slot valor))",
+    "(deftemplate historial (slot condicion))",
+    "(deftemplate diagnostico (slot enfermedad) (slot certeza) (slot recomendacion) (slot regla))",
+    "(deftemplate riesgo (slot factor) (slot nivel))",
+]
+
+# Cambiar al modificar compilar_regla o PLANTILLAS: forma parte del hash de la cache
+VERSION_COMPILADOR = 5
+
+# Variable global de CLIPS en la que cada regla registra sus disparos (ver explicaciones)
+GLOBAL_TRAZA = "traza"
+
+# Palabras distintas cuya normalización memoriza cada base (ver id_forma); las
+# siguientes se normalizan en cada llamada, con el mismo resultado
+MAX_FORMAS = int(os.environ.get("SISTEMA_EXPERTO_MAX_FORMAS", "16384"))
+
+CONDICIONES = {"sintomas", "sintomas_negados", "historial", "edad_minima", "edad_maxima", "riesgos"}
+
+# Estado de un síntoma según el contexto del texto (ver contexto_clinico)
+PRESENTE, NEGADO, INCIERTO, PASADO = "presente", "negado", "incierto", "pasado"
+ESTADOS = (PRESENTE, NEGADO, INCIERTO, PASADO)
+# Estados con los que un síntoma cumple la condición "sintomas" de una regla
+ESTADOS_ACTIVOS = (PRESENTE, INCIERTO)
+
+_NOMBRE_VALIDO = re.compile(r"^[A-Za-z][A-Za-z0-9_\-]*$")
+
+
+# Atajo para las letras acentuadas más comunes; el resto pasa por la descomposición NFD
+_SIN_ACENTOS = str.maketrans("áéíóúüñàèìòùâêîôûäëïöç", "aeiouunaeiouaeiouaeioc")
+
+
+def plegar(texto):
+    """Pasa un texto a minúsculas y le quita los acentos ("Congestión" -> "congestion")"""
+    plegado = texto.lower().translate(_SIN_ACENTOS)
+    if plegado.isascii():
+        return plegado
+    descompuesto = unicodedata.normalize("NFD", plegado)
+    return "".join(c for c in descompuesto if unicodedata.category(c) != "Mn")
+
+
+def id_sintoma(texto):
+    """
+    Identificador canónico de un síntoma o condición: minúsculas, sin acentos y
+    con guiones bajos en lugar de espacios ("Congestión nasal" -> "congestion_nasal").
+    """
+    return plegar(texto).strip().replace(" ", "_")
+
+
+def calificar(canonico, estado=PRESENTE):
+    """Nombre de un síntoma con su estado: "fiebre" si está presente, "fiebre:negado" si no"""
+    return canonico if estado == PRESENTE else f"{canonico}:{estado}"
+
+
+def separar(nombre):
+    """Inverso de calificar: devuelve (síntoma canónico, estado)"""
+    canonico, _, estado = nombre.partition(":")
+    return canonico, estado or PRESENTE
+
+
+class IdsSintomas(array):
+    """
+    Array de ids de síntomas que además lleva, como cadenas en `otros`, los síntomas
+    que no están en la TablaSimbolos (palabras del texto fuera del vocabulario).
+    Ninguna regla los usa: no cuentan en la clave de la cache de diagnósticos.
+    """
+
+    def __new__(cls, tipo, ids=(), otros=()):
+        ids_sintomas = super().__new__(cls, tipo, ids)
+        ids_sintomas.otros = tuple(otros)
+        return ids_sintomas
+
+    def __reduce__(self):
+        return IdsSintomas, (self.typecode, list(self), self.otros)
+
+
+class TablaSimbolos:
+    """
+    Tabla de internado de síntomas y condiciones: cada identificador canónico recibe
+    un entero pequeño, en orden de llegada. Los síntomas viajan por el pipeline como
+    arrays de ids ordenados y sin repetidos (2 bytes por síntoma con el tipo "H") y
+    solo se vuelven a convertir en cadenas al salir (CLIPS, resultados, API pública).
+
+    La tabla solo contiene el vocabulario de las bases: las palabras que no conoce
+    (los NOUN/ADJ de spaCy) no reciben id y viajan como cadenas en el IdsSintomas de
+    cada llamada, así que el tamaño de la tabla no depende de los textos vistos. Los
+    ids solo tienen sentido dentro de un proceso; una base recargada parte de una
+    copia de la tabla anterior, así que los ids que ya existían no cambian al recargar.
+    """
+
+    def __init__(self, nombres=()):
+        self.nombres = []
+        self._ids = {}
+        self._candado = threading.Lock()
+        for nombre in nombres:
+            self.internar(nombre)
+
+    def __len__(self):
+        return len(self.nombres)
+
+    def copia(self):
+        """Tabla nueva con los mismos nombres e ids, que crece sin tocar esta"""
+        with self._candado:
+            return TablaSimbolos(list(self.nombres))
+
+    @property
+    def tipo(self):
+        """Código de tipo de los arrays de ids: "H" mientras quepan en 16 bits"""
+        return "H" if len(self.nombres) <= 0xFFFF else "I"
+
+    def buscar(self, nombre):
+        """Id de un identificador canónico, o None si no está en la tabla"""
+        return self._ids.get(nombre)
+
+    def internar(self, nombre):
+        """Id de un identificador canónico de la base, añadiéndolo a la tabla si es nuevo"""
+        id_simbolo = self._ids.get(nombre)
+        if id_simbolo is None:
+            with self._candado:
+                id_simbolo = self._ids.get(nombre)
+                if id_simbolo is None:
+                    id_simbolo = len(self.nombres)
+                    self.nombres.append(nombre)
+                    self._ids[nombre] = id_simbolo
+        return id_simbolo
+
+    def id_o_nombre(self, nombre):
+        """Id de un nombre si está en la tabla; si no, el propio nombre"""
+        id_simbolo = self._ids.get(nombre)
+        return nombre if id_simbolo is None else id_simbolo
+
+    def array_ids(self, ids):
+        """
+        Array compacto con los ids dados, ordenados y sin repetidos. Los elementos que
+        son cadenas (nombres fuera de la tabla) se guardan ordenados en un IdsSintomas.
+        """
+        ids = set(ids)
+        otros = [nombre for nombre in ids if isinstance(nombre, str)]
+        if not otros:
+            return array(self.tipo, sorted(ids))
+        ids.difference_update(otros)
+        return IdsSintomas(self.tipo, sorted(ids), sorted(otros))
+
+    def codificar(self, nombres):
+        """Array compacto de ids de unos identificadores canónicos (ver array_ids)"""
+        return self.array_ids(self.id_o_nombre(nombre) for nombre in nombres)
+
+    def decodificar(self, ids):
+        """Lista de identificadores canónicos de un array de ids (con los de fuera de la tabla al final)"""
+        nombres = self.nombres
+        return [nombres[i] for i in ids] + list(getattr(ids, "otros", ()))
+
+
+def _cadena_clips(texto):
+    """Convierte un texto en una cadena CLIPS con comillas y barras escapadas"""
+    return '"' + str(texto).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def compilar_regla(regla):
+    """
+    Traduce una regla declarativa (dict) al código de un defrule de CLIPS.
+    Las condiciones van dentro de un (logical ...): si se retira un hecho del que
+    depende la conclusión, CLIPS la retira también (necesario en las sesiones).
+    Al dispararse, la regla añade a la global GLOBAL_TRAZA un registro con su nombre,
+    el estado de cada síntoma y la edad (ver explicaciones.TrazaDisparos).
+    """
+    nombre = regla.get("nombre", "")
+    if not _NOMBRE_VALIDO.match(nombre):
+        raise ValueError(f"Nombre de regla no válido: {nombre!r}")
+    si = regla.get("si", {})
+    desconocidas = set(si) - CONDICIONES
+    if desconocidas:
+        raise ValueError(f"Condiciones desconocidas en {nombre}: {', '.join(sorted(desconocidas))}")
+
+    patrones = []
+    variables = []
+    for i, sintoma in enumerate(si.get("sintomas", []), 1):
+        patrones.append(f"(sintoma (nombre {id_sintoma(sintoma)}) (estado ?s{i}&{'|'.join(ESTADOS_ACTIVOS)}))")
+        variables.append(f"?s{i}")
+    for sintoma in si.get("sintomas_negados", []):
+        patrones.append(f"(sintoma (nombre {id_sintoma(sintoma)}) (estado {NEGADO}))")
+    for condicion in si.get("historial", []):
+        patrones.append(f"(historial (condicion {id_sintoma(condicion)}))")
+    if "edad_minima" in si or "edad_maxima" in si:
+        patrones.append("(edad (valor ?e))")
+        variables.append("?e")
+        if "edad_minima" in si:
+            patrones.append(f"(test (>= ?e {float(si['edad_minima']):g}))")
+        if "edad_maxima" in si:
+            patrones.append(f"(test (<= ?e {float(si['edad_maxima']):g}))")
+    for riesgo in si.get("riesgos", []):
+        patrones.append(f"(riesgo (factor {_cadena_clips(riesgo['factor'])}) (nivel {_cadena_clips(riesgo['nivel'])}))")
+    if not patrones:
+        raise ValueError(f"La regla {nombre} no tiene condiciones")
+
+    entonces = regla.get("entonces", {})
+    if "diagnostico" in entonces:
+        d = entonces["diagnostico"]
+        conclusion = (f"(diagnostico (enfermedad {_cadena_clips(d['enfermedad'])}) (certeza {int(d['certeza'])}) "
+                      f"(recomendacion {_cadena_clips(d['recomendacion'])}) (regla {nombre}))")
+    elif "riesgo" in entonces:
+        r = entonces["riesgo"]
+        conclusion = f"(riesgo (factor {_cadena_clips(r['factor'])}) (nivel {_cadena_clips(r['nivel'])}))"
+    else:
+        raise ValueError(f"La regla {nombre} no concluye un diagnostico ni un riesgo")
+
+    cuerpo = "\n".join("      " + patron for patron in patrones)
+    registro = " ".join([f'"{nombre}"'] + [f'" " {variable}' for variable in variables] + ['";"'])
+    traza = f"(bind ?*{GLOBAL_TRAZA}* (str-cat ?*{GLOBAL_TRAZA}* {registro}))"
+    return f"(defrule {nombre}\n   (logical\n{cuerpo})\n   =>\n   {traza}\n   (assert {conclusion}))"
+
+
+class BaseConocimientos:
+    """
+    Base de conocimientos compilada a partir del fichero declarativo.
+
+    Contiene las reglas traducidas a CLIPS y los índices derivados que antes se
+    reconstruían en cada llamada: sinónimo -> síntoma canónico, enfermedad ->
+    síntomas requeridos (encadenamiento hacia atrás) y enfermedad -> explicación.
+    """
+
+    def __init__(self, datos, huella, anterior=None):
+        self.datos = datos
+        self.huella = huella
+        self.sinonimos = datos.get("sinonimos", {})
+        self.definiciones = datos.get("reglas", [])
+        self.reglas = [compilar_regla(regla) for regla in self.definiciones]
+
+        self.indice_sinonimos = {}
+        for clave, lista in self.sinonimos.items():
+            canonico = id_sintoma(clave)
+            self.indice_sinonimos[clave] = canonico
+            for sinonimo in lista:
+                self.indice_sinonimos[sinonimo] = canonico
+
+        # Todas las formas de superficie conocidas (claves, sinónimos y términos de las reglas)
+        self.vocabulario = dict(self.indice_sinonimos)
+        for regla in self.definiciones:
+            for sintoma in regla.get("si", {}).get("sintomas", []):
+                self.vocabulario.setdefault(sintoma, id_sintoma(sintoma))
+
+        # Ids enteros de los síntomas y condiciones que aparecen en la base, también
+        # los de los síntomas del vocabulario y de las reglas con el estado que pueden
+        # tener en el texto (las palabras que no son del vocabulario no entran en la tabla).
+        # Al recargar se parte de una copia de la tabla de la base `anterior` y se le
+        # añaden los nombres nuevos: los arrays extraídos con aquella siguen siendo
+        # válidos con esta, y si la base se rechaza la tabla en servicio no cambia.
+        nombres = {calificar(canonico, estado) for canonico in self.vocabulario.values() for estado in ESTADOS}
+        for regla in self.definiciones:
+            si = regla.get("si", {})
+            nombres.update(id_sintoma(c) for c in si.get("historial", []))
+            for sintoma in si.get("sintomas", []) + si.get("sintomas_negados", []):
+                nombres.update(calificar(id_sintoma(sintoma), estado) for estado in ESTADOS)
+        self.simbolos = anterior.simbolos.copia() if anterior is not None else TablaSimbolos()
+        for nombre in sorted(nombres):
+            self.simbolos.internar(nombre)
+        # Palabra del texto -> id (o nombre) de su síntoma normalizado, rellenado al
+        # extraer y con como mucho MAX_FORMAS palabras
+        self._ids_formas = {}
+
+        # Una enfermedad puede concluirse con varias reglas: se guardan todas las alternativas
+        self.requisitos = {}
+        self.reglas_por_nombre = {regla["nombre"]: regla for regla in self.definiciones}
+        for regla in self.definiciones:
+            diagnostico = regla.get("entonces", {}).get("diagnostico")
+            if diagnostico is None:
+                continue
+            enfermedad = diagnostico["enfermedad"]
+            sintomas = tuple(id_sintoma(s) for s in regla.get("si", {}).get("sintomas", []))
+            self.requisitos.setdefault(enfermedad, []).append(sintomas)
+
+    def id_forma(self, forma):
+        """
+        Id del síntoma normalizado de una palabra (sinónimo o identificador canónico),
+        o el nombre normalizado si no está en la tabla de símbolos. Se memorizan las
+        primeras MAX_FORMAS palabras distintas; las demás se normalizan cada vez.
+        """
+        id_simbolo = self._ids_formas.get(forma)
+        if id_simbolo is None:
+            canonico = self.indice_sinonimos.get(forma)
+            id_simbolo = self.simbolos.id_o_nombre(canonico if canonico is not None else id_sintoma(forma))
+            if len(self._ids_formas) < MAX_FORMAS:
+                self._ids_formas[forma] = id_simbolo
+        return id_simbolo
+
+    def _ruta_imagen(self):
+        return os.path.join(DIRECTORIO_CACHE, f"{self.huella}.bin")
+
+    def crear_entorno(self):
+        """
+        Crea un entorno CLIPS con los templates y reglas de esta base. Si existe una
+        imagen binaria para este mismo contenido se carga con bload en vez de parsear.
+        """
+        ruta = self._ruta_imagen()
+        if os.path.exists(ruta):
+            env = clips.Environment()
+            try:
+                env.load(ruta, binary=True)
+                return env
+            except clips.CLIPSError:
+                pass
+
+        env = clips.Environment()
+        # Evita el aviso de bsave sobre restricciones; el entorno cargado no lo hereda
+        env.eval("(set-dynamic-constraint-checking TRUE)")
+        for plantilla in PLANTILLAS:
+            env.build(plantilla)
+        env.build(f'(defglobal ?*{GLOBAL_TRAZA}* = "")')
+        for regla in self.reglas:
+            env.build(regla)
+        self._guardar_imagen(env, ruta)
+        env.eval("(set-dynamic-constraint-checking FALSE)")
+        return env
+
+    def _guardar_imagen(self, env, ruta):
+        """Guarda la imagen binaria del entorno; si no se puede escribir se sigue sin cache"""
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+            env.save(temporal, binary=True)
+            os.replace(temporal, ruta)
+        except (OSError, clips.CLIPSError):
+            if os.path.exists(temporal):
+                os.remove(temporal)
+
+
+def cargar_base(ruta=RUTA_BASE, anterior=None):
+    """
+    Lee y compila el fichero de la base de conocimientos. Con `anterior` (la base que
+    se va a sustituir) la nueva conserva los ids de su tabla de símbolos, sin
+    modificarla.
+    """
+    with open(ruta, "rb") as fichero:
+        contenido = fichero.read()
+    resumen = hashlib.sha256(contenido)
+    resumen.update(f"{VERSION_COMPILADOR}:{PLANTILLAS}".encode())
+    huella = resumen.hexdigest()[:16]
+    return BaseConocimientos(json.loads(contenido.decode("utf-8")), huella, anterior)
+
+
+class RecursoPorHuella:
+    """
+    Recurso derivado de una base de conocimientos (matcher, índice, motor...) que se
+    construye con `construir(base)` en el primer uso y otra vez cuando cambia la huella
+    de la base. La huella se comprueba sin candado; solo la construcción lo toma
+    (doble comprobación), así que el caso habitual no se bloquea.
+    """
+
+    __slots__ = ("_actual", "_candado", "_construir")
+
+    def __init__(self, construir, candado=None):
+        self._construir = construir
+        self._candado = candado or threading.Lock()
+        # (recurso, huella de la base con la que se construyó), o None
+        self._actual = None
+
+    @property
+    def construido(self):
+        """Indica si el recurso ya se construyó para alguna base"""
+        return self._actual is not None
+
+    def obtener(self, base):
+        """Recurso de `base`, construyéndolo si aún no existe o es de otra base"""
+        actual = self._actual
+        if actual is None or actual[1] != base.huella:
+            with self._candado:
+                actual = self._actual
+                if actual is None or actual[1] != base.huella:
+                    actual = self._actual = (self._construir(base), base.huella)
+        return actual[0]
+
+    def construir(self, base):
+        """Construye el recurso de `base` sin instalarlo (ver instalar)"""
+        return self._construir(base)
+
+    def instalar(self, recurso, base):
+        """Pone en uso un recurso ya construido para `base`"""
+        self._actual = (recurso, base.huella)
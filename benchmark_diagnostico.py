@@ -0,0 +1,358 @@
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from sistema_experto import (
+    _inferir,
+    _recursos,
+    _sintomas_de_doc,
+    cache_diagnosticos,
+    cargar_hechos,
+    crear_entorno,
+    obtener_base,
+    obtener_extractor_rapido,
+    obtener_motor_compilado,
+    recoger_diagnosticos,
+)
+
+# Paciente de ejemplo para las mediciones de carga de hechos
+SINTOMAS_EJEMPLO = ["fiebre_alta", "tos_seca", "dificultad_para_respirar", "dolor_muscular", "congestion_nasal"]
+EDAD_EJEMPLO = 65
+HISTORIAL_EJEMPLO = ["asma", "diabetes"]
+
+# Etapas del diagnóstico que se miden por separado
+ETAPAS = ["parse_spacy", "normalizacion", "carga_hechos", "inferencia", "recoleccion"]
+
+# Plantillas y relleno para las notas sintéticas
+PLANTILLAS_NOTA = [
+    "Tengo {sintomas}.",
+    "Desde hace {dias} días presento {sintomas}.",
+    "El paciente refiere {sintomas}.",
+    "Me siento mal, con {sintomas}.",
+    "Acudo a consulta por {sintomas}.",
+]
+RELLENO = [
+    "No he viajado recientemente.",
+    "Trabajo en una oficina y duermo poco.",
+    "Tomé paracetamol ayer sin mejoría.",
+    "Vivo con mi familia y nadie más está enfermo.",
+    "Los síntomas empeoran por la noche.",
+    "Como con normalidad y bebo bastante agua.",
+    "Hace una semana estuve en una reunión con mucha gente.",
+    "No tengo alergias conocidas a medicamentos.",
+]
+HISTORIAL_POSIBLE = ["asma", "diabetes", "hipertensión"]
+# Cómo se menciona un síntoma según su estado, para las notas con contexto
+MENCIONES = {"presente": "tengo {}", "negado": "no tengo {}", "incierto": "posible {}", "pasado": "tuve {}"}
+
+
+def generar_notas(cantidad, largas=False, semilla=0):
+    """
+    Genera notas de ingreso sintéticas en español a partir de los sinónimos y las reglas.
+    Cada nota es un dict con texto, edad, historial y los síntomas esperados (ids canónicos).
+    Con largas=True cada nota lleva varias frases de relleno alrededor de los síntomas.
+    """
+    aleatorio = random.Random(semilla)
+    vocabulario = sorted(obtener_base().vocabulario.items())
+    for _ in range(cantidad):
+        elegidos = aleatorio.sample(vocabulario, aleatorio.randint(1, min(4, len(vocabulario))))
+        formas = [forma for forma, _ in elegidos]
+        lista = formas[0] if len(formas) == 1 else ", ".join(formas[:-1]) + " y " + formas[-1]
+        frase = aleatorio.choice(PLANTILLAS_NOTA).format(sintomas=lista, dias=aleatorio.randint(1, 10))
+        if largas:
+            relleno = aleatorio.choices(RELLENO, k=10)
+            frase = " ".join(relleno[:5] + [frase] + relleno[5:])
+        yield {
+            "texto": frase,
+            "edad": aleatorio.randint(1, 95),
+            "historial": aleatorio.sample(HISTORIAL_POSIBLE, aleatorio.randint(0, 2)),
+            "esperados": sorted({canonico for _, canonico in elegidos}),
+        }
+
+
+def generar_notas_contexto(cantidad, semilla=0):
+    """
+    Notas sintéticas construidas sobre la premisa de una regla al azar: cada síntoma
+    aparece presente, negado, incierto o pasado, y en un tercio de las notas falta
+    uno (coincidencia parcial). Mismo formato que generar_notas, sin "esperados".
+    """
+    aleatorio = random.Random(semilla)
+    premisas = [regla["si"]["sintomas"] for regla in obtener_base().definiciones if regla.get("si", {}).get("sintomas")]
+    estados = list(MENCIONES)
+    for _ in range(cantidad):
+        sintomas = list(aleatorio.choice(premisas))
+        if len(sintomas) > 1 and aleatorio.random() < 1 / 3:
+            sintomas.remove(aleatorio.choice(sintomas))
+        menciones = [MENCIONES[aleatorio.choices(estados, weights=(3, 1, 1, 1))[0]].format(sintoma)
+                     for sintoma in sintomas]
+        yield {
+            "texto": ", ".join(menciones).capitalize() + ".",
+            "edad": aleatorio.randint(1, 95),
+            "historial": aleatorio.sample(HISTORIAL_POSIBLE, aleatorio.randint(0, 2)),
+        }
+
+
+def notas_motores(cantidad, largas=False, semilla=0):
+    """Corpus de comparar_motores: mitad notas de generar_notas, mitad de generar_notas_contexto"""
+    yield from generar_notas(cantidad // 2, largas, semilla)
+    yield from generar_notas_contexto(cantidad - cantidad // 2, semilla)
+
+
+def _percentil(ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not ordenados:
+        return 0.0
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def _commit_actual():
+    """Hash del commit de git actual, si está disponible"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def medir_pipeline(notas, ligero=None):
+    """
+    Ejecuta el diagnóstico de cada nota midiendo por separado el parse de spaCy, la
+    normalización, la carga de hechos, env.run y la recolección de resultados.
+    Las caches no intervienen. Devuelve un dict serializable a JSON.
+    """
+    nlp, matcher = _recursos(ligero)
+    env = crear_entorno()
+    tiempos = {etapa: [] for etapa in ETAPAS}
+    reglas_disparadas = 0
+    cantidad = 0
+
+    inicio = time.perf_counter()
+    for nota in notas:
+        t0 = time.perf_counter()
+        doc = nlp(nota["texto"].lower())
+        t1 = time.perf_counter()
+        sintomas = _sintomas_de_doc(doc, matcher)
+        t2 = time.perf_counter()
+        env.reset()
+        cargar_hechos(env, sintomas, nota["edad"], nota["historial"])
+        t3 = time.perf_counter()
+        reglas_disparadas += env.run()
+        t4 = time.perf_counter()
+        recoger_diagnosticos(env)
+        t5 = time.perf_counter()
+
+        for etapa, duracion in zip(ETAPAS, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)):
+            tiempos[etapa].append(duracion)
+        cantidad += 1
+    segundos = time.perf_counter() - inicio
+
+    etapas = {}
+    for etapa, valores in tiempos.items():
+        valores.sort()
+        etapas[etapa] = {
+            "p50_ms": _percentil(valores, 50) * 1000,
+            "p95_ms": _percentil(valores, 95) * 1000,
+            "p99_ms": _percentil(valores, 99) * 1000,
+            "media_ms": sum(valores) / len(valores) * 1000 if valores else 0.0,
+            "total_s": sum(valores),
+        }
+    return {
+        "notas": cantidad,
+        "segundos": segundos,
+        "notas_por_segundo": cantidad / segundos if segundos else 0.0,
+        "reglas_disparadas": reglas_disparadas,
+        "etapas": etapas,
+    }
+
+
+def _precision_recall(aciertos, detectados, esperados):
+    return {"precision": aciertos / detectados if detectados else 0.0,
+            "recall": aciertos / esperados if esperados else 0.0}
+
+
+def comparar_extractores(notas, ligero=None):
+    """
+    Compara el extractor de spaCy con el rápido sobre las mismas notas: tiempo por
+    nota, precisión y recall frente a los síntomas esperados del generador, y
+    proporción de notas en las que ambos llevan a los mismos diagnósticos.
+    Sin caches. Devuelve un dict serializable a JSON.
+    """
+    nlp, matcher = _recursos(ligero)
+    rapido = obtener_extractor_rapido()
+    extractores = {
+        "spacy": lambda texto: _sintomas_de_doc(nlp(texto.lower()), matcher),
+        "rapido": rapido.extraer,
+    }
+    env = crear_entorno()
+    segundos = dict.fromkeys(extractores, 0.0)
+    aciertos = dict.fromkeys(extractores, 0)
+    detectados = dict.fromkeys(extractores, 0)
+    esperados = 0
+    mismos_diagnosticos = 0
+    cantidad = 0
+
+    for nota in notas:
+        diagnosticos = {}
+        for nombre, extraer in extractores.items():
+            inicio = time.perf_counter()
+            sintomas = set(extraer(nota["texto"]))
+            segundos[nombre] += time.perf_counter() - inicio
+            aciertos[nombre] += len(sintomas.intersection(nota["esperados"]))
+            detectados[nombre] += len(sintomas)
+            diagnosticos[nombre] = set(_inferir(sintomas, nota["edad"], nota["historial"], env))
+        esperados += len(nota["esperados"])
+        mismos_diagnosticos += diagnosticos["spacy"] == diagnosticos["rapido"]
+        cantidad += 1
+
+    resultado = {"notas": cantidad, "acuerdo_diagnosticos": mismos_diagnosticos / cantidad if cantidad else 0.0}
+    for nombre in extractores:
+        resultado[nombre] = {
+            "us_por_nota": segundos[nombre] / cantidad * 1e6 if cantidad else 0.0,
+            "sintomas_por_nota": detectados[nombre] / cantidad if cantidad else 0.0,
+            **_precision_recall(aciertos[nombre], detectados[nombre], esperados),
+        }
+    resultado["aceleracion"] = segundos["spacy"] / segundos["rapido"] if segundos["rapido"] else 0.0
+    return resultado
+
+
+def comparar_motores(notas, ligero=None):
+    """
+    Prueba de equivalencia del motor compilado frente a CLIPS: diagnostica cada nota
+    con ambos (síntomas del extractor rápido) y cuenta las que no dan exactamente la
+    misma lista. Devuelve también el tiempo de inferencia por paciente de cada motor.
+    El compilado se llama como en producción, _inferir(..., motor="compilado"), con
+    la cache de diagnósticos vacía; CLIPS, con un entorno propio. Conviene usar
+    notas_motores, que incluye síntomas negados, inciertos y premisas incompletas.
+    """
+    if obtener_motor_compilado() is None:
+        raise SystemExit("La base actual no se puede compilar; solo está disponible CLIPS")
+    rapido = obtener_extractor_rapido()
+    env = crear_entorno()
+    motores = {
+        "clips": lambda sintomas, edad, historial: _inferir(sintomas, edad, historial, env),
+        "compilado": lambda sintomas, edad, historial: _inferir(sintomas, edad, historial, motor="compilado"),
+    }
+    segundos = dict.fromkeys(motores, 0.0)
+    diferencias = []
+    cantidad = 0
+
+    for nota in notas:
+        sintomas = rapido.extraer_ids(nota["texto"])
+        diagnosticos = {}
+        for nombre, inferir in motores.items():
+            cache_diagnosticos.limpiar()
+            inicio = time.perf_counter()
+            diagnosticos[nombre] = inferir(sintomas, nota["edad"], nota["historial"])
+            segundos[nombre] += time.perf_counter() - inicio
+        if diagnosticos["clips"] != diagnosticos["compilado"]:
+            diferencias.append({"texto": nota["texto"], "edad": nota["edad"], "historial": nota["historial"],
+                                **diagnosticos})
+        cantidad += 1
+
+    resultado = {"notas": cantidad, "diferencias": len(diferencias), "ejemplos_diferencias": diferencias[:10]}
+    for nombre in motores:
+        resultado[nombre] = {"us_por_paciente": segundos[nombre] / cantidad * 1e6 if cantidad else 0.0}
+    resultado["aceleracion"] = segundos["clips"] / segundos["compilado"] if segundos["compilado"] else 0.0
+    return resultado
+
+
+def _cargar_con_strings(env, sintomas, edad, historial):
+    """Carga de hechos original: genera código CLIPS y lo parsea con assert_string"""
+    for sintoma in sintomas:
+        env.assert_string(f'(sintoma (nombre {sintoma}))')
+    env.assert_string(f'(edad (valor {edad}))')
+    for condicion in historial:
+        env.assert_string(f'(historial (condicion {condicion.replace(" ", "_")}))')
+
+
+def benchmark_hechos(repeticiones=5000):
+    """
+    Mide el coste por hecho de cargar un paciente con assert_string frente a
+    cargar_hechos (templates). Devuelve un dict con microsegundos por hecho.
+    """
+    env = crear_entorno()
+    hechos_por_paciente = len(SINTOMAS_EJEMPLO) + 1 + len(HISTORIAL_EJEMPLO)
+    resultados = {}
+    for nombre, cargar in (("assert_string", _cargar_con_strings), ("assert_fact", cargar_hechos)):
+        total = 0.0
+        for _ in range(repeticiones):
+            env.reset()
+            inicio = time.perf_counter()
+            cargar(env, SINTOMAS_EJEMPLO, EDAD_EJEMPLO, HISTORIAL_EJEMPLO)
+            total += time.perf_counter() - inicio
+        resultados[nombre] = total / (repeticiones * hechos_por_paciente) * 1e6
+    return resultados
+
+
+def _escribir(resultado, salida):
+    """Escribe el resultado en JSON en el fichero indicado o en la salida estándar"""
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2)
+    if salida:
+        with open(salida, "w", encoding="utf-8") as fichero:
+            fichero.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks del sistema de diagnóstico (resultados en JSON)")
+    subparsers = parser.add_subparsers(dest="comando")
+
+    pipeline = subparsers.add_parser("pipeline", help="latencia por etapa sobre notas sintéticas")
+    pipeline.add_argument("--notas", type=int, default=1000)
+    pipeline.add_argument("--largas", action="store_true", help="notas largas con frases de relleno")
+    pipeline.add_argument("--ligero", action="store_true", help="spaCy sin parser, NER ni lematizador")
+    pipeline.add_argument("--semilla", type=int, default=0)
+    pipeline.add_argument("--salida", help="fichero JSON de resultados (por defecto, salida estándar)")
+
+    extractores = subparsers.add_parser("extractores", help="spaCy frente al extractor rápido (tiempo y precisión)")
+    extractores.add_argument("--notas", type=int, default=1000)
+    extractores.add_argument("--largas", action="store_true")
+    extractores.add_argument("--ligero", action="store_true")
+    extractores.add_argument("--semilla", type=int, default=0)
+    extractores.add_argument("--salida")
+
+    motores = subparsers.add_parser("motores", help="equivalencia y tiempo del motor compilado frente a CLIPS")
+    motores.add_argument("--notas", type=int, default=1000)
+    motores.add_argument("--largas", action="store_true")
+    motores.add_argument("--ligero", action="store_true")
+    motores.add_argument("--semilla", type=int, default=0)
+    motores.add_argument("--salida")
+
+    hechos = subparsers.add_parser("hechos", help="coste por hecho de assert_string frente a templates")
+    hechos.add_argument("--repeticiones", type=int, default=5000)
+    hechos.add_argument("--salida")
+
+    args = parser.parse_args()
+    if args.comando is None:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.comando == "hechos":
+        resultado = {"microsegundos_por_hecho": benchmark_hechos(args.repeticiones), "repeticiones": args.repeticiones}
+        configuracion = {"repeticiones": args.repeticiones}
+    else:
+        configuracion = {"notas": args.notas, "largas": args.largas, "ligero": args.ligero, "semilla": args.semilla}
+        medir = {"pipeline": medir_pipeline, "extractores": comparar_extractores, "motores": comparar_motores}[args.comando]
+        generar = notas_motores if args.comando == "motores" else generar_notas
+        resultado = medir(generar(args.notas, args.largas, args.semilla), args.ligero)
+
+    resultado = {
+        "benchmark": args.comando,
+        "commit": _commit_actual(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "configuracion": configuracion,
+        **resultado,
+        # ru_maxrss está en KB en Linux
+        "rss_maximo_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    _escribir(resultado, args.salida)
+    # La comparación de motores es una prueba: falla si hay alguna diferencia
+    if resultado.get("diferencias"):
+        sys.exit(1)
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Marca para distinguir "no está en la cache" de un valor guardado None
+_AUSENTE = object()
+
+
+class CacheLRU:
+    """
+    Cache en memoria con expulsión LRU y caducidad opcional (TTL en segundos).
+    Es segura entre hilos y lleva contadores de aciertos y fallos.
+    Con tamano_maximo=0 queda desactivada.
+    """
+
+    def __init__(self, tamano_maximo=10000, ttl=None):
+        self.tamano_maximo = tamano_maximo
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._candado = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def obtener(self, clave, defecto=None):
+        """Devuelve el valor guardado para `clave` o `defecto` si no está o caducó"""
+        with self._candado:
+            entrada = self._datos.get(clave, _AUSENTE)
+            if entrada is not _AUSENTE:
+                valor, caduca = entrada
+                if caduca is None or caduca > time.monotonic():
+                    self._datos.move_to_end(clave)
+                    self.aciertos += 1
+                    return valor
+                del self._datos[clave]
+            self.fallos += 1
+            return defecto
+
+    def guardar(self, clave, valor):
+        """Guarda `valor` para `clave`, expulsando la entrada menos usada si hace falta"""
+        if self.tamano_maximo <= 0:
+            return
+        caduca = time.monotonic() + self.ttl if self.ttl else None
+        with self._candado:
+            self._datos[clave] = (valor, caduca)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.tamano_maximo:
+                self._datos.popitem(last=False)
+                self.expulsiones += 1
+
+    def limpiar(self):
+        """Vacía la cache (los contadores se conservan)"""
+        with self._candado:
+            self._datos.clear()
+
+    def __len__(self):
+        return len(self._datos)
+
+    def metricas(self):
+        """Devuelve un dict con el tamaño y los contadores de la cache"""
+        with self._candado:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "tasa_aciertos": self.aciertos / consultas if consultas else 0.0,
+            }
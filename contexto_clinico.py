@@ -0,0 +1,162 @@
+from base_conocimientos import (
+    ESTADOS,
+    INCIERTO,
+    NEGADO,
+    PASADO,
+    calificar,
+    plegar,
+    separar,
+)
+
+# Palabras siguientes (o anteriores) a las que alcanza un disparador
+VENTANA = 5
+
+# Certeza con la que cuenta un síntoma que solo aparece como incierto ("posible fiebre")
+CERTEZA_INCIERTO = 0.5
+
+# Tipos de frase que reconoce estados_contexto
+_PREVIO, _POSTERIOR, _TERMINADOR, _PSEUDO, _REINICIO = range(5)
+
+# Disparadores al estilo de NegEx: los previos afectan a las palabras siguientes
+# ("no tengo fiebre") y los posteriores a las anteriores ("covid descartado").
+# Se escriben en minúsculas y sin acentos, como quedan tras plegar().
+DISPARADORES_PREVIOS = {
+    NEGADO: ["no", "sin", "ni", "niega", "niego", "nego", "tampoco", "nunca", "jamas", "ausencia de",
+             "negativo para", "negativa para", "descarta", "descartamos", "libre de"],
+    INCIERTO: ["posible", "posibles", "probable", "probablemente", "sospecha de", "sospecho", "quizas", "quiza",
+               "tal vez", "puede que", "creo que", "no se si", "no estoy seguro de", "parece"],
+    PASADO: ["antecedentes de", "antecedente de", "historia de", "historial de", "hace anos", "hace meses",
+             "el ano pasado", "en el pasado", "de nino", "de nina", "de pequeno", "de pequena", "previamente",
+             "tuve", "tenia", "padeci", "sufri"],
+}
+DISPARADORES_POSTERIORES = {
+    NEGADO: ["negativo", "negativa", "descartado", "descartada", "ausente"],
+    INCIERTO: ["dudoso", "dudosa", "a descartar", "por confirmar"],
+    PASADO: ["ya resuelto", "ya resuelta"],
+}
+# Cortan el alcance de un disparador (la coma también: "no tengo fiebre, tengo tos")
+TERMINADORES = ["pero", "aunque", "sin embargo", "no obstante", "excepto", "salvo", "ahora", "actualmente", "hoy",
+                ".", ",", ";", ":", "!", "?"]
+# Verbos que empiezan una cláusula nueva: cortan el alcance salvo que sigan justo a
+# un disparador previo ("no tengo fiebre" sí niega la fiebre; "no hay fiebre y tengo tos", no la tos)
+REINICIOS = ["tengo", "tiene", "tenemos", "presento", "presenta", "siento", "noto", "hay"]
+# Contienen un disparador pero no lo son ("fiebre que no cede" no niega la fiebre)
+PSEUDO_DISPARADORES = ["no solo", "sin duda", "no cede", "no mejora", "no remite", "no ha mejorado", "no se quita"]
+
+
+def _indice_frases():
+    """Primera palabra -> [(palabras, tipo, índice del estado)], de la frase más larga a la más corta"""
+    frases = [(frase, _TERMINADOR, 0) for frase in TERMINADORES]
+    frases += [(frase, _REINICIO, 0) for frase in REINICIOS]
+    frases += [(frase, _PSEUDO, 0) for frase in PSEUDO_DISPARADORES]
+    for tipo, disparadores in ((_PREVIO, DISPARADORES_PREVIOS), (_POSTERIOR, DISPARADORES_POSTERIORES)):
+        frases += [(frase, tipo, ESTADOS.index(estado)) for estado, lista in disparadores.items() for frase in lista]
+    indice = {}
+    for frase, tipo, estado in frases:
+        palabras = tuple(frase.split())
+        indice.setdefault(palabras[0], []).append((palabras, tipo, estado))
+    for opciones in indice.values():
+        opciones.sort(key=lambda opcion: -len(opcion[0]))
+    return indice
+
+
+_FRASES = _indice_frases()
+_LARGO_MAXIMO = max(len(opcion[0]) for opciones in _FRASES.values() for opcion in opciones)
+
+
+def palabras_contexto(palabras):
+    """Pliega (sin acentos) unas palabras ya en minúsculas; solo se toca las que no son ASCII"""
+    return [palabra if palabra.isascii() else plegar(palabra) for palabra in palabras]
+
+
+def _frase_en(palabras, posicion):
+    """(palabras, tipo, estado) de la frase más larga que empieza en `posicion`, o None"""
+    for opcion in _FRASES.get(palabras[posicion], ()):
+        frase = opcion[0]
+        if tuple(palabras[posicion:posicion + len(frase)]) == frase:
+            return opcion
+    return None
+
+
+def _sigue_a_previo(palabras, posicion):
+    """Indica si un disparador previo termina justo antes de `posicion`"""
+    for k in range(max(0, posicion - _LARGO_MAXIMO), posicion):
+        opcion = _frase_en(palabras, k) if palabras[k] in _FRASES else None
+        if opcion is not None and opcion[1] == _PREVIO and k + len(opcion[0]) == posicion:
+            return True
+    return False
+
+
+def hay_disparadores(palabras):
+    """
+    Indica si alguna palabra puede iniciar un disparador o un terminador. Si no, todas
+    las palabras están presentes y no hace falta llamar a estado_en: el caso habitual.
+    """
+    return not _FRASES.keys().isdisjoint(palabras)
+
+
+def estado_en(palabras, posicion):
+    """
+    Índice en ESTADOS (0 = presente) de la palabra en `posicion` de un texto ya
+    tokenizado (minúsculas, sin acentos). Como en NegEx, manda el disparador previo
+    más cercano a menos de VENTANA palabras, o si no hay, el primer disparador
+    posterior a esa distancia; un terminador o un verbo que reinicia la cláusula
+    corta la búsqueda. Solo se examinan las palabras alrededor de la posición, no
+    el texto entero.
+    """
+    # Hacia atrás, hasta un terminador o el final de la ventana
+    k = posicion - 1
+    limite = posicion - VENTANA - _LARGO_MAXIMO
+    while k >= 0 and k > limite:
+        opcion = _frase_en(palabras, k) if palabras[k] in _FRASES else None
+        if opcion is not None and k + len(opcion[0]) <= posicion:
+            frase, tipo, estado = opcion
+            if tipo == _TERMINADOR or tipo == _POSTERIOR:
+                break
+            if tipo == _REINICIO and not _sigue_a_previo(palabras, k):
+                break
+            if tipo == _PREVIO:
+                if posicion - (k + len(frase)) < VENTANA:
+                    return estado
+                break
+        k -= 1
+    # Hacia delante, solo disparadores posteriores
+    total = len(palabras)
+    j = posicion + 1
+    while j < total and j <= posicion + VENTANA:
+        opcion = _frase_en(palabras, j) if palabras[j] in _FRASES else None
+        if opcion is not None:
+            frase, tipo, estado = opcion
+            if tipo == _TERMINADOR or tipo == _REINICIO:
+                break
+            if tipo == _POSTERIOR:
+                return estado
+            j += len(frase)
+        else:
+            j += 1
+    return 0
+
+
+def calificar_id(simbolos, id_simbolo, estado):
+    """
+    Id en `simbolos` del síntoma `id_simbolo` con el estado de índice `estado`; si
+    `id_simbolo` es un nombre fuera de la tabla, el nombre calificado
+    """
+    if not estado:
+        return id_simbolo
+    if isinstance(id_simbolo, str):
+        return calificar(id_simbolo, ESTADOS[estado])
+    return simbolos.id_o_nombre(calificar(simbolos.nombres[id_simbolo], ESTADOS[estado]))
+
+
+def certezas_sintomas(nombres):
+    """
+    Certezas para ponderar las reglas (ver factores_certeza) a partir de los nombres
+    calificados de los síntomas: CERTEZA_INCIERTO para los que solo aparecen como
+    inciertos. None si no hay ninguno.
+    """
+    inciertos = [canonico for canonico, estado in map(separar, nombres) if estado == INCIERTO]
+    if not inciertos:
+        return None
+    presentes = set(nombres)
+    return {canonico: CERTEZA_INCIERTO for canonico in inciertos if canonico not in presentes} or None
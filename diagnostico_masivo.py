@@ -0,0 +1,281 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+
+from pool_procesos import PoolProcesos, procesar_lote
+from sistema_experto import EXTRACTORES, MOTORES
+
+# Columnas de la salida en CSV
+COLUMNAS_CSV = ["indice", "id", "sintomas", "diagnosticos", "error"]
+
+
+def _formato(ruta, formato):
+    """Formato indicado o deducido de la extensión del fichero (jsonl por defecto)"""
+    if formato:
+        return formato
+    return "csv" if ruta.lower().endswith(".csv") else "jsonl"
+
+
+def leer_registros(ruta, formato=None, desde=0):
+    """
+    Genera (indice, registro) a partir de un fichero JSONL o CSV ("-" es la entrada
+    estándar), leyendo de uno en uno. Los primeros `desde` registros se saltan.
+    """
+    formato = _formato(ruta, formato)
+    fichero = sys.stdin if ruta == "-" else open(ruta, encoding="utf-8", newline="")
+    try:
+        if formato == "csv":
+            lineas = enumerate(csv.DictReader(fichero))
+        else:
+            # Las líneas en blanco no cuentan como registros
+            lineas = enumerate(linea for linea in fichero if linea.strip())
+        for indice, registro in lineas:
+            if indice < desde:
+                continue
+            if formato != "csv":
+                try:
+                    registro = json.loads(registro)
+                except ValueError as e:
+                    registro = {"_error": f"JSON no válido: {e}"}
+            yield indice, registro
+    finally:
+        if fichero is not sys.stdin:
+            fichero.close()
+
+
+def _validar_registro(registro):
+    """Devuelve (texto, edad, historial) de un registro leído de JSON o CSV"""
+    if not isinstance(registro, dict):
+        raise ValueError("Se esperaba un objeto con texto, edad e historial")
+    if "_error" in registro:
+        raise ValueError(registro["_error"])
+    texto = registro.get("texto")
+    if not isinstance(texto, str) or not texto.strip():
+        raise ValueError("'texto' debe ser una cadena no vacía")
+    edad = registro.get("edad")
+    if isinstance(edad, str):
+        edad = float(edad) if "." in edad else int(edad)
+    if isinstance(edad, bool) or not isinstance(edad, (int, float)):
+        raise ValueError("'edad' debe ser un número")
+    historial = registro.get("historial") or []
+    if isinstance(historial, str):
+        # En CSV el historial va en una sola columna separado por ';'
+        historial = [c.strip() for c in historial.split(";") if c.strip()]
+    elif not isinstance(historial, list) or not all(isinstance(c, str) for c in historial):
+        raise ValueError("'historial' debe ser una lista de cadenas o una cadena separada por ';'")
+    return texto, edad, historial
+
+
+def _preparar_lote(lote):
+    """
+    Valida un lote de (indice, registro). Devuelve la lista (indice, registro, error)
+    y el lote compacto de (texto, edad, historial) de los registros válidos.
+    """
+    preparados = []
+    compacto = []
+    for indice, registro in lote:
+        try:
+            compacto.append(_validar_registro(registro))
+            preparados.append((indice, registro, None))
+        except (TypeError, ValueError) as e:
+            preparados.append((indice, registro, str(e)))
+    return preparados, compacto
+
+
+def _resultados(preparados, compactos):
+    """Une los registros de un lote con sus resultados compactos (sintomas, diagnosticos)"""
+    compactos = iter(compactos)
+    for indice, registro, error in preparados:
+        resultado = {"indice": indice}
+        if isinstance(registro, dict) and "id" in registro:
+            resultado["id"] = registro["id"]
+        if error is not None:
+            resultado["error"] = error
+            yield resultado
+            continue
+        sintomas, diagnosticos = next(compactos)
+        resultado["sintomas"] = list(sintomas)
+        resultado["diagnosticos"] = [{"enfermedad": enfermedad, "certeza": certeza, "recomendacion": recomendacion}
+                                     for enfermedad, certeza, recomendacion in diagnosticos]
+        yield resultado
+
+
+def _lotes(registros, tamano):
+    """Agrupa un iterable en listas de `tamano` elementos sin materializarlo entero"""
+    iterador = iter(registros)
+    while True:
+        lote = list(islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def _fila_csv(resultado):
+    return {
+        "indice": resultado["indice"],
+        "id": resultado.get("id", ""),
+        "sintomas": ";".join(resultado.get("sintomas", [])),
+        "diagnosticos": ";".join(f"{d['enfermedad']} ({d['certeza']})" for d in resultado.get("diagnosticos", [])),
+        "error": resultado.get("error", ""),
+    }
+
+
+def _leer_punto_control(ruta):
+    try:
+        with open(ruta, encoding="utf-8") as fichero:
+            return json.load(fichero)
+    except FileNotFoundError:
+        return None
+
+
+def _guardar_punto_control(ruta, datos):
+    """Escritura atómica: un corte a mitad nunca deja el punto de control a medias"""
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "w", encoding="utf-8") as fichero:
+        json.dump(datos, fichero)
+        fichero.flush()
+        os.fsync(fichero.fileno())
+    os.replace(temporal, ruta)
+
+
+def diagnosticar_fichero(entrada, salida, formato_entrada=None, formato_salida=None, procesos=1,
+                         tamano_lote=256, extractor=None, reanudar=False, cada=10000, progreso=None,
+                         tareas_por_proceso=None, almacen=None, motor=None):
+    """
+    Diagnostica todos los registros de `entrada` y escribe un resultado por registro
+    en `salida` a medida que se completan. La memoria no depende del tamaño de la
+    entrada: se leen, procesan y escriben lotes de `tamano_lote` registros. Con
+    procesos > 1 los lotes se reparten en un PoolProcesos.
+
+    `almacen` es el directorio de un AlmacenDocumentos: los textos ya analizados en
+    otra ejecución (por ejemplo, antes de cambiar las reglas) no vuelven a pasar por
+    spaCy. Solo admite un proceso, que es el único que escribe en el almacén.
+
+    Cada `cada` registros se sincroniza la salida y se guarda un punto de control en
+    `<salida>.checkpoint` con los registros procesados y el tamaño de la salida. Con
+    reanudar=True se recorta la salida a ese tamaño y se continúa desde ese registro.
+    Devuelve el número de registros escritos en esta ejecución.
+    """
+    if almacen is not None:
+        if procesos > 1:
+            raise ValueError("El almacén de documentos solo admite un proceso")
+        from almacen_documentos import AlmacenDocumentos
+
+        almacen = AlmacenDocumentos(almacen)
+    formato_salida = _formato(salida, formato_salida)
+    ruta_control = f"{salida}.checkpoint"
+    desde, bytes_salida = 0, 0
+    if reanudar:
+        control = _leer_punto_control(ruta_control)
+        if control is not None:
+            if control.get("entrada") != os.path.abspath(entrada):
+                raise ValueError(f"El punto de control {ruta_control} corresponde a otra entrada: {control.get('entrada')}")
+            desde, bytes_salida = control["registros"], control["bytes_salida"]
+
+    if bytes_salida:
+        os.truncate(salida, bytes_salida)
+        fichero = open(salida, "a", encoding="utf-8", newline="")
+    else:
+        fichero = open(salida, "w", encoding="utf-8", newline="")
+
+    procesados = desde
+    escritos = 0
+    inicio = time.perf_counter()
+    pool = None
+    try:
+        escritor = csv.DictWriter(fichero, COLUMNAS_CSV) if formato_salida == "csv" else None
+        if escritor is not None and not bytes_salida:
+            escritor.writeheader()
+
+        # Solo viajan a los trabajadores los lotes compactos; los registros esperan aquí
+        # en el mismo orden en que vuelven los resultados
+        preparados = deque()
+
+        def compactos():
+            for lote in _lotes(leer_registros(entrada, formato_entrada, desde), tamano_lote):
+                lote_preparado, compacto = _preparar_lote(lote)
+                preparados.append(lote_preparado)
+                yield compacto
+
+        if procesos > 1:
+            opciones = {} if tareas_por_proceso is None else {"tareas_por_proceso": tareas_por_proceso}
+            pool = PoolProcesos(procesos, extractor=extractor, motor=motor, **opciones)
+            lotes_resueltos = pool.mapear(compactos())
+        else:
+            lotes_resueltos = (procesar_lote(compacto, extractor=extractor, almacen=almacen, motor=motor)
+                               for compacto in compactos())
+
+        pendientes_control = 0
+        for compactos_resueltos in lotes_resueltos:
+            resultados = list(_resultados(preparados.popleft(), compactos_resueltos))
+            for resultado in resultados:
+                if escritor is not None:
+                    escritor.writerow(_fila_csv(resultado))
+                else:
+                    fichero.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+            procesados += len(resultados)
+            escritos += len(resultados)
+            pendientes_control += len(resultados)
+            if pendientes_control >= cada:
+                pendientes_control = 0
+                if almacen is not None:
+                    almacen.guardar()
+                fichero.flush()
+                os.fsync(fichero.fileno())
+                _guardar_punto_control(ruta_control, {"entrada": os.path.abspath(entrada), "registros": procesados,
+                                                      "bytes_salida": fichero.tell()})
+                if progreso is not None:
+                    transcurrido = time.perf_counter() - inicio
+                    progreso(f"{procesados} registros ({escritos / transcurrido:.0f}/s)")
+        if almacen is not None:
+            almacen.guardar()
+        fichero.flush()
+        os.fsync(fichero.fileno())
+        _guardar_punto_control(ruta_control, {"entrada": os.path.abspath(entrada), "registros": procesados,
+                                              "bytes_salida": fichero.tell(), "completo": True})
+    finally:
+        fichero.close()
+        if pool is not None:
+            pool.cerrar()
+    return escritos
+
+
+def main(argumentos=None):
+    """Punto de entrada de la línea de órdenes (también vía `python -m sistema_experto`)"""
+    parser = argparse.ArgumentParser(prog="sistema_experto", description="Diagnóstico masivo de ficheros JSONL o CSV")
+    subparsers = parser.add_subparsers(dest="comando")
+    diagnose = subparsers.add_parser("diagnosticar", aliases=["diagnose"],
+                                     help="diagnostica cada registro (texto, edad, historial) de la entrada")
+    diagnose.add_argument("--entrada", "--input", required=True, help="fichero .jsonl o .csv ('-' para stdin)")
+    diagnose.add_argument("--salida", "--output", required=True, help="fichero .jsonl o .csv de resultados")
+    diagnose.add_argument("--formato-entrada", choices=["jsonl", "csv"])
+    diagnose.add_argument("--formato-salida", choices=["jsonl", "csv"])
+    diagnose.add_argument("--procesos", "--workers", type=int, default=1)
+    diagnose.add_argument("--tamano-lote", type=int, default=256)
+    diagnose.add_argument("--tareas-por-proceso", type=int, help="lotes por trabajador antes de reemplazarlo")
+    diagnose.add_argument("--extractor", choices=EXTRACTORES)
+    diagnose.add_argument("--motor", choices=MOTORES, help="motor de inferencia (por defecto, SISTEMA_EXPERTO_MOTOR)")
+    diagnose.add_argument("--reanudar", "--resume", action="store_true",
+                          help="continuar desde el punto de control de la salida")
+    diagnose.add_argument("--almacen", help="directorio del almacén de documentos analizados (evita repetir spaCy)")
+    diagnose.add_argument("--cada", type=int, default=10000, help="registros entre puntos de control")
+    args = parser.parse_args(argumentos)
+    if args.comando is None:
+        parser.print_help()
+        return 1
+
+    escritos = diagnosticar_fichero(
+        args.entrada, args.salida, args.formato_entrada, args.formato_salida, args.procesos, args.tamano_lote,
+        args.extractor, args.reanudar, args.cada, progreso=lambda mensaje: print(mensaje, file=sys.stderr),
+        tareas_por_proceso=args.tareas_por_proceso, almacen=args.almacen, motor=args.motor)
+    print(f"{escritos} registros diagnosticados", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+from collections import deque
+
+from base_conocimientos import GLOBAL_TRAZA, id_sintoma
+
+# Disparos que guarda la traza de una sesión; los más antiguos se descartan
+TAMANO_TRAZA = int(os.environ.get("SISTEMA_EXPERTO_TRAZA", "64"))
+
+
+class TrazaDisparos:
+    """
+    Buffer circular con los últimos `tamano` disparos de reglas de un entorno (con
+    `tamano` None los guarda todos).
+
+    Cada regla compilada añade al dispararse un registro compacto a la variable
+    global de traza de CLIPS ("nombre valor valor;", con el estado de cada síntoma
+    de su premisa y la edad si la usa): con los valores fijos de la regla bastan
+    para saber con qué hechos se disparó. recoger() pasa esos registros a este
+    buffer con una sola lectura por ejecución; el texto solo se genera al pedir
+    una Explicacion. `ultimos` guarda completos los disparos de la última
+    ejecución, aunque no quepan en el buffer.
+    """
+
+    __slots__ = ("_registros", "ultimos")
+
+    def __init__(self, tamano=TAMANO_TRAZA):
+        self._registros = deque(maxlen=tamano)
+        self.ultimos = ()
+
+    def recoger(self, env):
+        """Añade los disparos registrados en `env` desde la última llamada (o el último reset)"""
+        variable = env.find_global(GLOBAL_TRAZA)
+        texto = variable.value
+        self.ultimos = tuple(texto[:-1].split(";")) if texto else ()
+        if texto:
+            self._registros.extend(self.ultimos)
+            variable.value = ""
+
+    def __iter__(self):
+        return iter(self._registros)
+
+    def __len__(self):
+        return len(self._registros)
+
+    def reglas(self, registros=None):
+        """Nombres de las reglas disparadas (por defecto, las del buffer), en orden"""
+        return [registro.partition(" ")[0] for registro in (self._registros if registros is None else registros)]
+
+    def limpiar(self):
+        self._registros.clear()
+        self.ultimos = ()
+
+
+def _enumerar(partes):
+    if len(partes) <= 1:
+        return "".join(partes)
+    return ", ".join(partes[:-1]) + " y " + partes[-1]
+
+
+def _rango_edad(si):
+    if "edad_minima" in si and "edad_maxima" in si:
+        return f"entre {float(si['edad_minima']):g} y {float(si['edad_maxima']):g}"
+    if "edad_minima" in si:
+        return f"≥ {float(si['edad_minima']):g}"
+    return f"≤ {float(si['edad_maxima']):g}"
+
+
+class Explicacion:
+    """
+    Explicación de un diagnóstico a partir de los disparos de reglas que lo produjeron.
+
+    Solo guarda referencias a los registros de la traza: el texto se redacta la
+    primera vez que se convierte en cadena (str, f-string o JSON con default=str).
+    Sin registros de la enfermedad, describe lo que exigen las reglas que la concluyen.
+    Con `parcial` (regla, síntomas que faltan) explica una coincidencia parcial: qué
+    síntomas de la premisa de esa regla se cumplen y cuáles faltan.
+    """
+
+    __slots__ = ("_parcial", "_registros", "_reglas", "_texto", "_vigentes", "enfermedad")
+
+    def __init__(self, reglas, enfermedad, registros=(), vigentes=None, parcial=None):
+        self.enfermedad = enfermedad
+        self._reglas = reglas
+        self._registros = registros
+        self._vigentes = vigentes
+        self._parcial = parcial
+        self._texto = None
+
+    def __str__(self):
+        if self._texto is None:
+            self._texto = self._redactar()
+        return self._texto
+
+    def __repr__(self):
+        return f"Explicacion({self.enfermedad!r})"
+
+    def _conclusion(self, nombre, clave):
+        """Diagnóstico o riesgo (según `clave`) que concluye la regla `nombre`, o None"""
+        regla = self._reglas.get(nombre)
+        return regla.get("entonces", {}).get(clave) if regla is not None else None
+
+    def _concluye_enfermedad(self, nombre):
+        diagnostico = self._conclusion(nombre, "diagnostico")
+        return diagnostico is not None and diagnostico["enfermedad"] == self.enfermedad
+
+    def _redactar(self):
+        if self._parcial is not None:
+            return self._redactar_parcial(*self._parcial)
+        # Último disparo de cada regla que concluye la enfermedad, en orden de disparo
+        ultimos = {}
+        for registro in self._registros:
+            nombre, *valores = registro.split(" ")
+            if self._concluye_enfermedad(nombre) and (self._vigentes is None or nombre in self._vigentes):
+                ultimos.pop(nombre, None)
+                ultimos[nombre] = valores
+        if ultimos:
+            return " ".join(f"La regla {nombre} se disparó con {self._condiciones(nombre, valores)}."
+                            for nombre, valores in ultimos.items())
+        reglas = [nombre for nombre in self._reglas if self._concluye_enfermedad(nombre)]
+        if not reglas:
+            return "No hay explicación disponible para esta condición."
+        return " ".join(f"Se concluye con la regla {nombre} cuando hay {self._condiciones(nombre)}."
+                        for nombre in reglas)
+
+    def _redactar_parcial(self, nombre, faltantes):
+        sintomas = self._reglas[nombre].get("si", {}).get("sintomas", [])
+        presentes = [s for s in sintomas if id_sintoma(s) not in faltantes]
+        ausentes = [s for s in sintomas if id_sintoma(s) in faltantes]
+        return (f"Coincidencia parcial: la regla {nombre} no se disparó. Hay {_enumerar(presentes)}, "
+                f"pero falta {_enumerar(ausentes)}.")
+
+    def _condiciones(self, nombre, valores=None, visitadas=()):
+        """Condiciones de una regla; con `valores`, los que tenían al dispararse"""
+        si = self._reglas[nombre].get("si", {})
+        valores = iter(valores or ())
+        partes = []
+        for sintoma in si.get("sintomas", []):
+            estado = next(valores, None)
+            partes.append(f"{sintoma} ({estado})" if estado is not None else sintoma)
+        partes += [f"ausencia de {sintoma}" for sintoma in si.get("sintomas_negados", [])]
+        partes += [f"antecedente de {condicion}" for condicion in si.get("historial", [])]
+        if "edad_minima" in si or "edad_maxima" in si:
+            edad = next(valores, None)
+            partes.append(f"edad {float(edad):g} ({_rango_edad(si)})" if edad is not None
+                          else f"edad {_rango_edad(si)}")
+        for riesgo in si.get("riesgos", []):
+            texto = f"riesgo {riesgo['factor']} {riesgo['nivel']}"
+            causa = self._causa_riesgo(riesgo, visitadas + (nombre,))
+            partes.append(f"{texto} (de la regla {causa})" if causa else texto)
+        return _enumerar(partes)
+
+    def _causa_riesgo(self, riesgo, visitadas):
+        """Último disparo de una regla que concluyó `riesgo`, redactado, o None"""
+        for registro in reversed(self._registros):
+            nombre, *valores = registro.split(" ")
+            if nombre in visitadas:
+                continue
+            concluido = self._conclusion(nombre, "riesgo")
+            if concluido is not None and (concluido["factor"], concluido["nivel"]) == (riesgo["factor"], riesgo["nivel"]):
+                return f"{nombre}, con {self._condiciones(nombre, valores, visitadas)}"
+        return None
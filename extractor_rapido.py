@@ -0,0 +1,78 @@
+import re
+from array import array
+
+from base_conocimientos import plegar
+from contexto_clinico import calificar_id, estado_en, hay_disparadores
+
+# Palabras y signos de puntuación (los signos cortan el alcance de una negación)
+_PALABRA = re.compile(r"\w+|[^\w\s]")
+
+
+class TrieFrases:
+    """
+    Trie de frases (secuencias de palabras) con el síntoma canónico de cada una.
+    Como en Aho-Corasick se devuelven todas las coincidencias, también las anidadas,
+    con un coste lineal en el número de palabras por la longitud de la frase más
+    larga e independiente del número de frases.
+    """
+
+    def __init__(self, frases):
+        self.trie = {}
+        for palabras, canonico in frases:
+            nodo = self.trie
+            for palabra in palabras:
+                nodo = nodo.setdefault(palabra, {})
+            # La clave None marca el final de una frase
+            nodo[None] = canonico
+
+    def coincidencias(self, palabras):
+        """Genera (posición de la primera palabra, síntoma canónico) por cada frase presente"""
+        trie = self.trie
+        for inicio in range(len(palabras)):
+            nodo = trie.get(palabras[inicio])
+            siguiente = inicio + 1
+            while nodo is not None:
+                canonico = nodo.get(None)
+                if canonico is not None:
+                    yield inicio, canonico
+                if siguiente == len(palabras):
+                    break
+                nodo = nodo.get(palabras[siguiente])
+                siguiente += 1
+
+    def buscar(self, palabras):
+        """Devuelve el conjunto de síntomas canónicos de las frases presentes en `palabras`"""
+        return {canonico for _, canonico in self.coincidencias(palabras)}
+
+
+class ExtractorRapido(TrieFrases):
+    """
+    Extractor de síntomas sin spaCy: busca las frases del vocabulario de la base
+    (claves, sinónimos y términos de las reglas) en un trie de palabras.
+
+    El texto y las frases se pliegan (minúsculas, sin acentos), así que
+    "Congestión Nasal" y "congestion nasal" dan el mismo síntoma. También se
+    devuelven las coincidencias anidadas: "fiebre alta" produce fiebre_alta y
+    fiebre si ambas están en el vocabulario. El trie guarda el id de cada síntoma
+    en la TablaSimbolos `simbolos`, así que la búsqueda no crea cadenas. Los
+    síntomas negados, inciertos o pasados ("no tengo fiebre") se devuelven con
+    su estado, como "fiebre:negado".
+    """
+
+    def __init__(self, vocabulario, simbolos):
+        self.simbolos = simbolos
+        super().__init__((_PALABRA.findall(plegar(frase)), simbolos.internar(canonico))
+                         for frase, canonico in vocabulario.items())
+
+    def extraer_ids(self, texto):
+        """Devuelve el array de ids (ordenados) de los síntomas presentes en el texto"""
+        palabras = _PALABRA.findall(plegar(texto))
+        if not hay_disparadores(palabras):
+            return array(self.simbolos.tipo, sorted(self.buscar(palabras)))
+        simbolos = self.simbolos
+        return simbolos.array_ids(calificar_id(simbolos, id_simbolo, estado_en(palabras, inicio))
+                                  for inicio, id_simbolo in self.coincidencias(palabras))
+
+    def extraer(self, texto):
+        """Devuelve la lista de síntomas canónicos presentes en el texto"""
+        return self.simbolos.decodificar(self.extraer_ids(texto))
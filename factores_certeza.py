@@ -0,0 +1,143 @@
+from array import array
+
+from base_conocimientos import ESTADOS_ACTIVOS, id_sintoma, separar
+
+# Como en MYCIN, una premisa con certeza menor o igual que este umbral no aporta evidencia
+UMBRAL_PREMISA = 0.2
+
+# Una regla que no se disparó es una coincidencia parcial si la parte cumplida de su
+# premisa supera esta fracción (con 0.5, más de la mitad de sus síntomas)
+UMBRAL_PARCIAL = 0.5
+
+
+def combinar(cf1, cf2):
+    """Combina dos factores de certeza en [-1, 1] con la fórmula de MYCIN"""
+    if cf1 >= 0 and cf2 >= 0:
+        return cf1 + cf2 * (1 - cf1)
+    if cf1 < 0 and cf2 < 0:
+        return cf1 + cf2 * (1 + cf1)
+    divisor = 1 - min(abs(cf1), abs(cf2))
+    # Evidencia totalmente a favor y totalmente en contra: se anulan
+    return (cf1 + cf2) / divisor if divisor else 0.0
+
+
+class TablaCertezas:
+    """
+    Índices numéricos de las reglas de diagnóstico de una base, construidos una vez.
+
+    Cada enfermedad tiene un id entero; la combinación de evidencias de una llamada
+    se hace en un array de doubles indexado por ese id, sin dicts por llamada.
+    Solo las reglas disparadas aportan evidencia; las coincidencias parciales se
+    piden aparte con parciales().
+    """
+
+    __slots__ = ("enfermedades", "ids", "recomendaciones", "reglas", "reglas_parciales")
+
+    def __init__(self, base):
+        self.enfermedades = []
+        self.recomendaciones = []
+        self.ids = {}
+        # nombre de regla -> (id de la enfermedad, síntomas de la premisa)
+        self.reglas = {}
+        # (nombre de regla, id de la enfermedad, síntomas, cf) de las que admiten coincidencia parcial
+        self.reglas_parciales = []
+        for regla in base.definiciones:
+            diagnostico = regla.get("entonces", {}).get("diagnostico")
+            if diagnostico is None:
+                continue
+            enfermedad = diagnostico["enfermedad"]
+            id_enfermedad = self.ids.get(enfermedad)
+            if id_enfermedad is None:
+                id_enfermedad = self.ids[enfermedad] = len(self.enfermedades)
+                self.enfermedades.append(enfermedad)
+                self.recomendaciones.append(diagnostico["recomendacion"])
+            si = regla.get("si", {})
+            sintomas = tuple(id_sintoma(s) for s in si.get("sintomas", []))
+            self.reglas[regla["nombre"]] = (id_enfermedad, sintomas)
+            if len(sintomas) > 1 and si.keys() == {"sintomas"}:
+                self.reglas_parciales.append((regla["nombre"], id_enfermedad, sintomas, diagnostico["certeza"] / 100))
+
+    def contribuciones(self, env, certezas_sintomas=None):
+        """
+        Genera (id de enfermedad, factor de certeza) por cada hecho diagnostico de `env`.
+        Con `certezas_sintomas` (síntoma -> certeza en [0, 1]) la evidencia de cada
+        regla se pondera por la menor certeza de los síntomas de su premisa.
+        """
+        for fact in env.find_template("diagnostico").facts():
+            regla = self.reglas.get(str(fact["regla"]))
+            if regla is None:
+                # Diagnóstico insertado fuera de las reglas de la base
+                id_enfermedad = self.ids.get(fact["enfermedad"])
+                if id_enfermedad is not None:
+                    yield id_enfermedad, fact["certeza"] / 100
+                continue
+            cf = self._ponderar(regla[1], fact["certeza"] / 100, certezas_sintomas)
+            if cf is not None:
+                yield regla[0], cf
+
+    def contribuciones_reglas(self, disparadas, certezas_sintomas=None):
+        """Como contribuciones, a partir de pares (nombre de regla, certeza 0-100) ya evaluados"""
+        for nombre, certeza in disparadas:
+            id_enfermedad, sintomas = self.reglas[nombre]
+            cf = self._ponderar(sintomas, certeza / 100, certezas_sintomas)
+            if cf is not None:
+                yield id_enfermedad, cf
+
+    def parciales(self, sintomas, disparadas=(), certezas_sintomas=None):
+        """
+        Coincidencias parciales de un paciente con los nombres calificados `sintomas`:
+        reglas que solo piden síntomas (dos o más), que no están en `disparadas` y de
+        cuya premisa el paciente cumple más de UMBRAL_PARCIAL. Un síntoma de la premisa
+        negado o pasado descarta la regla. Devuelve, una por enfermedad (la de más
+        certeza) y de mayor a menor, tuplas (enfermedad, certeza 0-100, recomendacion,
+        regla, faltantes): la certeza de la regla por la fracción cumplida (ponderada
+        por `certezas_sintomas`). Las enfermedades ya diagnosticadas no se repiten.
+        """
+        activos, excluidos = set(), set()
+        for canonico, estado in map(separar, sintomas):
+            (activos if estado in ESTADOS_ACTIVOS else excluidos).add(canonico)
+        excluidos -= activos
+        certezas_sintomas = certezas_sintomas or {}
+        diagnosticadas = {self.reglas[nombre][0] for nombre in disparadas if nombre in self.reglas}
+        mejores = {}
+        for nombre, id_enfermedad, premisa, cf in self.reglas_parciales:
+            if nombre in disparadas or id_enfermedad in diagnosticadas or not excluidos.isdisjoint(premisa):
+                continue
+            cumplida = sum(certezas_sintomas.get(s, 1.0) for s in premisa if s in activos) / len(premisa)
+            if not UMBRAL_PARCIAL < cumplida < 1:
+                continue
+            certeza = round(cf * cumplida * 100)
+            if id_enfermedad not in mejores or certeza > mejores[id_enfermedad][1]:
+                mejores[id_enfermedad] = (self.enfermedades[id_enfermedad], certeza, self.recomendaciones[id_enfermedad],
+                                          nombre, [s for s in premisa if s not in activos])
+        return sorted(mejores.values(), key=lambda parcial: (-parcial[1], parcial[0]))
+
+    @staticmethod
+    def _ponderar(sintomas, cf, certezas_sintomas):
+        """Pondera cf por la menor certeza de los síntomas de la premisa (None si no llega al umbral)"""
+        if certezas_sintomas and sintomas:
+            premisa = min(certezas_sintomas.get(s, 1.0) for s in sintomas)
+            if premisa <= UMBRAL_PREMISA:
+                return None
+            cf *= premisa
+        return cf
+
+    def agregar(self, contribuciones):
+        """
+        Combina en una pasada las contribuciones (id, cf) y devuelve la lista de
+        (enfermedad, certeza 0-100, recomendacion) sin repetidos, de mayor a menor
+        certeza. Las enfermedades con certeza combinada nula o negativa se descartan.
+        """
+        certezas = array("d", bytes(8 * len(self.enfermedades)))
+        vistas = bytearray(len(self.enfermedades))
+        tocadas = []
+        for id_enfermedad, cf in contribuciones:
+            if vistas[id_enfermedad]:
+                certezas[id_enfermedad] = combinar(certezas[id_enfermedad], cf)
+            else:
+                vistas[id_enfermedad] = 1
+                certezas[id_enfermedad] = cf
+                tocadas.append(id_enfermedad)
+        tocadas.sort(key=lambda i: (-certezas[i], self.enfermedades[i]))
+        return [(self.enfermedades[i], round(certezas[i] * 100), self.recomendaciones[i])
+                for i in tocadas if certezas[i] > 0]
@@ -0,0 +1,122 @@
+import bisect
+import json
+import logging
+import os
+import threading
+
+# Se activa con activar() o con la variable de entorno SISTEMA_EXPERTO_METRICAS=1.
+# Desactivada, cada etapa instrumentada solo comprueba este indicador.
+activa = False
+
+# Tupla que activar() y desactivar() sustituyen entera: registrar() la recorre sin copiarla
+_sumideros = ()
+
+# Límites (segundos) de los buckets de los histogramas de duración
+LIMITES_SEGUNDOS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+PREFIJO = "sistema_experto"
+
+
+class HistogramaMemoria:
+    """
+    Sumidero que acumula en memoria un histograma de duración por etapa y el total
+    de cada contador (tokens, hechos, reglas disparadas...). Seguro entre hilos.
+    """
+
+    def __init__(self, limites=LIMITES_SEGUNDOS):
+        self.limites = tuple(limites)
+        self._candado = threading.Lock()
+        self._etapas = {}
+
+    def registrar(self, etapa, segundos, contadores):
+        with self._candado:
+            datos = self._etapas.get(etapa)
+            if datos is None:
+                datos = self._etapas[etapa] = {"buckets": [0] * (len(self.limites) + 1), "suma": 0.0,
+                                               "cuenta": 0, "contadores": {}}
+            datos["buckets"][bisect.bisect_left(self.limites, segundos)] += 1
+            datos["suma"] += segundos
+            datos["cuenta"] += 1
+            for nombre, valor in contadores.items():
+                datos["contadores"][nombre] = datos["contadores"].get(nombre, 0) + valor
+
+    def limpiar(self):
+        with self._candado:
+            self._etapas.clear()
+
+    def resumen(self):
+        """Dict etapa -> cuenta, segundos totales, media en ms y totales de los contadores"""
+        with self._candado:
+            return {etapa: {"cuenta": datos["cuenta"], "segundos": datos["suma"],
+                            "media_ms": datos["suma"] / datos["cuenta"] * 1000, **datos["contadores"]}
+                    for etapa, datos in self._etapas.items()}
+
+    def prometheus(self):
+        """Volcado en el formato de texto de Prometheus"""
+        with self._candado:
+            etapas = sorted(self._etapas.items())
+            nombre = f"{PREFIJO}_etapa_segundos"
+            lineas = [f"# HELP {nombre} Duración de cada etapa del diagnóstico", f"# TYPE {nombre} histogram"]
+            for etapa, datos in etapas:
+                acumulado = 0
+                for limite, cuenta in zip(self.limites + ("+Inf",), datos["buckets"]):
+                    acumulado += cuenta
+                    lineas.append(f'{nombre}_bucket{{etapa="{etapa}",le="{limite}"}} {acumulado}')
+                lineas.append(f'{nombre}_sum{{etapa="{etapa}"}} {datos["suma"]!r}')
+                lineas.append(f'{nombre}_count{{etapa="{etapa}"}} {datos["cuenta"]}')
+
+            contadores = sorted({c for _, datos in etapas for c in datos["contadores"]})
+            for contador in contadores:
+                nombre = f"{PREFIJO}_{contador}_total"
+                lineas.append(f"# TYPE {nombre} counter")
+                for etapa, datos in etapas:
+                    if contador in datos["contadores"]:
+                        lineas.append(f'{nombre}{{etapa="{etapa}"}} {datos["contadores"][contador]}')
+        return "\n".join(lineas) + "\n"
+
+    def volcar_prometheus(self, ruta):
+        """Escribe el volcado de Prometheus de forma atómica (para el textfile collector)"""
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "w", encoding="utf-8") as fichero:
+            fichero.write(self.prometheus())
+        os.replace(temporal, ruta)
+
+
+class SumideroLog:
+    """Sumidero que escribe cada medición como una línea JSON en un logger"""
+
+    def __init__(self, logger=None, nivel=logging.INFO):
+        self.logger = logger or logging.getLogger(f"{PREFIJO}.metricas")
+        self.nivel = nivel
+
+    def registrar(self, etapa, segundos, contadores):
+        if self.logger.isEnabledFor(self.nivel):
+            self.logger.log(self.nivel, "%s", json.dumps({"etapa": etapa, "ms": round(segundos * 1000, 4), **contadores}))
+
+
+# Sumidero por defecto cuando se activa sin indicar ninguno
+histograma = HistogramaMemoria()
+
+
+def activar(*sumideros):
+    """Activa la instrumentación enviando las mediciones a `sumideros` (por defecto, `histograma`)"""
+    global activa, _sumideros
+    _sumideros = tuple(sumideros) or (histograma,)
+    activa = True
+
+
+def desactivar():
+    """Desactiva la instrumentación y descarta los sumideros"""
+    global activa, _sumideros
+    activa = False
+    _sumideros = ()
+
+
+def registrar(etapa, segundos, **contadores):
+    """Envía una medición a todos los sumideros activos"""
+    for sumidero in _sumideros:
+        sumidero.registrar(etapa, segundos, contadores)
+
+
+if os.environ.get("SISTEMA_EXPERTO_METRICAS", "0") == "1":
+    activar()
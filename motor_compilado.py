@@ -0,0 +1,136 @@
+from base_conocimientos import (
+    CONDICIONES,
+    INCIERTO,
+    NEGADO,
+    PRESENTE,
+    calificar,
+    id_sintoma,
+    separar,
+)
+
+
+class ReglaNoCompilable(ValueError):
+    """La base contiene reglas que el motor compilado no puede evaluar (se usa CLIPS)"""
+
+
+class _Regla:
+    __slots__ = ("certeza", "edad_maxima", "edad_minima", "nombre", "requisitos", "riesgo")
+
+    def __init__(self, nombre, requisitos, edad_minima, edad_maxima, riesgo, certeza):
+        self.nombre = nombre
+        self.requisitos = requisitos
+        self.edad_minima = edad_minima
+        self.edad_maxima = edad_maxima
+        self.riesgo = riesgo
+        self.certeza = certeza
+
+
+class MotorCompilado:
+    """
+    Evalúa en Python las reglas conjuntivas de la base, sin entorno CLIPS.
+
+    Cada síntoma, condición del historial y factor de riesgo ocupa un bit (los de
+    los síntomas, en una lista indexada por su id en base.simbolos; un síntoma
+    incierto activa el mismo bit que el presente y uno negado, otro distinto); los
+    requisitos de cada regla son una máscara y comprobar la regla es un AND de
+    enteros, más las pruebas de edad. Las reglas que concluyen un riesgo se ordenan
+    topológicamente antes de las que lo exigen, de modo que una sola pasada resuelve
+    cadenas como evaluar_riesgo_edad -> recomendaciones_prevencion. Si las reglas de
+    riesgo forman un ciclo, o usan condiciones desconocidas, se lanza
+    ReglaNoCompilable y el diagnóstico sigue en CLIPS.
+    """
+
+    def __init__(self, base):
+        self._simbolos = base.simbolos
+        self._bits_sintoma = {}
+        self._bits_historial = {}
+        self._bits_riesgo = {}
+        self._siguiente_bit = 0
+        self.reglas = self._ordenar([self._compilar(regla) for regla in base.definiciones])
+        self._bits_por_id = [0] * len(self._simbolos)
+        for sintoma, bit in self._bits_sintoma.items():
+            self._bits_por_id[self._simbolos.buscar(sintoma)] |= bit
+            if separar(sintoma)[1] == PRESENTE:
+                self._bits_por_id[self._simbolos.buscar(calificar(sintoma, INCIERTO))] |= bit
+
+    def _bit(self, tabla, clave):
+        bit = tabla.get(clave)
+        if bit is None:
+            bit = tabla[clave] = 1 << self._siguiente_bit
+            self._siguiente_bit += 1
+        return bit
+
+    def _compilar(self, regla):
+        nombre = regla.get("nombre", "")
+        si = regla.get("si", {})
+        if set(si) - CONDICIONES:
+            raise ReglaNoCompilable(f"Condiciones no soportadas en {nombre}")
+        requisitos = 0
+        for sintoma in si.get("sintomas", []):
+            requisitos |= self._bit(self._bits_sintoma, id_sintoma(sintoma))
+        for sintoma in si.get("sintomas_negados", []):
+            requisitos |= self._bit(self._bits_sintoma, calificar(id_sintoma(sintoma), NEGADO))
+        for condicion in si.get("historial", []):
+            requisitos |= self._bit(self._bits_historial, id_sintoma(condicion))
+        for riesgo in si.get("riesgos", []):
+            requisitos |= self._bit(self._bits_riesgo, (riesgo["factor"], riesgo["nivel"]))
+        edad_minima = float(si["edad_minima"]) if "edad_minima" in si else None
+        edad_maxima = float(si["edad_maxima"]) if "edad_maxima" in si else None
+
+        entonces = regla.get("entonces", {})
+        if "diagnostico" in entonces:
+            return _Regla(nombre, requisitos, edad_minima, edad_maxima, 0, int(entonces["diagnostico"]["certeza"]))
+        if "riesgo" in entonces:
+            riesgo = entonces["riesgo"]
+            return _Regla(nombre, requisitos, edad_minima, edad_maxima,
+                          self._bit(self._bits_riesgo, (riesgo["factor"], riesgo["nivel"])), None)
+        raise ReglaNoCompilable(f"Conclusión no soportada en {nombre}")
+
+    @staticmethod
+    def _ordenar(reglas):
+        """Orden topológico: las reglas que producen un riesgo van antes que las que lo exigen"""
+        pendientes = list(reglas)
+        ordenadas = []
+        while pendientes:
+            # Una regla está lista cuando ya no queda pendiente ningún productor de sus riesgos
+            por_producir = 0
+            for regla in pendientes:
+                por_producir |= regla.riesgo
+            listas = [regla for regla in pendientes if not regla.requisitos & por_producir]
+            if not listas:
+                raise ReglaNoCompilable("Las reglas de riesgo forman un ciclo")
+            ordenadas.extend(listas)
+            colocadas = {id(regla) for regla in listas}
+            pendientes = [regla for regla in pendientes if id(regla) not in colocadas]
+        return ordenadas
+
+    def evaluar(self, ids, edad, historial):
+        """
+        Devuelve los pares (nombre de regla, certeza) de las reglas de diagnóstico que
+        se cumplen. `ids` son los ids de los síntomas del paciente en base.simbolos.
+        """
+        edad = edad if isinstance(edad, (int, float)) else int(edad)
+        mascara = 0
+        bits = self._bits_por_id
+        # Los ids añadidos después de compilar no aparecen en ninguna regla
+        conocidos = len(bits)
+        for id_simbolo in ids:
+            if id_simbolo < conocidos:
+                mascara |= bits[id_simbolo]
+        bits = self._bits_historial
+        for condicion in historial:
+            mascara |= bits.get(id_sintoma(condicion), 0)
+
+        disparadas = []
+        for regla in self.reglas:
+            if mascara & regla.requisitos != regla.requisitos:
+                continue
+            if regla.edad_minima is not None and not edad >= regla.edad_minima:
+                continue
+            if regla.edad_maxima is not None and not edad <= regla.edad_maxima:
+                continue
+            if regla.riesgo:
+                mascara |= regla.riesgo
+            else:
+                disparadas.append((regla.nombre, regla.certeza))
+        return disparadas
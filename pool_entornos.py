@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+class EnvironmentPool:
+    """
+    Pool de entornos CLIPS con templates y reglas ya cargados.
+
+    Cada diagnóstico toma prestado un entorno en exclusiva, de modo que varias
+    peticiones pueden ejecutarse en paralelo sin compartir la memoria de trabajo.
+    Los entornos se construyen todos al crear el pool con la función `fabrica`.
+    """
+
+    def __init__(self, fabrica, tamano=4):
+        if tamano < 1:
+            raise ValueError("El pool necesita al menos un entorno")
+        self.tamano = tamano
+        self._libres = queue.LifoQueue()
+        for _ in range(tamano):
+            self._libres.put(fabrica())
+
+        self._candado = threading.Lock()
+        self._creado = time.perf_counter()
+        self._prestamos = 0
+        self._en_uso = 0
+        self._espera_total = 0.0
+        self._espera_maxima = 0.0
+        self._ocupado_total = 0.0
+
+    @contextmanager
+    def prestar(self, timeout=None):
+        """
+        Presta un entorno durante el bloque `with` y lo devuelve al terminar.
+        Si no hay entornos libres espera hasta `timeout` segundos (queue.Empty si se agota).
+        """
+        inicio = time.perf_counter()
+        env = self._libres.get(timeout=timeout)
+        prestado = time.perf_counter()
+        espera = prestado - inicio
+        with self._candado:
+            self._prestamos += 1
+            self._en_uso += 1
+            self._espera_total += espera
+            self._espera_maxima = max(self._espera_maxima, espera)
+        try:
+            yield env
+        finally:
+            ocupado = time.perf_counter() - prestado
+            with self._candado:
+                self._en_uso -= 1
+                self._ocupado_total += ocupado
+            self._libres.put(env)
+
+    def metricas(self):
+        """Devuelve un dict con las métricas de uso acumuladas del pool"""
+        with self._candado:
+            transcurrido = time.perf_counter() - self._creado
+            prestamos = self._prestamos
+            return {
+                "tamano": self.tamano,
+                "en_uso": self._en_uso,
+                "prestamos": prestamos,
+                "prestamos_por_segundo": prestamos / transcurrido if transcurrido else 0.0,
+                "espera_media": self._espera_total / prestamos if prestamos else 0.0,
+                "espera_maxima": self._espera_maxima,
+                "utilizacion": self._ocupado_total / (self.tamano * transcurrido) if transcurrido else 0.0,
+            }
@@ -0,0 +1,128 @@
+import gc
+import multiprocessing
+import os
+from collections import deque
+from itertools import islice
+
+from sistema_experto import (
+    _inferir,
+    _recursos,
+    _variante,
+    crear_entorno,
+    extraer_ids_lote,
+    obtener_base,
+    obtener_extractor_rapido,
+    obtener_motor_compilado,
+)
+
+# Lotes que atiende cada proceso antes de reemplazarlo, para acotar el crecimiento de memoria
+TAREAS_POR_PROCESO = int(os.environ.get("SISTEMA_EXPERTO_TAREAS_POR_PROCESO", "1000"))
+
+# Estado de cada proceso trabajador, creado por _iniciar_trabajador
+_entorno = None
+_opciones = (None, None, None)
+
+
+def procesar_lote(lote, ligero=None, extractor=None, env=None, almacen=None, motor=None):
+    """
+    Diagnostica un lote compacto de tuplas (texto, edad, historial) ya validadas, con
+    el historial como lista de cadenas (ver diagnostico_masivo._validar_registro).
+    Los textos se procesan con una sola llamada a nlp.pipe. Devuelve, por paciente, una tupla
+    (sintomas, diagnosticos) con los síntomas ordenados y las tuplas de _inferir.
+    Sin `env` se usan el pool de entornos y la cache de diagnósticos del proceso; con
+    motor="compilado" (si la base se puede compilar) no se usa CLIPS.
+    Con un AlmacenDocumentos en `almacen` solo se analizan los textos que no están en él.
+    """
+    textos = [texto for texto, _, _ in lote]
+    simbolos = obtener_base().simbolos
+    if almacen is not None:
+        from almacen_documentos import extraer_sintomas_almacen
+
+        ids_lote = [simbolos.codificar(sintomas)
+                    for sintomas in extraer_sintomas_almacen(textos, almacen, max(1, len(lote)))]
+    else:
+        ids_lote = extraer_ids_lote(textos, max(1, len(lote)), ligero, extractor)
+    if motor == "compilado" and obtener_motor_compilado() is not None:
+        env = None
+    # Los ids solo valen dentro de este proceso: se devuelven los nombres
+    return [(tuple(sorted(simbolos.decodificar(ids))), tuple(_inferir(ids, edad, historial, env, motor)))
+            for ids, (_, edad, historial) in zip(ids_lote, lote)]
+
+
+def _iniciar_trabajador(ligero, extractor, motor):
+    """Se ejecuta una vez en cada proceso: solo falta el entorno CLIPS, el modelo viene del padre"""
+    global _entorno, _opciones
+    _entorno = crear_entorno()
+    _opciones = (ligero, extractor, motor)
+
+
+def _procesar_en_trabajador(lote):
+    ligero, extractor, motor = _opciones
+    return procesar_lote(lote, ligero, extractor, _entorno, motor=motor)
+
+
+class PoolProcesos:
+    """
+    Pool de procesos precargados para repartir el diagnóstico entre núcleos.
+
+    spaCy y CLIPS retienen el GIL casi todo el tiempo, así que los hilos no escalan.
+    El modelo de spaCy (o el extractor rápido) y la base se cargan en el proceso padre
+    antes de crear los trabajadores con fork: los procesos hijos comparten esas
+    páginas de memoria (copy-on-write) y solo construyen su entorno CLIPS. gc.freeze()
+    evita que el recolector de basura de los hijos toque y copie esos objetos; dura
+    mientras viva el pool (los trabajadores reemplazados también se crean con fork) y
+    se deshace al cerrarlo.
+    Cada trabajador se reemplaza tras `tareas_por_proceso` lotes.
+    """
+
+    def __init__(self, procesos=None, tareas_por_proceso=TAREAS_POR_PROCESO, ligero=None, extractor=None, motor=None):
+        self.procesos = procesos or os.cpu_count() or 1
+        if _variante(ligero, extractor) == "rapido":
+            obtener_extractor_rapido()
+        else:
+            _recursos(ligero)
+        if motor == "compilado":
+            obtener_motor_compilado()
+        gc.collect()
+        gc.freeze()
+        metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        self._pool = multiprocessing.get_context(metodo).Pool(
+            self.procesos, _iniciar_trabajador, (ligero, extractor, motor), maxtasksperchild=tareas_por_proceso)
+
+    def mapear(self, lotes, en_vuelo=None):
+        """
+        Envía cada lote compacto de (texto, edad, historial) a los trabajadores y genera
+        sus resultados en orden. Como mucho hay `en_vuelo` lotes en curso (por defecto
+        dos por proceso), así la entrada se consume al ritmo al que se procesa.
+        """
+        en_vuelo = en_vuelo or 2 * self.procesos
+        en_curso = deque()
+        for lote in lotes:
+            en_curso.append(self._pool.apply_async(_procesar_en_trabajador, (lote,)))
+            if len(en_curso) >= en_vuelo:
+                yield en_curso.popleft().get()
+        while en_curso:
+            yield en_curso.popleft().get()
+
+    def diagnosticar_lote(self, pacientes, tamano_lote=64):
+        """Genera (sintomas, diagnosticos) para cada paciente (texto, edad, historial), en orden"""
+        iterador = iter(pacientes)
+        lotes = iter(lambda: list(islice(iterador, tamano_lote)), [])
+        for resultados in self.mapear(lotes):
+            yield from resultados
+
+    def cerrar(self):
+        """Espera a que terminen los lotes enviados y detiene los trabajadores"""
+        self._pool.close()
+        self._pool.join()
+        gc.unfreeze()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.cerrar()
+        else:
+            self._pool.terminate()
+            gc.unfreeze()
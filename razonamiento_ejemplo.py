@@ -1,38 +1,62 @@
-import clips
-import spacy
+import logging
+import time
+
+import auditoria
+import instrumentacion
+from base_conocimientos import ESTADOS_ACTIVOS, separar
+from contexto_clinico import certezas_sintomas
+from explicaciones import Explicacion, TrazaDisparos
 
 # Load existing environment setup
-from sistema_experto import env, extraer_sintomas, normalizar_sintomas, sinonimos_sintomas
+from sistema_experto import (
+    cargar_paciente,
+    ejecutar_reglas,
+    extraer_sintomas,
+    obtener_base,
+    obtener_pool,
+    recoger_diagnosticos,
+    recoger_parciales,
+)
+
+logger = logging.getLogger(__name__)
+
+def _sintomas_activos(env, sintomas):
+    """
+    Síntomas presentes o inciertos (canónicos) de la lista `sintomas` si se indica,
+    o si no de los hechos de `env`; sin ninguno de los dos, ninguno
+    """
+    if sintomas is not None:
+        return {canonico for canonico, estado in map(separar, sintomas) if estado in ESTADOS_ACTIVOS}
+    if env is None:
+        return set()
+    return {str(fact["nombre"]) for fact in env.find_template("sintoma").facts() if fact["estado"] in ESTADOS_ACTIVOS}
 
 # Add backward chaining capability
-def backward_chaining(enfermedad_objetivo):
+def backward_chaining(enfermedad_objetivo, env=None, sintomas=None):
     """
     Implementa razonamiento hacia atrás para verificar si una enfermedad específica
-    puede ser diagnosticada con base en los síntomas actuales.
+    puede ser diagnosticada con base en los síntomas actuales del entorno `env`, o
+    en la lista `sintomas` (nombres como los de extraer_sintomas) si se indica. Los
+    diagnósticos usan entornos del pool, así que para consultar a un paciente ya
+    diagnosticado hay que pasar sus síntomas o su entorno (como evaluar_paciente o
+    SesionDiagnostico.analizar).
     """
-    # Obtener reglas que concluyen la enfermedad objetivo
-    requisitos_sintomas = {
-        "COVID19": ["fiebre_alta", "tos_seca", "dificultad_para_respirar"],
-        "Gripe": ["fiebre", "dolor_muscular", "congestion_nasal"],
-        "Riesgo_alto_enfermedades_respiratorias": []  # Este depende de factores de riesgo, no síntomas
-    }
+    # Alternativas de síntomas de las reglas que concluyen la enfermedad objetivo
+    # (vacía si depende de factores de riesgo y no de síntomas)
+    alternativas = obtener_base().requisitos.get(enfermedad_objetivo)
     
-    if enfermedad_objetivo not in requisitos_sintomas:
+    if alternativas is None:
         return {
             "posible": False,
             "mensaje": "Enfermedad no reconocida en la base de conocimientos",
             "sintomas_faltantes": []
         }
     
-    # Obtener síntomas actuales en los hechos
-    sintomas_actuales = []
-    for fact in env.facts():
-        if fact.template.name == "sintoma":
-            sintomas_actuales.append(fact["nombre"])
+    # Obtener síntomas actuales (los negados o pasados no cuentan)
+    sintomas_actuales = _sintomas_activos(env, sintomas)
     
-    # Comprobar si todos los síntomas necesarios están presentes
-    sintomas_requeridos = requisitos_sintomas[enfermedad_objetivo]
-    sintomas_faltantes = [s for s in sintomas_requeridos if s not in sintomas_actuales]
+    # Comprobar si todos los síntomas necesarios están presentes en alguna alternativa
+    sintomas_faltantes = min(([s for s in requeridos if s not in sintomas_actuales] for requeridos in alternativas), key=len)
     
     return {
         "posible": len(sintomas_faltantes) == 0,
@@ -40,62 +64,122 @@ def backward_chaining(enfermedad_objetivo):
         "sintomas_faltantes": sintomas_faltantes
     }
 
-def explicar_diagnostico(enfermedad):
+def backward_chaining_todas(env=None, k=5, sintomas=None):
     """
-    Explica cómo se llegó a un diagnóstico específico, mostrando las reglas involucradas.
+    Razonamiento hacia atrás sobre todas las enfermedades a la vez: devuelve las k
+    hipótesis que mejor cubren los síntomas actuales del entorno `env` o de la lista
+    `sintomas` (como en backward_chaining), con sus síntomas faltantes (ver
+    razonamiento_vectorial).
     """
-    explicaciones = {
-        "COVID19": "El diagnóstico de COVID-19 se basa en la presencia de fiebre alta, tos seca, y dificultad para respirar.",
-        "Gripe": "El diagnóstico de gripe se basa en la presencia de fiebre, dolor muscular, y congestión nasal.",
-        "Riesgo_alto_enfermedades_respiratorias": "Este aviso se genera cuando hay un factor de riesgo alto, como la edad avanzada."
-    }
+    from razonamiento_vectorial import ordenar_diagnosticos
+
+    return ordenar_diagnosticos(_sintomas_activos(env, sintomas), k)
+
+def explicar_diagnostico(enfermedad, traza=(), vigentes=None, parcial=None):
+    """
+    Explica cómo se llegó a un diagnóstico específico, mostrando las reglas involucradas
+    y los hechos con los que se dispararon según `traza` (registros de una
+    TrazaDisparos). Si se indica, solo cuentan las reglas de `vigentes`. Con
+    `parcial` (regla, faltantes) explica una coincidencia parcial. El texto se
+    genera al convertir en cadena la Explicacion devuelta (al imprimirla o al
+    serializar el resultado con default=str).
+    """
+    return Explicacion(obtener_base().reglas_por_nombre, enfermedad, tuple(traza), vigentes, parcial)
+
+def evaluar_paciente(sintomas, edad, historial, enfermedad_objetivo=None, env=None, texto=None, parciales=False):
+    """
+    Núcleo de diagnosticar_completo sin salida por pantalla: carga los hechos, hace el
+    análisis hacia atrás de `enfermedad_objetivo` (si se indica) y ejecuta las reglas.
+    Devuelve un dict con sintomas, analisis (o None) y diagnosticos; las explicaciones
+    salen de la traza de disparos de esta llamada y se redactan solo al convertirlas
+    en cadena (ver explicar_diagnostico). Con parciales=True añade
+    "parciales": las coincidencias parciales (recoger_parciales), marcadas con
+    "parcial" y fuera de la lista de diagnósticos. Con la auditoría activa el
+    resultado se encola para el registro (`texto` forma parte del hash).
+    """
+    if env is None:
+        with obtener_pool().prestar() as prestado:
+            return evaluar_paciente(sintomas, edad, historial, enfermedad_objetivo, prestado, texto, parciales)
+
+    cargar_paciente(env, sintomas, edad, historial)
     
-    return explicaciones.get(enfermedad, "No hay explicación disponible para esta condición.")
+    # Si hay una enfermedad objetivo, usar encadenamiento hacia atrás primero
+    analisis = None
+    if enfermedad_objetivo:
+        analisis = backward_chaining(enfermedad_objetivo, env)
+    
+    # Ejecutar motor de inferencia (encadenamiento hacia adelante); la traza de una
+    # sola ejecución se guarda entera
+    traza = TrazaDisparos(None)
+    ejecutar_reglas(env, traza=traza)
+    registros = tuple(traza)
+    if analisis is not None:
+        analisis["explicacion"] = explicar_diagnostico(enfermedad_objetivo, registros) if analisis["posible"] else None
+    
+    # Volcado de la memoria de trabajo solo si el nivel DEBUG está activo
+    if logger.isEnabledFor(logging.DEBUG):
+        for fact in env.facts():
+            logger.debug("%s", fact)
+    
+    # Recopilar diagnósticos generados (uno por enfermedad, de mayor a menor certeza)
+    inicio = time.perf_counter() if instrumentacion.activa else None
+    certezas = certezas_sintomas(sintomas)
+    diagnosticos = []
+    for enfermedad, certeza, recomendacion in recoger_diagnosticos(env, certezas):
+        diagnosticos.append({
+            "enfermedad": enfermedad, 
+            "certeza": certeza, 
+            "recomendacion": recomendacion,
+            "explicacion": explicar_diagnostico(enfermedad, registros)
+        })
+    if inicio is not None:
+        instrumentacion.registrar("recoleccion", time.perf_counter() - inicio, diagnosticos=len(diagnosticos))
 
-# Ejemplo de uso combinado de encadenamiento hacia adelante y hacia atrás
-def diagnosticar_completo(texto, edad, historial, enfermedad_objetivo=None):
-    """Integra encadenamiento hacia adelante y hacia atrás"""
-    env.reset()
+    if auditoria.activa:
+        auditoria.registrar(texto, edad, historial, sintomas, traza.reglas(), diagnosticos)
     
+    resultado = {"sintomas": list(sintomas), "analisis": analisis, "diagnosticos": diagnosticos}
+    if parciales:
+        resultado["parciales"] = [{
+            "enfermedad": enfermedad,
+            "certeza": certeza,
+            "recomendacion": recomendacion,
+            "parcial": True,
+            "faltantes": faltantes,
+            "explicacion": explicar_diagnostico(enfermedad, parcial=(regla, faltantes))
+        } for enfermedad, certeza, recomendacion, regla, faltantes in recoger_parciales(env, certezas)]
+    return resultado
+
+# Ejemplo de uso combinado de encadenamiento hacia adelante y hacia atrás
+def diagnosticar_completo(texto, edad, historial, enfermedad_objetivo=None, env=None):
+    """
+    Integra encadenamiento hacia adelante y hacia atrás.
+    Sin `env` se toma prestado un entorno del pool, por lo que admite llamadas concurrentes.
+    Como también muestra el resultado, devuelve las explicaciones ya redactadas.
+    """
+    inicio = time.perf_counter() if instrumentacion.activa else None
     # Procesar texto para extraer síntomas (encadenamiento hacia adelante)
     sintomas = extraer_sintomas(texto)
     print(f"\nSíntomas detectados: {sintomas}")
     
-    for sintoma in sintomas:
-        env.assert_string(f'(sintoma (nombre {sintoma}))')
-    
-    env.assert_string(f'(edad (valor {edad}))')
+    resultado = evaluar_paciente(sintomas, edad, historial, enfermedad_objetivo, env, texto)
     
-    for condicion in historial:
-        env.assert_string(f'(historial (condicion {condicion.replace(" ", "_")}))')
-    
-    # Si hay una enfermedad objetivo, usar encadenamiento hacia atrás primero
-    if enfermedad_objetivo:
-        resultado_backward = backward_chaining(enfermedad_objetivo)
-        if resultado_backward["posible"]:
-            print(f"\nAnálisis específico para {enfermedad_objetivo}:")
-            print(f"✓ {resultado_backward['mensaje']}")
-            print(f"✓ {explicar_diagnostico(enfermedad_objetivo)}")
+    analisis = resultado["analisis"]
+    if analisis is not None:
+        print(f"\nAnálisis específico para {enfermedad_objetivo}:")
+        if analisis["posible"]:
+            print(f"✓ {analisis['mensaje']}")
+            print(f"✓ {analisis['explicacion']}")
         else:
-            print(f"\nAnálisis específico para {enfermedad_objetivo}:")
-            print(f"✗ {resultado_backward['mensaje']}")
-            if resultado_backward['sintomas_faltantes']:
-                print(f"Síntomas faltantes: {', '.join(resultado_backward['sintomas_faltantes'])}")
-    
-    # Ejecutar motor de inferencia (encadenamiento hacia adelante)
-    env.run()
-    
-    # Recopilar diagnósticos generados
-    diagnosticos = []
-    for fact in env.facts():
-        if fact.template.name == "diagnostico":
-            diagnosticos.append({
-                "enfermedad": fact["enfermedad"], 
-                "certeza": fact["certeza"], 
-                "recomendacion": fact["recomendacion"],
-                "explicacion": explicar_diagnostico(fact["enfermedad"])
-            })
+            print(f"✗ {analisis['mensaje']}")
+            if analisis['sintomas_faltantes']:
+                print(f"Síntomas faltantes: {', '.join(analisis['sintomas_faltantes'])}")
     
+    diagnosticos = [dict(diagnostico, explicacion=str(diagnostico["explicacion"]))
+                    for diagnostico in resultado["diagnosticos"]]
+    # La diferencia con la suma de las etapas es el coste del código Python intermedio
+    if inicio is not None:
+        instrumentacion.registrar("diagnostico_completo", time.perf_counter() - inicio)
     return diagnosticos
 
 # Demo de uso
@@ -0,0 +1,111 @@
+from collections import Counter
+
+import numpy as np
+
+from base_conocimientos import RecursoPorHuella
+from sistema_experto import obtener_base
+
+
+class MatrizRequisitos:
+    """
+    Representación matricial de los requisitos de síntomas de la base.
+
+    Cada fila es una regla que concluye un diagnóstico y cada columna un síntoma del
+    vocabulario de las reglas. Las reglas que no exigen síntomas (las que dependen
+    solo de factores de riesgo) no se incluyen, porque no se pueden ordenar por cobertura.
+    """
+
+    def __init__(self, base):
+        filas = [(enfermedad, requeridos)
+                 for enfermedad, alternativas in base.requisitos.items()
+                 for requeridos in alternativas if requeridos]
+        self.sintomas = sorted({s for _, requeridos in filas for s in requeridos})
+        self.columnas = {sintoma: i for i, sintoma in enumerate(self.sintomas)}
+        self.enfermedades = [enfermedad for enfermedad, _ in filas]
+
+        self.requisitos = np.zeros((len(filas), len(self.sintomas)), dtype=np.float32)
+        for fila, (_, requeridos) in enumerate(filas):
+            for sintoma in requeridos:
+                self.requisitos[fila, self.columnas[sintoma]] = 1.0
+        self.totales = self.requisitos.sum(axis=1)
+
+        # Columnas requeridas por regla, para listar los faltantes sin recorrer la matriz
+        self.columnas_regla = [sorted(self.columnas[s] for s in requeridos) for _, requeridos in filas]
+        # Peor caso de filas a revisar para obtener k enfermedades distintas
+        self.max_alternativas = max(Counter(self.enfermedades).values(), default=1)
+
+    def codificar(self, pacientes):
+        """Convierte una lista de conjuntos de síntomas en una matriz paciente x síntoma"""
+        matriz = np.zeros((len(pacientes), len(self.sintomas)), dtype=np.float32)
+        for fila, sintomas in enumerate(pacientes):
+            for sintoma in sintomas:
+                columna = self.columnas.get(sintoma)
+                if columna is not None:
+                    matriz[fila, columna] = 1.0
+        return matriz
+
+    def ordenar(self, pacientes, k=5):
+        """
+        Devuelve, para cada paciente, los k diagnósticos más cercanos como lista de dicts
+        con enfermedad, cobertura (0-1), posible y sintomas_faltantes.
+        Todas las reglas se evalúan a la vez con un producto de matrices.
+        """
+        if not self.enfermedades:
+            return [[] for _ in pacientes]
+        presentes = self.codificar(pacientes)
+        aciertos = presentes @ self.requisitos.T
+        faltan = self.totales - aciertos
+        cobertura = aciertos / self.totales
+        # Mayor cobertura primero; a igual cobertura, menos síntomas faltantes.
+        # Solo se conservan las filas necesarias para reunir k enfermedades distintas.
+        limite = min(len(self.enfermedades), k * self.max_alternativas)
+        orden = np.lexsort((faltan, -cobertura), axis=-1)[:, :limite]
+        coberturas = np.take_along_axis(cobertura, orden, axis=1).tolist()
+
+        resultados = []
+        for p, filas in enumerate(orden.tolist()):
+            columnas_presentes = {self.columnas[s] for s in pacientes[p] if s in self.columnas}
+            vistos = set()
+            ranking = []
+            for fila, cobertura_fila in zip(filas, coberturas[p]):
+                enfermedad = self.enfermedades[fila]
+                if enfermedad in vistos:
+                    continue
+                vistos.add(enfermedad)
+                ausentes = [self.sintomas[c] for c in self.columnas_regla[fila] if c not in columnas_presentes]
+                ranking.append({
+                    "enfermedad": enfermedad,
+                    "cobertura": cobertura_fila,
+                    "posible": not ausentes,
+                    "sintomas_faltantes": ausentes,
+                })
+                if len(ranking) == k:
+                    break
+            resultados.append(ranking)
+        return resultados
+
+
+# Matriz de la última base usada; al recargar la base se sustituye
+_matriz = RecursoPorHuella(MatrizRequisitos)
+
+
+def obtener_matriz(base=None):
+    """Devuelve la MatrizRequisitos de la base (la actual por defecto), construyéndola una vez"""
+    return _matriz.obtener(obtener_base() if base is None else base)
+
+
+def ordenar_diagnosticos(sintomas, k=5):
+    """Ordena todas las enfermedades de la base según cuánto cubren los síntomas de un paciente"""
+    return obtener_matriz().ordenar([sintomas], k)[0]
+
+
+def ordenar_diagnosticos_lote(pacientes, k=5, tamano_bloque=4096):
+    """
+    Igual que ordenar_diagnosticos para una lista de pacientes (cada uno un conjunto de
+    síntomas). Se procesa por bloques para acotar la memoria de las matrices.
+    """
+    matriz = obtener_matriz()
+    resultados = []
+    for inicio in range(0, len(pacientes), tamano_bloque):
+        resultados.extend(matriz.ordenar(pacientes[inicio:inicio + tamano_bloque], k))
+    return resultados
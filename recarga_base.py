@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from base_conocimientos import NEGADO, RUTA_BASE, calificar, cargar_base, id_sintoma
+from contexto_clinico import certezas_sintomas
+from extractor_rapido import ExtractorRapido
+from factores_certeza import TablaCertezas
+from sistema_experto import (
+    _motor_de_base,
+    cargar_paciente,
+    ejecutar_reglas,
+    obtener_base,
+    recargar_base,
+)
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre dos comprobaciones del fichero de la base
+INTERVALO = float(os.environ.get("SISTEMA_EXPERTO_RECARGA_INTERVALO", "1.0"))
+
+# Fichero JSONL con casos de humo adicionales: {"texto" o "sintomas", "edad", "historial", "enfermedades"}
+CASOS_HUMO = os.environ.get("SISTEMA_EXPERTO_CASOS_HUMO")
+
+_vigilante = None
+
+
+class BaseNoValida(ValueError):
+    """La base recargada no supera los casos de humo: se sigue con la anterior"""
+
+
+def casos_de_reglas(base):
+    """
+    Un caso por regla de diagnóstico de `base` que no depende de riesgos: un paciente
+    que cumple sus condiciones y del que se espera la enfermedad de la regla.
+    """
+    casos = []
+    for regla in base.definiciones:
+        diagnostico = regla.get("entonces", {}).get("diagnostico")
+        si = regla.get("si", {})
+        if diagnostico is None or "riesgos" in si:
+            continue
+        sintomas = [id_sintoma(s) for s in si.get("sintomas", [])]
+        sintomas += [calificar(id_sintoma(s), NEGADO) for s in si.get("sintomas_negados", [])]
+        casos.append({
+            "nombre": regla["nombre"],
+            "sintomas": sintomas,
+            "edad": si.get("edad_minima", si.get("edad_maxima", 40)),
+            "historial": list(si.get("historial", [])),
+            "enfermedades": [diagnostico["enfermedad"]],
+        })
+    return casos
+
+
+def cargar_casos(ruta):
+    """Lee un fichero JSONL de casos de humo"""
+    with open(ruta, encoding="utf-8") as fichero:
+        return [json.loads(linea) for linea in fichero if linea.strip()]
+
+
+def validar_base(base, casos=None):
+    """
+    Comprueba una base antes de ponerla en servicio: construye un entorno CLIPS y
+    diagnostica los casos de humo (por defecto, casos_de_reglas más los de
+    CASOS_HUMO). Cada caso debe dar al menos sus `enfermedades`, y si la base se
+    puede compilar, el motor compilado debe coincidir con CLIPS. Lanza BaseNoValida
+    con todos los fallos.
+    """
+    if casos is None:
+        casos = casos_de_reglas(base) + (cargar_casos(CASOS_HUMO) if CASOS_HUMO else [])
+    env = base.crear_entorno()
+    tabla = TablaCertezas(base)
+    motor = _motor_de_base(base)
+    extractor = None
+    fallos = []
+    for i, caso in enumerate(casos):
+        nombre = caso.get("nombre", f"caso {i + 1}")
+        sintomas = caso.get("sintomas")
+        if sintomas is None:
+            extractor = extractor or ExtractorRapido(base.vocabulario, base.simbolos)
+            sintomas = extractor.extraer(caso["texto"])
+        edad, historial = caso.get("edad", 40), caso.get("historial", [])
+        certezas = certezas_sintomas(sintomas)
+        cargar_paciente(env, sintomas, edad, historial)
+        ejecutar_reglas(env)
+        diagnosticos = tabla.agregar(tabla.contribuciones(env, certezas))
+        faltan = set(caso.get("enfermedades", [])).difference(d[0] for d in diagnosticos)
+        if faltan:
+            fallos.append(f"{nombre}: no se diagnostica {', '.join(sorted(faltan))}")
+        if motor is not None:
+            disparadas = motor.evaluar(base.simbolos.codificar(sintomas), edad, historial)
+            if tabla.agregar(tabla.contribuciones_reglas(disparadas, certezas)) != diagnosticos:
+                fallos.append(f"{nombre}: el motor compilado no coincide con CLIPS")
+    if fallos:
+        raise BaseNoValida("; ".join(fallos))
+
+
+def recargar(ruta=RUTA_BASE, casos=None):
+    """
+    Lee la base de `ruta`, la valida y, si ha cambiado, la pone en servicio con
+    recargar_base(preparar=True). Todo se hace en el hilo que llama: el servicio
+    sigue atendiendo con la base anterior hasta el cambio. Devuelve la nueva base,
+    o None si el contenido no cambió.
+    """
+    actual = obtener_base()
+    base = cargar_base(ruta, anterior=actual)
+    if base.huella == actual.huella:
+        return None
+    validar_base(base, casos)
+    recargar_base(base, preparar=True)
+    return base
+
+
+class VigilanteBase:
+    """
+    Hilo que vigila el fichero de la base de conocimientos y la recarga al cambiar.
+
+    Cada `intervalo` segundos compara la fecha de modificación y el tamaño del
+    fichero; tras un cambio espera a que dejen de variar durante un intervalo (un
+    editor puede escribirlo en varios pasos) y llama a recargar(). Si el fichero no
+    se puede leer o compilar, o la base no supera los casos de humo, se registra el
+    error y se sigue con la base anterior.
+    """
+
+    def __init__(self, ruta=RUTA_BASE, intervalo=INTERVALO, casos=None):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.casos = casos
+        self.recargas = 0
+        self.rechazadas = 0
+        self.ultimo_error = None
+        self._detener = threading.Event()
+        self._estado = self._leer_estado()
+        self._hilo = threading.Thread(target=self._bucle, name="recarga_base", daemon=True)
+        self._hilo.start()
+
+    def _leer_estado(self):
+        try:
+            estado = os.stat(self.ruta)
+        except OSError:
+            return None
+        return estado.st_mtime_ns, estado.st_size
+
+    def _bucle(self):
+        while not self._detener.wait(self.intervalo):
+            estado = self._leer_estado()
+            if estado is None or estado == self._estado:
+                continue
+            # Se espera a que el fichero deje de cambiar
+            while not self._detener.wait(self.intervalo):
+                siguiente = self._leer_estado()
+                if siguiente == estado:
+                    break
+                estado = siguiente
+            if self._detener.is_set():
+                break
+            self._estado = estado
+            self._recargar()
+
+    def _recargar(self):
+        inicio = time.perf_counter()
+        try:
+            base = recargar(self.ruta, self.casos)
+        except Exception as e:
+            self.rechazadas += 1
+            self.ultimo_error = str(e)
+            logger.exception("No se recargó la base de conocimientos %s", self.ruta)
+            return
+        if base is not None:
+            self.recargas += 1
+            self.ultimo_error = None
+            logger.info("Base de conocimientos %s recargada en %.3f s", base.huella, time.perf_counter() - inicio)
+
+    def detener(self):
+        """Detiene el hilo vigilante (una recarga en curso termina antes)"""
+        self._detener.set()
+        self._hilo.join()
+
+    def metricas(self):
+        """Devuelve un dict con la huella de la base en servicio y los contadores de recargas"""
+        return {
+            "huella": obtener_base().huella,
+            "recargas": self.recargas,
+            "rechazadas": self.rechazadas,
+            "ultimo_error": self.ultimo_error,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detener()
+
+
+def activar(ruta=RUTA_BASE, **opciones):
+    """Empieza a vigilar `ruta` (ver VigilanteBase para las opciones)"""
+    global _vigilante
+    desactivar()
+    _vigilante = VigilanteBase(ruta, **opciones)
+    return _vigilante
+
+
+def desactivar():
+    """Deja de vigilar el fichero de la base"""
+    global _vigilante
+    vigilante, _vigilante = _vigilante, None
+    if vigilante is not None:
+        vigilante.detener()
+
+
+def metricas():
+    """Contadores del vigilante activo, o None si no se vigila la base"""
+    vigilante = _vigilante
+    return vigilante.metricas() if vigilante is not None else None
+
+
+def _tras_fork():
+    """El hilo vigilante no sobrevive a un fork: los procesos hijos no recargan"""
+    global _vigilante
+    _vigilante = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_tras_fork)
+
+if os.environ.get("SISTEMA_EXPERTO_RECARGA") == "1":
+    activar()
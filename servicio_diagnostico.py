@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import auditoria
+import recarga_base
+from razonamiento_ejemplo import evaluar_paciente
+from sistema_experto import (
+    TAMANO_POOL,
+    cache_diagnosticos,
+    cache_sintomas,
+    extraer_sintomas_lote,
+    obtener_nlp,
+    obtener_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo del cuerpo de una petición (bytes)
+MAX_CUERPO = 1024 * 1024
+
+MOTIVOS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class SolicitudInvalida(ValueError):
+    """El cuerpo de la petición no tiene el formato esperado"""
+
+
+class ServicioSaturado(RuntimeError):
+    """Hay demasiadas peticiones pendientes (backpressure)"""
+
+
+class ServicioDetenido(ServicioSaturado):
+    """El servicio se detuvo antes de atender la petición (también se responde con 503)"""
+
+
+class ServicioNoIniciado(ServicioSaturado):
+    """Llega una petición antes de iniciar() el servicio (también se responde con 503)"""
+
+
+def validar_solicitud(datos):
+    """Comprueba y normaliza el JSON {texto, edad, historial, enfermedad_objetivo}"""
+    if not isinstance(datos, dict):
+        raise SolicitudInvalida("Se esperaba un objeto JSON")
+    texto = datos.get("texto")
+    if not isinstance(texto, str) or not texto.strip():
+        raise SolicitudInvalida("'texto' debe ser una cadena no vacía")
+    edad = datos.get("edad")
+    if isinstance(edad, bool) or not isinstance(edad, (int, float)):
+        raise SolicitudInvalida("'edad' debe ser un número")
+    historial = datos.get("historial", [])
+    if not isinstance(historial, list) or not all(isinstance(c, str) for c in historial):
+        raise SolicitudInvalida("'historial' debe ser una lista de cadenas")
+    objetivo = datos.get("enfermedad_objetivo")
+    if objetivo is not None and not isinstance(objetivo, str):
+        raise SolicitudInvalida("'enfermedad_objetivo' debe ser una cadena")
+    return {"texto": texto, "edad": edad, "historial": historial, "enfermedad_objetivo": objetivo or None}
+
+
+class ServicioDiagnostico:
+    """
+    Servicio asíncrono de diagnóstico con agrupación de peticiones.
+
+    Las peticiones concurrentes se acumulan durante `espera_lote` segundos (o hasta
+    `tamano_lote`) y sus textos se procesan con una sola llamada a nlp.pipe; la
+    inferencia de cada paciente se reparte entre `hilos` hilos que usan el pool de
+    entornos CLIPS. Con más de `max_pendientes` peticiones en curso se rechazan las
+    nuevas con ServicioSaturado.
+    """
+
+    def __init__(self, tamano_lote=32, espera_lote=0.005, max_pendientes=1000, hilos=None):
+        self.tamano_lote = tamano_lote
+        self.espera_lote = espera_lote
+        self.max_pendientes = max_pendientes
+        self.pendientes = 0
+        self.listo = False
+        self._hilos = hilos or TAMANO_POOL
+        self._detenido = False
+        self._cola = None
+        self._tarea = None
+        self._lotes = set()
+        self._ejecutor_nlp = None
+        self._ejecutor_inferencia = None
+
+    async def iniciar(self):
+        """Arranca el agrupador y precarga el modelo y los entornos en segundo plano"""
+        loop = asyncio.get_running_loop()
+        self._cola = asyncio.Queue()
+        # spaCy procesa cada lote en un único hilo; la inferencia se reparte entre varios
+        self._ejecutor_nlp = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nlp")
+        self._ejecutor_inferencia = ThreadPoolExecutor(max_workers=self._hilos, thread_name_prefix="clips")
+        self._tarea = asyncio.create_task(self._agrupar())
+        await loop.run_in_executor(self._ejecutor_nlp, obtener_nlp)
+        await loop.run_in_executor(self._ejecutor_inferencia, obtener_pool)
+        self.listo = True
+
+    async def detener(self):
+        """
+        Detiene el agrupador, espera los lotes en curso y libera los hilos. Las
+        peticiones que aún no estaban en un lote terminan con ServicioDetenido.
+        """
+        self.listo = False
+        self._detenido = True
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+        while self._cola is not None and not self._cola.empty():
+            _, futuro = self._cola.get_nowait()
+            self._rechazar(futuro)
+        if self._lotes:
+            await asyncio.gather(*self._lotes, return_exceptions=True)
+        for ejecutor in (self._ejecutor_nlp, self._ejecutor_inferencia):
+            if ejecutor is not None:
+                ejecutor.shutdown(wait=True)
+        # Los diagnósticos ya respondidos quedan en el registro de auditoría
+        await asyncio.get_running_loop().run_in_executor(None, auditoria.vaciar)
+
+    async def diagnosticar(self, solicitud):
+        """Encola una solicitud ya validada y espera su resultado"""
+        if self._detenido:
+            raise ServicioDetenido("El servicio se está deteniendo")
+        if self._cola is None:
+            raise ServicioNoIniciado("El servicio aún no se ha iniciado")
+        if self.pendientes >= self.max_pendientes:
+            raise ServicioSaturado("Demasiadas peticiones pendientes")
+        self.pendientes += 1
+        try:
+            futuro = asyncio.get_running_loop().create_future()
+            self._cola.put_nowait((solicitud, futuro))
+            return await futuro
+        finally:
+            self.pendientes -= 1
+
+    @staticmethod
+    def _rechazar(futuro):
+        if not futuro.done():
+            futuro.set_exception(ServicioDetenido("El servicio se detuvo antes de atender la petición"))
+
+    async def _agrupar(self):
+        """Forma lotes con las peticiones que llegan dentro de la ventana de espera"""
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = [await self._cola.get()]
+            limite = loop.time() + self.espera_lote
+            try:
+                while len(lote) < self.tamano_lote:
+                    restante = limite - loop.time()
+                    if restante <= 0:
+                        break
+                    try:
+                        lote.append(await asyncio.wait_for(self._cola.get(), restante))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # El lote a medio formar no llegará a resolverse
+                for _, futuro in lote:
+                    self._rechazar(futuro)
+                raise
+            tarea = asyncio.create_task(self._resolver(lote))
+            self._lotes.add(tarea)
+            tarea.add_done_callback(self._lotes.discard)
+
+    async def _resolver(self, lote):
+        """Procesa un lote: un nlp.pipe para todos los textos y una inferencia por paciente"""
+        loop = asyncio.get_running_loop()
+        try:
+            textos = [solicitud["texto"] for solicitud, _ in lote]
+            sintomas_lote = await loop.run_in_executor(
+                self._ejecutor_nlp, extraer_sintomas_lote, textos, self.tamano_lote)
+            resultados = await asyncio.gather(*(
+                loop.run_in_executor(self._ejecutor_inferencia, evaluar_paciente, sintomas,
+                                     solicitud["edad"], solicitud["historial"], solicitud["enfermedad_objetivo"],
+                                     None, solicitud["texto"])
+                for (solicitud, _), sintomas in zip(lote, sintomas_lote)), return_exceptions=True)
+        except Exception as e:
+            resultados = [e] * len(lote)
+        for (_, futuro), resultado in zip(lote, resultados):
+            if futuro.done():
+                continue
+            if isinstance(resultado, Exception):
+                futuro.set_exception(resultado)
+            else:
+                futuro.set_result(resultado)
+
+    def salud(self):
+        """Estado del servicio para el balanceador de carga"""
+        return {
+            "estado": "ok" if self.listo else "iniciando",
+            "pendientes": self.pendientes,
+            "max_pendientes": self.max_pendientes,
+            "pool": obtener_pool().metricas() if self.listo else None,
+            "cache_sintomas": cache_sintomas.metricas(),
+            "cache_diagnosticos": cache_diagnosticos.metricas(),
+            "auditoria": auditoria.metricas(),
+            "recarga_base": recarga_base.metricas(),
+        }
+
+    async def atender(self, metodo, ruta, cuerpo):
+        """Resuelve una petición y devuelve (código HTTP, dict con la respuesta)"""
+        if ruta == "/salud":
+            if metodo != "GET":
+                return 405, {"error": "Método no permitido"}
+            return (200 if self.listo else 503), self.salud()
+        if ruta != "/diagnostico":
+            return 404, {"error": "Ruta no encontrada"}
+        if metodo != "POST":
+            return 405, {"error": "Método no permitido"}
+        try:
+            solicitud = validar_solicitud(json.loads(cuerpo or b"null"))
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        try:
+            return 200, await self.diagnosticar(solicitud)
+        except ServicioSaturado as e:
+            return 503, {"error": str(e)}
+        except Exception:
+            logger.exception("Error al diagnosticar")
+            return 500, {"error": "Error interno en el diagnóstico"}
+
+
+class ClienteEnProceso:
+    """Cliente para pruebas locales: llama al servicio directamente, sin sockets"""
+
+    def __init__(self, servicio):
+        self.servicio = servicio
+
+    async def get(self, ruta):
+        return await self.servicio.atender("GET", ruta, b"")
+
+    async def post(self, ruta, datos):
+        return await self.servicio.atender("POST", ruta, json.dumps(datos).encode("utf-8"))
+
+
+async def _responder(escritor, estado, respuesta, cerrar):
+    """Escribe una respuesta HTTP/1.1 con el cuerpo JSON `respuesta`"""
+    # Las explicaciones de los diagnósticos se redactan aquí, al serializarlas
+    datos = json.dumps(respuesta, ensure_ascii=False, default=str).encode("utf-8")
+    extra = "Retry-After: 1\r\n" if estado == 503 else ""
+    escritor.write((f"HTTP/1.1 {estado} {MOTIVOS.get(estado, '')}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(datos)}\r\n{extra}"
+                    f"Connection: {'close' if cerrar else 'keep-alive'}\r\n\r\n").encode("latin-1") + datos)
+    await escritor.drain()
+
+
+async def _atender_conexion(servicio, lector, escritor):
+    """Atiende una conexión HTTP/1.1 (con keep-alive) y delega cada petición en el servicio"""
+    try:
+        while True:
+            linea = await lector.readline()
+            if not linea:
+                break
+            try:
+                metodo, ruta, version = linea.decode("latin-1").split()
+            except ValueError:
+                await _responder(escritor, 400, {"error": "Línea de petición no válida"}, cerrar=True)
+                break
+            cabeceras = {}
+            while True:
+                cabecera = await lector.readline()
+                if cabecera in (b"\r\n", b"\n", b""):
+                    break
+                nombre, _, valor = cabecera.decode("latin-1").partition(":")
+                cabeceras[nombre.strip().lower()] = valor.strip()
+
+            try:
+                longitud = int(cabeceras.get("content-length") or 0)
+            except ValueError:
+                longitud = -1
+            if longitud < 0:
+                estado, respuesta = 400, {"error": "Content-Length no válido"}
+                cabeceras["connection"] = "close"
+            elif longitud > MAX_CUERPO:
+                estado, respuesta = 413, {"error": "Cuerpo demasiado grande"}
+                cabeceras["connection"] = "close"
+            else:
+                cuerpo = await lector.readexactly(longitud) if longitud else b""
+                estado, respuesta = await servicio.atender(metodo, ruta.split("?", 1)[0], cuerpo)
+
+            cerrar = cabeceras.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+            await _responder(escritor, estado, respuesta, cerrar)
+            if cerrar:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        escritor.close()
+
+
+async def servir(host="127.0.0.1", puerto=8080, **opciones):
+    """Arranca el servicio HTTP y atiende peticiones hasta que se cancele"""
+    servicio = ServicioDiagnostico(**opciones)
+    servidor = await asyncio.start_server(lambda r, w: _atender_conexion(servicio, r, w), host, puerto)
+    await servicio.iniciar()
+    logger.info("Servicio de diagnóstico escuchando en %s:%s", host, puerto)
+    try:
+        async with servidor:
+            await servidor.serve_forever()
+    finally:
+        await servicio.detener()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servicio HTTP de diagnóstico")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--tamano-lote", type=int, default=32)
+    parser.add_argument("--espera-lote", type=float, default=0.005, help="segundos")
+    parser.add_argument("--max-pendientes", type=int, default=1000)
+    parser.add_argument("--hilos", type=int, default=None)
+    parser.add_argument("--auditoria", help="registro de auditoría (.jsonl, o .db para SQLite)")
+    parser.add_argument("--auditoria-fsync", choices=auditoria.POLITICAS_FSYNC, default=auditoria.FSYNC)
+    parser.add_argument("--recargar", action="store_true",
+                        help="vigilar el fichero de la base y recargarlo al cambiar, sin reiniciar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.auditoria:
+        auditoria.activar(args.auditoria, fsync=args.auditoria_fsync)
+    if args.recargar:
+        recarga_base.activar()
+    try:
+        asyncio.run(servir(args.host, args.puerto, tamano_lote=args.tamano_lote, espera_lote=args.espera_lote,
+                           max_pendientes=args.max_pendientes, hilos=args.hilos))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+import os
+import time
+
+import clips
+
+import instrumentacion
+from base_conocimientos import id_sintoma, separar
+from contexto_clinico import certezas_sintomas
+from explicaciones import TrazaDisparos
+from razonamiento_ejemplo import backward_chaining, explicar_diagnostico
+from sistema_experto import (
+    crear_entorno,
+    ejecutar_reglas,
+    extraer_sintomas,
+    recoger_diagnosticos,
+    recoger_parciales,
+)
+
+# Máximo de reglas disparadas por turno si no se indica otro límite
+LIMITE_REGLAS = int(os.environ.get("SISTEMA_EXPERTO_LIMITE_REGLAS", "10000"))
+
+
+class SesionDiagnostico:
+    """
+    Diagnóstico interactivo que conserva la memoria de trabajo entre turnos.
+
+    En cada cambio solo se insertan o retiran los hechos que han variado, de modo que
+    la red Rete de CLIPS hace trabajo incremental en vez de repetir reset y carga.
+    Las reglas se compilan con (logical ...), así que al retirar un síntoma se retiran
+    también los diagnósticos que dependían de él. Cada sesión tiene su propio entorno
+    y no debe usarse desde varios hilos a la vez. Los últimos disparos de reglas se
+    guardan en `traza` para explicar los diagnósticos.
+    """
+
+    def __init__(self, edad=None, historial=(), env=None):
+        self.env = env if env is not None else crear_entorno()
+        self.env.reset()
+        self._plantilla_sintoma = self.env.find_template("sintoma")
+        self._plantilla_edad = self.env.find_template("edad")
+        self._plantilla_historial = self.env.find_template("historial")
+        self._sintomas = {}
+        self._historial = {}
+        self._edad = None
+        self.edad = None
+        # True si la última ejecución agotó el límite con reglas aún pendientes
+        self.agotado = False
+        self.traza = TrazaDisparos()
+        self.actualizar(edad=edad, historial=historial)
+
+    @property
+    def sintomas(self):
+        return sorted(self._sintomas)
+
+    @property
+    def historial(self):
+        return sorted(self._historial)
+
+    def actualizar(self, sintomas=None, edad=None, historial=None):
+        """
+        Hace que la memoria de trabajo refleje los valores indicados (los que se dejan
+        en None no cambian). Devuelve el número de hechos insertados o retirados.
+        """
+        inicio = time.perf_counter() if instrumentacion.activa else None
+        cambios = 0
+        if sintomas is not None:
+            cambios += self._sincronizar(self._sintomas, set(sintomas), self._insertar_sintoma)
+        if historial is not None:
+            cambios += self._sincronizar(self._historial, {id_sintoma(c) for c in historial},
+                                         self._insertar_condicion)
+        if edad is not None:
+            edad = edad if isinstance(edad, (int, float)) else int(edad)
+            if edad != self.edad:
+                if self._edad is not None:
+                    self._edad.retract()
+                    cambios += 1
+                self._edad = self._plantilla_edad.assert_fact(valor=edad)
+                self.edad = edad
+                cambios += 1
+        if inicio is not None:
+            instrumentacion.registrar("sesion_cambios", time.perf_counter() - inicio, hechos=cambios)
+        return cambios
+
+    def _insertar_sintoma(self, sintoma):
+        nombre, estado = separar(sintoma)
+        return self._plantilla_sintoma.assert_fact(nombre=clips.Symbol(nombre), estado=clips.Symbol(estado))
+
+    def _insertar_condicion(self, condicion):
+        return self._plantilla_historial.assert_fact(condicion=clips.Symbol(condicion))
+
+    @staticmethod
+    def _sincronizar(actuales, deseados, insertar):
+        """Retira los hechos que sobran e inserta los que faltan; devuelve cuántos cambió"""
+        sobrantes = [valor for valor in actuales if valor not in deseados]
+        for valor in sobrantes:
+            actuales.pop(valor).retract()
+        nuevos = sorted(deseados.difference(actuales))
+        for valor in nuevos:
+            actuales[valor] = insertar(valor)
+        return len(sobrantes) + len(nuevos)
+
+    def agregar_sintomas(self, *sintomas):
+        return self.actualizar(sintomas=self._sintomas.keys() | set(sintomas))
+
+    def quitar_sintomas(self, *sintomas):
+        return self.actualizar(sintomas=self._sintomas.keys() - set(sintomas))
+
+    def agregar_texto(self, texto):
+        """Extrae los síntomas de un texto nuevo (solo ese fragmento) y los añade a la sesión"""
+        return self.agregar_sintomas(*extraer_sintomas(texto))
+
+    def run(self, limite=LIMITE_REGLAS):
+        """
+        Ejecuta las reglas activadas por los cambios, como máximo `limite` disparos,
+        para que una base de reglas desbocada no bloquee la petición. Devuelve las
+        reglas disparadas; `agotado` indica si quedaron activaciones en la agenda.
+        """
+        disparadas = ejecutar_reglas(self.env, limite, self.traza)
+        self.agotado = limite is not None and next(iter(self.env.activations()), None) is not None
+        return disparadas
+
+    def diagnosticos(self):
+        """
+        Diagnósticos presentes ahora en la memoria de trabajo, como dicts ordenados por
+        certeza. Las explicaciones usan los disparos de las reglas cuyo diagnóstico
+        sigue en la memoria (los retirados por (logical ...) no cuentan).
+        """
+        registros = tuple(self.traza)
+        vigentes = {str(fact["regla"]) for fact in self.env.find_template("diagnostico").facts()}
+        return [{"enfermedad": enfermedad, "certeza": certeza, "recomendacion": recomendacion,
+                 "explicacion": explicar_diagnostico(enfermedad, registros, vigentes)}
+                for enfermedad, certeza, recomendacion in recoger_diagnosticos(self.env, certezas_sintomas(self._sintomas))]
+
+    def parciales(self):
+        """
+        Coincidencias parciales con los síntomas actuales (ver recoger_parciales), como
+        dicts marcados con "parcial"; no forman parte de diagnosticos().
+        """
+        return [{"enfermedad": enfermedad, "certeza": certeza, "recomendacion": recomendacion, "parcial": True,
+                 "faltantes": faltantes, "explicacion": explicar_diagnostico(enfermedad, parcial=(regla, faltantes))}
+                for enfermedad, certeza, recomendacion, regla, faltantes
+                in recoger_parciales(self.env, certezas_sintomas(self._sintomas))]
+
+    def analizar(self, enfermedad_objetivo):
+        """Encadenamiento hacia atrás sobre los síntomas actuales de la sesión"""
+        return backward_chaining(enfermedad_objetivo, self.env)
+
+    def reiniciar(self):
+        """Vacía la sesión (memoria de trabajo incluida)"""
+        self.env.reset()
+        self._sintomas.clear()
+        self._historial.clear()
+        self._edad = None
+        self.edad = None
+        self.agotado = False
+        self.traza.limpiar()
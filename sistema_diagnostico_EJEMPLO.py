@@ -1,209 +1,22 @@
-import clips
-import spacy
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import ttk, scrolledtext
 
+import auditoria
+
 ###########################################
 # PARTE 1: SISTEMA EXPERTO BASE (CLIPS)
 ###########################################
 
-# Cargar modelo de spaCy en español
-nlp = spacy.load("es_core_news_sm")
-
-# Inicializar entorno CLIPS
-env = clips.Environment()
-
-# Diccionario de sinónimos para mejorar el reconocimiento de síntomas
-sinonimos_sintomas = {
-    "fiebre alta": ["temperatura elevada", "calentura"],
-    "tos seca": ["tos persistente"],
-    "dolor de cabeza": ["cefalea", "migraña"],
-    "congestión nasal": ["nariz tapada"],
-    "dificultad para respirar": ["falta de aire", "disnea"],
-    "dolor muscular": ["mialgia", "cuerpo cortado"],
-    "estornudos": ["estornudar"],
-    "mareo": ["vértigo"],
-    "dolor abdominal": ["malestar estomacal"],
-}
-
-# Definir templates de forma individual
-env.build("(deftemplate sintoma (slot nombre))")
-env.build("(deftemplate edad (slot valor))")
-env.build("(deftemplate historial (slot condicion))")
-env.build("(deftemplate diagnostico (slot enfermedad) (slot certeza) (slot recomendacion))")
-env.build("(deftemplate riesgo (slot factor) (slot nivel))")
-
-# Definir reglas de forma individual
-env.build("""
-(defrule detectar_covid
-   (sintoma (nombre fiebre))
-   (sintoma (nombre tos))
-   (sintoma (nombre dificultad))
-   =>
-   (assert (diagnostico (enfermedad "COVID19") (certeza 90) (recomendacion "Aislamiento, prueba PCR y monitoreo medico"))))
-""")
-
-env.build("""
-(defrule detectar_gripe
-   (sintoma (nombre fiebre))
-   (sintoma (nombre dolor_muscular))
-   (sintoma (nombre congestion_nasal))
-   =>
-   (assert (diagnostico (enfermedad "Gripe") (certeza 80) (recomendacion "Reposo, hidratacion y analgesicos"))))
-""")
-
-env.build("""
-(defrule evaluar_riesgo_edad
-   (edad (valor ?e))
-   (test (>= ?e 60))
-   =>
-   (assert (riesgo (factor "edad") (nivel "alto"))))
-""")
-
-env.build("""
-(defrule evaluar_riesgo_historial
-   (historial (condicion "asma"))
-   =>
-   (assert (riesgo (factor "asma") (nivel "medio"))))
-""")
-
-env.build("""
-(defrule recomendaciones_prevencion
-   (riesgo (factor "edad") (nivel "alto"))
-   =>
-   (assert (diagnostico (enfermedad "Riesgo_alto_enfermedades_respiratorias") (certeza 100) (recomendacion "Vacunacion y evitar aglomeraciones"))))
-""")
-
-def normalizar_sintomas(sintoma):
-    """Convierte un síntoma en su versión estandarizada usando sinónimos"""
-    for clave, sinonimos in sinonimos_sintomas.items():
-        if sintoma in sinonimos:
-            return clave.replace(" ", "_")
-    return sintoma.replace(" ", "_")
-
-def extraer_sintomas(texto):
-    """Extrae síntomas relevantes y normaliza con sinónimos"""
-    doc = nlp(texto.lower())
-    sintomas_detectados = [normalizar_sintomas(token.text) for token in doc if token.pos_ in ["NOUN", "ADJ"]]
-    return list(set(sintomas_detectados))
-
-def diagnosticar(texto, edad, historial):
-    """Procesa el texto ingresado, extrae síntomas y ejecuta el motor de inferencia en CLIPS."""
-    env.reset()
-    
-    sintomas = extraer_sintomas(texto)
-    for sintoma in sintomas:
-        env.assert_string(f'(sintoma (nombre {sintoma}))')
-    
-    env.assert_string(f'(edad (valor {edad}))')
-    
-    for condicion in historial:
-        env.assert_string(f'(historial (condicion {condicion.replace(" ", "_")}))')
-    
-    env.run()
-    
-    diagnosticos = []
-    for fact in env.facts():
-        if fact.template.name == "diagnostico":
-            diagnosticos.append((fact["enfermedad"], fact["certeza"], fact["recomendacion"]))
-    
-    return diagnosticos
+# La base de conocimientos (base_conocimientos.json), el modelo de spaCy y los
+# entornos CLIPS se comparten con sistema_experto
+from sistema_experto import extraer_sintomas, obtener_base, obtener_nlp
 
 #################################################
 # PARTE 2: RAZONAMIENTO (FORWARD & BACKWARD CHAINING)
 #################################################
 
-def backward_chaining(enfermedad_objetivo):
-    """
-    Implementa razonamiento hacia atrás para verificar si una enfermedad específica
-    puede ser diagnosticada con base en los síntomas actuales.
-    """
-    # Obtener reglas que concluyen la enfermedad objetivo
-    requisitos_sintomas = {
-        "COVID19": ["fiebre", "tos", "dificultad_para_respirar"],
-        "Gripe": ["fiebre", "dolor_muscular", "congestion_nasal"],
-        "Riesgo_alto_enfermedades_respiratorias": []  # Este depende de factores de riesgo, no síntomas
-    }
-    
-    if enfermedad_objetivo not in requisitos_sintomas:
-        return {
-            "posible": False,
-            "mensaje": "Enfermedad no reconocida en la base de conocimientos",
-            "sintomas_faltantes": []
-        }
-    
-    # Obtener síntomas actuales en los hechos
-    sintomas_actuales = []
-    for fact in env.facts():
-        if fact.template.name == "sintoma":
-            sintomas_actuales.append(fact["nombre"])
-    
-    # Comprobar si todos los síntomas necesarios están presentes
-    sintomas_requeridos = requisitos_sintomas[enfermedad_objetivo]
-    sintomas_faltantes = [s for s in sintomas_requeridos if s not in sintomas_actuales]
-    
-    return {
-        "posible": len(sintomas_faltantes) == 0,
-        "mensaje": "Diagnóstico posible" if len(sintomas_faltantes) == 0 else "Faltan síntomas para confirmar",
-        "sintomas_faltantes": sintomas_faltantes
-    }
-
-def explicar_diagnostico(enfermedad):
-    """
-    Explica cómo se llegó a un diagnóstico específico, mostrando las reglas involucradas.
-    """
-    explicaciones = {
-        "COVID19": "El diagnóstico de COVID-19 se basa en la presencia de fiebre alta, tos seca, y dificultad para respirar.",
-        "Gripe": "El diagnóstico de gripe se basa en la presencia de fiebre, dolor muscular, y congestión nasal.",
-        "Riesgo_alto_enfermedades_respiratorias": "Este aviso se genera cuando hay un factor de riesgo alto, como la edad avanzada."
-    }
-    
-    return explicaciones.get(enfermedad, "No hay explicación disponible para esta condición.")
-
-def diagnosticar_completo(texto, edad, historial, enfermedad_objetivo=None):
-    """Integra encadenamiento hacia adelante y hacia atrás"""
-    env.reset()
-    
-    # Procesar texto para extraer síntomas (encadenamiento hacia adelante)
-    sintomas = extraer_sintomas(texto)
-    print(f"\nSíntomas detectados: {sintomas}")
-    
-    for sintoma in sintomas:
-        env.assert_string(f'(sintoma (nombre {sintoma}))')
-    
-    env.assert_string(f'(edad (valor {edad}))')
-    
-    for condicion in historial:
-        env.assert_string(f'(historial (condicion {condicion.replace(" ", "_")}))')
-    
-    # Si hay una enfermedad objetivo, usar encadenamiento hacia atrás primero
-    if enfermedad_objetivo:
-        resultado_backward = backward_chaining(enfermedad_objetivo)
-        if resultado_backward["posible"]:
-            print(f"\nAnálisis específico para {enfermedad_objetivo}:")
-            print(f"✓ {resultado_backward['mensaje']}")
-            print(f"✓ {explicar_diagnostico(enfermedad_objetivo)}")
-        else:
-            print(f"\nAnálisis específico para {enfermedad_objetivo}:")
-            print(f"✗ {resultado_backward['mensaje']}")
-            if resultado_backward['sintomas_faltantes']:
-                print(f"Síntomas faltantes: {', '.join(resultado_backward['sintomas_faltantes'])}")
-    
-    # Ejecutar motor de inferencia (encadenamiento hacia adelante)
-    env.run()
-    
-    # Recopilar diagnósticos generados
-    diagnosticos = []
-    for fact in env.facts():
-        print(fact)
-        if fact.template.name == "diagnostico":
-            diagnosticos.append({
-                "enfermedad": fact["enfermedad"], 
-                "certeza": fact["certeza"], 
-                "recomendacion": fact["recomendacion"],
-                "explicacion": explicar_diagnostico(fact["enfermedad"])
-            })
-    return diagnosticos
+from sesion_diagnostico import SesionDiagnostico
 
 #################################################
 # PARTE 3: INTERFAZ GRÁFICA (TKINTER)
@@ -271,11 +84,24 @@ class DiagnosticApp:
         
         self.disease_var = tk.StringVar()
         disease_combo = ttk.Combobox(input_frame, textvariable=self.disease_var)
-        disease_combo['values'] = ('', 'COVID19', 'Gripe', 'Riesgo_alto_enfermedades_respiratorias')
+        disease_combo['values'] = ('',) + tuple(obtener_base().requisitos)
         disease_combo.pack(fill=tk.X, pady=5)
         
-        # Botón de diagnóstico
-        ttk.Button(input_frame, text="Realizar diagnóstico", command=self.perform_diagnosis).pack(pady=10)
+        # Botones de diagnóstico y cancelación
+        button_frame = ttk.Frame(input_frame)
+        button_frame.pack(pady=10)
+        
+        ttk.Button(button_frame, text="Realizar diagnóstico", command=self.perform_diagnosis).pack(side=tk.LEFT, padx=5)
+        
+        self.cancel_button = ttk.Button(button_frame, text="Cancelar", command=self.cancel_diagnosis, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        
+        # Indicador de progreso
+        self.progress = ttk.Progressbar(input_frame, mode="indeterminate")
+        self.progress.pack(fill=tk.X)
+        
+        self.status_var = tk.StringVar(value="Cargando modelo de lenguaje...")
+        ttk.Label(input_frame, textvariable=self.status_var).pack(anchor=tk.W)
         
         # Marco de resultados
         result_frame = ttk.Frame(main_frame, padding="10")
@@ -286,18 +112,37 @@ class DiagnosticApp:
         self.result_text = scrolledtext.ScrolledText(result_frame, height=10, wrap=tk.WORD)
         self.result_text.pack(fill=tk.BOTH, expand=True)
         
+        # El diagnóstico se ejecuta en un hilo aparte para no congelar la ventana.
+        # Un solo hilo basta: los clics repetidos se agrupan en la última entrada.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+        self.pending = None
+        self.cancelled = False
+        # Sesión con la memoria de trabajo del último diagnóstico; solo la usa el hilo de trabajo
+        self.sesion = None
+        
+        # Precargar spaCy en segundo plano para que el primer diagnóstico no lo pague
+        self.warmup = self.executor.submit(obtener_nlp)
+        self.root.after(100, self._poll_warmup)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+    def _poll_warmup(self):
+        """Actualiza el estado cuando termina la precarga del modelo"""
+        if not self.warmup.done():
+            self.root.after(100, self._poll_warmup)
+        elif self.job is None:
+            self.status_var.set("Listo")
+        
     def perform_diagnosis(self):
         """Realizar diagnóstico usando el sistema experto"""
         
-        # Limpiar resultados anteriores
-        self.result_text.delete(1.0, tk.END)
-        
         # Obtener datos de entrada
         symptoms_text = self.symptom_text.get(1.0, tk.END).strip()
         
         try:
             age = int(self.age_var.get())
         except ValueError:
+            self.result_text.delete(1.0, tk.END)
             self.result_text.insert(tk.END, "Error: Por favor ingrese una edad válida\n")
             return
         
@@ -313,22 +158,99 @@ class DiagnosticApp:
         # Obtener enfermedad objetivo (si está seleccionada)
         target_disease = self.disease_var.get() if self.disease_var.get() else None
         
-        # Llamar a nuestro sistema experto
+        # Si ya hay un diagnóstico en curso solo se guarda la última entrada
+        self.pending = (symptoms_text, age, history, target_disease)
+        if self.job is None:
+            self._start_job()
+        else:
+            self.status_var.set("Diagnóstico en curso; se procesará la última entrada al terminar")
+    
+    def _start_job(self):
+        """Envía la entrada pendiente al hilo de trabajo"""
+        args, self.pending = self.pending, None
+        self.cancelled = False
+        self.job = self.executor.submit(self._diagnosticar, *args)
+        self.progress.start(10)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.status_var.set("Diagnosticando...")
+        self.root.after(50, self._poll_job)
+    
+    def _diagnosticar(self, texto, edad, historial, enfermedad_objetivo):
+        """
+        Se ejecuta en el hilo de trabajo. Entre dos diagnósticos solo se insertan o
+        retiran los hechos que cambiaron, en lugar de recargar todo el paciente.
+        Devuelve (analisis, diagnosticos); analisis es None sin enfermedad objetivo.
+        """
+        if self.sesion is None:
+            self.sesion = SesionDiagnostico()
+        sintomas = extraer_sintomas(texto)
+        self.sesion.actualizar(sintomas=sintomas, edad=edad, historial=historial)
+        self.sesion.run()
+        analisis = self.sesion.analizar(enfermedad_objetivo) if enfermedad_objetivo else None
+        diagnosticos = self.sesion.diagnosticos()
+        if auditoria.activa:
+            # Se auditan las reglas disparadas en este turno de la sesión
+            traza = self.sesion.traza
+            auditoria.registrar(texto, edad, historial, sintomas, traza.reglas(traza.ultimos), diagnosticos)
+        return analisis, diagnosticos
+    
+    def _poll_job(self):
+        """Revisa desde el hilo de Tk si el diagnóstico terminó y muestra el resultado"""
+        if not self.job.done():
+            self.root.after(50, self._poll_job)
+            return
+        
+        job, self.job = self.job, None
+        if self.pending is not None:
+            # El resultado ya está obsoleto: hay una entrada más reciente
+            self._start_job()
+            return
+        
+        self.progress.stop()
+        self.cancel_button.config(state=tk.DISABLED)
+        if self.cancelled:
+            self.status_var.set("Diagnóstico cancelado")
+            return
+        
+        if self.sesion is not None and self.sesion.agotado:
+            self.status_var.set("Listo (se alcanzó el límite de reglas; el resultado puede estar incompleto)")
+        else:
+            self.status_var.set("Listo")
+        self.result_text.delete(1.0, tk.END)
         try:
-            diagnosticos = diagnosticar_completo(symptoms_text, age, history, target_disease)
-            
-            # Mostrar resultados
-            if diagnosticos:
-                self.result_text.insert(tk.END, "=== Diagnóstico completado ===\n\n")
-                for diag in diagnosticos:
-                    self.result_text.insert(tk.END, f"• {diag['enfermedad']} (Certeza: {diag['certeza']}%)\n")
-                    self.result_text.insert(tk.END, f"  Explicación: {diag['explicacion']}\n")
-                    self.result_text.insert(tk.END, f"  Recomendación: {diag['recomendacion']}\n\n")
-            else:
-                self.result_text.insert(tk.END, "No se pudo generar un diagnóstico con los síntomas proporcionados.\n" +
-                                      "Intente describir sus síntomas con mayor detalle.\n")
+            self._show_results(*job.result())
         except Exception as e:
             self.result_text.insert(tk.END, f"Error en el diagnóstico: {str(e)}\n")
+    
+    def _show_results(self, analisis, diagnosticos):
+        """Escribe el análisis de la enfermedad objetivo (si lo hay) y los diagnósticos en el área de resultados"""
+        if analisis is not None:
+            self.result_text.insert(tk.END, f"=== Análisis específico: {analisis['mensaje']} ===\n")
+            if analisis['sintomas_faltantes']:
+                self.result_text.insert(tk.END, f"Síntomas faltantes: {', '.join(analisis['sintomas_faltantes'])}\n")
+            self.result_text.insert(tk.END, "\n")
+        if diagnosticos:
+            self.result_text.insert(tk.END, "=== Diagnóstico completado ===\n\n")
+            for diag in diagnosticos:
+                self.result_text.insert(tk.END, f"• {diag['enfermedad']} (Certeza: {diag['certeza']}%)\n")
+                self.result_text.insert(tk.END, f"  Explicación: {diag['explicacion']}\n")
+                self.result_text.insert(tk.END, f"  Recomendación: {diag['recomendacion']}\n\n")
+        else:
+            self.result_text.insert(tk.END, "No se pudo generar un diagnóstico con los síntomas proporcionados.\n" +
+                                  "Intente describir sus síntomas con mayor detalle.\n")
+    
+    def cancel_diagnosis(self):
+        """Descarta el diagnóstico en curso y cualquier entrada pendiente"""
+        self.pending = None
+        self.cancelled = True
+        if self.job is not None:
+            self.job.cancel()
+        self.status_var.set("Cancelando...")
+    
+    def on_close(self):
+        """Cierra la ventana sin esperar a un diagnóstico en curso"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
 #################################################
 # PARTE 4: EJECUCIÓN PRINCIPAL
@@ -1,114 +1,544 @@
+import os
+import threading
+import time
+from array import array
+
 import clips
-import spacy
-
-# Cargar modelo de spaCy en español
-nlp = spacy.load("es_core_news_sm")
-
-# Inicializar entorno CLIPS
-env = clips.Environment()
-
-# Diccionario de sinónimos para mejorar el reconocimiento de síntomas
-sinonimos_sintomas = {
-    "fiebre alta": ["temperatura elevada", "calentura"],
-    "tos seca": ["tos persistente"],
-    "dolor de cabeza": ["cefalea", "migraña"],
-    "congestión nasal": ["nariz tapada"],
-    "dificultad para respirar": ["falta de aire", "disnea"],
-    "dolor muscular": ["mialgia", "cuerpo cortado"],
-    "estornudos": ["estornudar"],
-    "mareo": ["vértigo"],
-    "dolor abdominal": ["malestar estomacal"],
-}
-
-# Definir templates de forma individual
-env.build("(deftemplate sintoma (slot nombre))")
-env.build("(deftemplate edad (slot valor))")
-env.build("(deftemplate historial (slot condicion))")
-env.build("(deftemplate diagnostico (slot enfermedad) (slot certeza) (slot recomendacion))")
-env.build("(deftemplate riesgo (slot factor) (slot nivel))")
-
-# Definir reglas de forma individual
-env.build("""
-(defrule detectar_covid
-   (sintoma (nombre fiebre_alta))
-   (sintoma (nombre tos_seca))
-   (sintoma (nombre dificultad_para_respirar))
-   =>
-   (assert (diagnostico (enfermedad "COVID19") (certeza 90) (recomendacion "Aislamiento, prueba PCR y monitoreo medico"))))
-""")
-
-env.build("""
-(defrule detectar_gripe
-   (sintoma (nombre fiebre))
-   (sintoma (nombre dolor_muscular))
-   (sintoma (nombre congestion_nasal))
-   =>
-   (assert (diagnostico (enfermedad "Gripe") (certeza 80) (recomendacion "Reposo, hidratacion y analgesicos"))))
-""")
-
-env.build("""
-(defrule evaluar_riesgo_edad
-   (edad (valor ?e))
-   (test (>= ?e 60))
-   =>
-   (assert (riesgo (factor "edad") (nivel "alto"))))
-""")
-
-env.build("""
-(defrule evaluar_riesgo_historial
-   (historial (condicion "asma"))
-   =>
-   (assert (riesgo (factor "asma") (nivel "medio"))))
-""")
-
-env.build("""
-(defrule recomendaciones_prevencion
-   (riesgo (factor "edad") (nivel "alto"))
-   =>
-   (assert (diagnostico (enfermedad "Riesgo_alto_enfermedades_respiratorias") (certeza 100) (recomendacion "Vacunacion y evitar aglomeraciones"))))
-""")
+
+import instrumentacion
+from base_conocimientos import (
+    RecursoPorHuella,
+    calificar,
+    cargar_base,
+    id_sintoma,
+    separar,
+)
+from cache_diagnostico import CacheLRU
+from contexto_clinico import (
+    calificar_id,
+    certezas_sintomas,
+    estado_en,
+    hay_disparadores,
+    palabras_contexto,
+)
+from extractor_rapido import ExtractorRapido
+from factores_certeza import TablaCertezas
+from motor_compilado import MotorCompilado, ReglaNoCompilable
+from pool_entornos import EnvironmentPool
+
+# Modelo de spaCy en español. Se carga de forma perezosa con obtener_nlp()
+MODELO_SPACY = "es_core_news_sm"
+
+# Componentes que extraer_sintomas no utiliza (solo necesita token.pos_, que
+# proviene de tok2vec + morphologizer + attribute_ruler)
+COMPONENTES_PRESCINDIBLES = ["parser", "ner", "lemmatizer"]
+
+# Cargar por defecto solo los componentes necesarios
+NLP_LIGERO = os.environ.get("SISTEMA_EXPERTO_NLP_LIGERO", "0") == "1"
+
+# Extractor de síntomas por defecto: "spacy" (modelo estadístico, etiqueta cada
+# palabra) o "rapido" (busca solo las frases del vocabulario, sin cargar spaCy)
+EXTRACTORES = ("spacy", "rapido")
+EXTRACTOR = os.environ.get("SISTEMA_EXPERTO_EXTRACTOR", "spacy")
+
+# Motor de inferencia cuando no se pasa un entorno: "clips" o "compilado" (reglas
+# evaluadas en Python con máscaras de bits; si la base no se puede compilar se usa CLIPS)
+MOTORES = ("clips", "compilado")
+MOTOR = os.environ.get("SISTEMA_EXPERTO_MOTOR", "clips")
+
+# Número de entornos CLIPS del pool compartido (diagnósticos simultáneos)
+TAMANO_POOL = int(os.environ.get("SISTEMA_EXPERTO_POOL") or os.cpu_count() or 4)
+
+# Caches de texto -> síntomas y de hechos del paciente -> diagnósticos.
+# Tamaño 0 las desactiva; TTL vacío significa sin caducidad.
+TAMANO_CACHE = int(os.environ.get("SISTEMA_EXPERTO_CACHE", "10000"))
+TTL_CACHE = float(os.environ.get("SISTEMA_EXPERTO_CACHE_TTL") or 0) or None
+
+# Recursos compartidos por todo el proceso, creados en el primer uso. Los que
+# dependen de la base se reconstruyen cuando cambia su huella (ver RecursoPorHuella)
+_candado = threading.RLock()
+_modelos_nlp = {}
+_base = None
+_entorno = None
+_pool = None
+
+cache_sintomas = CacheLRU(TAMANO_CACHE, TTL_CACHE)
+cache_diagnosticos = CacheLRU(TAMANO_CACHE, TTL_CACHE)
+
+def obtener_base():
+    """Devuelve la base de conocimientos compilada, cargándola del fichero la primera vez"""
+    global _base
+    if _base is None:
+        with _candado:
+            if _base is None:
+                _base = cargar_base()
+    return _base
+
+def crear_entorno():
+    """Crea un entorno CLIPS nuevo con los templates y las reglas cargados"""
+    return obtener_base().crear_entorno()
+
+def obtener_entorno():
+    """Devuelve el entorno CLIPS compartido, creándolo la primera vez"""
+    global _entorno
+    if _entorno is None:
+        with _candado:
+            if _entorno is None:
+                _entorno = crear_entorno()
+    return _entorno
+
+def obtener_pool():
+    """Devuelve el pool de entornos compartido, creándolo la primera vez"""
+    global _pool
+    if _pool is None:
+        with _candado:
+            if _pool is None:
+                _pool = EnvironmentPool(crear_entorno, TAMANO_POOL)
+    return _pool
+
+def _modelo_nlp(ligero):
+    """Modelo de spaCy de la variante pedida (no depende de la base), cargado una vez"""
+    modelo = _modelos_nlp.get(ligero)
+    if modelo is None:
+        with _candado:
+            modelo = _modelos_nlp.get(ligero)
+            if modelo is None:
+                # spaCy se importa aquí: solo importarlo ya cuesta cerca de un segundo
+                import spacy
+
+                excluir = COMPONENTES_PRESCINDIBLES if ligero else []
+                modelo = _modelos_nlp[ligero] = spacy.load(MODELO_SPACY, exclude=excluir)
+    return modelo
+
+def _motor_de_base(base):
+    """MotorCompilado de `base`, o None si tiene reglas que no se pueden compilar"""
+    try:
+        return MotorCompilado(base)
+    except ReglaNoCompilable:
+        return None
+
+# Matcher de sinónimos de cada variante de spaCy, y los índices derivados de la base
+_matchers = {ligero: RecursoPorHuella(lambda base, ligero=ligero: _construir_matcher(_modelo_nlp(ligero), base.sinonimos),
+                                      _candado)
+             for ligero in (False, True)}
+_extractor_rapido = RecursoPorHuella(lambda base: ExtractorRapido(base.vocabulario, base.simbolos), _candado)
+_tabla_certezas = RecursoPorHuella(TablaCertezas, _candado)
+_motor_compilado = RecursoPorHuella(_motor_de_base, _candado)
+
+def _recursos(ligero=None):
+    """
+    Devuelve (nlp, matcher) para la variante pedida, cargándolos la primera vez.
+    El matcher se recompila si la base de conocimientos cambió desde que se construyó.
+    """
+    ligero = NLP_LIGERO if ligero is None else bool(ligero)
+    matcher = _matchers[ligero].obtener(obtener_base())
+    return _modelos_nlp[ligero], matcher
+
+def obtener_extractor_rapido():
+    """Devuelve el ExtractorRapido de la base actual, reconstruyéndolo si la base cambió"""
+    return _extractor_rapido.obtener(obtener_base())
+
+def obtener_tabla_certezas():
+    """Devuelve la TablaCertezas de la base actual, reconstruyéndola si la base cambió"""
+    return _tabla_certezas.obtener(obtener_base())
+
+def obtener_motor_compilado():
+    """
+    Devuelve el MotorCompilado de la base actual, o None si la base tiene reglas que
+    no se pueden compilar (entonces el diagnóstico se hace en CLIPS).
+    """
+    return _motor_compilado.obtener(obtener_base())
+
+def _variante(ligero=None, extractor=None):
+    """Variante de extracción de una llamada (parte de la clave de la cache de síntomas)"""
+    extractor = extractor or EXTRACTOR
+    if extractor not in EXTRACTORES:
+        raise ValueError(f"Extractor desconocido: {extractor!r} (opciones: {', '.join(EXTRACTORES)})")
+    if extractor == "rapido":
+        return "rapido"
+    return NLP_LIGERO if ligero is None else ligero
+
+def obtener_nlp(ligero=None):
+    """
+    Devuelve el modelo de spaCy compartido por el proceso, cargándolo la primera vez.
+    Con ligero=True se carga sin parser, NER ni lematizador. Por defecto se usa
+    NLP_LIGERO (variable de entorno SISTEMA_EXPERTO_NLP_LIGERO=1).
+    """
+    return _recursos(ligero)[0]
+
+def invalidar_caches():
+    """Vacía las caches de síntomas y diagnósticos"""
+    cache_sintomas.limpiar()
+    cache_diagnosticos.limpiar()
+
+def recargar_base(base=None, preparar=False):
+    """
+    Sustituye la base de conocimientos (por defecto la vuelve a leer del fichero),
+    descarta los entornos ya construidos e invalida las caches. Los matchers de
+    sinónimos se recompilan en el siguiente uso.
+
+    Con preparar=True los recursos que ya se estaban usando (pool de entornos,
+    matchers, extractor rápido, motor compilado...) se construyen para la nueva base
+    antes de sustituirla, sin retener el candado, y se instalan todos a la vez: las
+    peticiones siguientes no pagan la reconstrucción y las que están en curso
+    terminan con los entornos que ya tenían prestados.
+    """
+    global _base, _entorno, _pool
+    if base is None:
+        base = cargar_base(anterior=_base)
+    nuevos = {}
+    preparados = []
+    if preparar:
+        if _pool is not None:
+            nuevos["pool"] = EnvironmentPool(base.crear_entorno, _pool.tamano)
+        if _entorno is not None:
+            nuevos["entorno"] = base.crear_entorno()
+        recursos = [*_matchers.values(), _extractor_rapido, _tabla_certezas, _motor_compilado]
+        preparados = [(recurso, recurso.construir(base)) for recurso in recursos if recurso.construido]
+    with _candado:
+        _base = base
+        _entorno = nuevos.get("entorno")
+        _pool = nuevos.get("pool")
+        for recurso, construido in preparados:
+            recurso.instalar(construido, base)
+    invalidar_caches()
+
+def __getattr__(nombre):
+    """
+    Compatibilidad: `nlp`, `env`, `sinonimos_sintomas` y `REGLAS` siguen disponibles
+    como atributos del módulo, resueltos de forma perezosa.
+    """
+    if nombre == "nlp":
+        return obtener_nlp()
+    if nombre == "env":
+        return obtener_entorno()
+    if nombre == "sinonimos_sintomas":
+        return obtener_base().sinonimos
+    if nombre == "REGLAS":
+        return obtener_base().reglas
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+def _construir_matcher(nlp, sinonimos):
+    """
+    Compila todas las frases de síntomas (claves y sinónimos) en un PhraseMatcher.
+    Se construye una sola vez; cada búsqueda recorre el documento en un solo paso,
+    con un coste que depende del largo del texto y no del tamaño del diccionario.
+    """
+    from spacy.matcher import PhraseMatcher
+
+    matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
+    for clave, lista in sinonimos.items():
+        patrones = list(nlp.tokenizer.pipe([clave] + list(lista)))
+        matcher.add(id_sintoma(clave), patrones)
+    return matcher
 
 def normalizar_sintomas(sintoma):
     """Convierte un síntoma en su versión estandarizada usando sinónimos"""
-    for clave, sinonimos in sinonimos_sintomas.items():
-        if sintoma in sinonimos:
-            return clave.replace(" ", "_")
-    return sintoma.replace(" ", "_")
-
-def extraer_sintomas(texto):
-    """Extrae síntomas relevantes y normaliza con sinónimos"""
-    doc = nlp(texto.lower())
-    sintomas_detectados = [normalizar_sintomas(token.text) for token in doc if token.pos_ in ["NOUN", "ADJ"]]
-    return list(set(sintomas_detectados))
-
-def diagnosticar(texto, edad, historial):
-    """Procesa el texto ingresado, extrae síntomas y ejecuta el motor de inferencia en CLIPS."""
-    env.reset()
-    
-    sintomas = extraer_sintomas(texto)
+    canonico = obtener_base().indice_sinonimos.get(sintoma)
+    return canonico if canonico is not None else id_sintoma(sintoma)
+
+def _ids_de_doc(doc, matcher, base=None):
+    """
+    Array de ids de los síntomas de un documento ya procesado por spaCy. La negación,
+    la incertidumbre y el tiempo pasado se detectan sobre los mismos tokens (ver
+    contexto_clinico) y esos síntomas llevan su estado en el nombre ("fiebre:negado").
+    """
+    base = base or obtener_base()
+    simbolos = base.simbolos
+    cadenas = doc.vocab.strings
+    palabras = palabras_contexto([token.lower_ for token in doc])
+    if not hay_disparadores(palabras):
+        ids = {simbolos.internar(cadenas[match_id]) for match_id, _, _ in matcher(doc)}
+        ids.update(base.id_forma(token.text) for token in doc if token.pos_ in ("NOUN", "ADJ"))
+    else:
+        ids = {calificar_id(simbolos, simbolos.internar(cadenas[match_id]), estado_en(palabras, inicio))
+               for match_id, inicio, _ in matcher(doc)}
+        ids.update(calificar_id(simbolos, base.id_forma(token.text), estado_en(palabras, token.i))
+                   for token in doc if token.pos_ in ("NOUN", "ADJ"))
+    return simbolos.array_ids(ids)
+
+def _sintomas_de_doc(doc, matcher):
+    """Filtra y normaliza los síntomas de un documento ya procesado por spaCy"""
+    base = obtener_base()
+    return base.simbolos.decodificar(_ids_de_doc(doc, matcher, base))
+
+def _ids_simbolos(sintomas, simbolos):
+    """Array de ids de unos síntomas, dados como cadenas o ya como array de ids"""
+    return sintomas if isinstance(sintomas, array) else simbolos.codificar(sintomas)
+
+def extraer_ids(texto, ligero=None, extractor=None):
+    """
+    Como extraer_sintomas, pero devuelve el array de ids de los síntomas en
+    obtener_base().simbolos. El array puede venir de la cache: no hay que modificarlo.
+    """
+    variante = _variante(ligero, extractor)
+    base = obtener_base()
+    clave = (texto, variante, base.huella)
+    ids = cache_sintomas.obtener(clave)
+    if ids is None and variante == "rapido":
+        rapido = obtener_extractor_rapido()
+        inicio = time.perf_counter() if instrumentacion.activa else None
+        ids = rapido.extraer_ids(texto)
+        cache_sintomas.guardar(clave, ids)
+        if inicio is not None:
+            instrumentacion.registrar("extraccion_rapida", time.perf_counter() - inicio, textos=1)
+    elif ids is None:
+        nlp, matcher = _recursos(ligero)
+        inicio = time.perf_counter() if instrumentacion.activa else None
+        doc = nlp(texto.lower())
+        ids = _ids_de_doc(doc, matcher, base)
+        cache_sintomas.guardar(clave, ids)
+        if inicio is not None:
+            instrumentacion.registrar("extraccion", time.perf_counter() - inicio, textos=1, tokens=len(doc))
+    return ids
+
+def extraer_sintomas(texto, ligero=None, extractor=None):
+    """
+    Extrae síntomas relevantes y normaliza con sinónimos. `extractor` elige entre
+    "spacy" y "rapido" (por defecto EXTRACTOR, variable SISTEMA_EXPERTO_EXTRACTOR).
+    """
+    return obtener_base().simbolos.decodificar(extraer_ids(texto, ligero, extractor))
+
+def extraer_ids_lote(textos, batch_size=64, ligero=None, extractor=None):
+    """
+    Extrae los síntomas de varios textos de una vez: los que no están en la cache se
+    procesan juntos con una sola llamada a nlp.pipe. Devuelve un array de ids por texto.
+    """
+    variante = _variante(ligero, extractor)
+    if variante == "rapido":
+        return [extraer_ids(texto, extractor="rapido") for texto in textos]
+    base = obtener_base()
+    resultados = [cache_sintomas.obtener((texto, variante, base.huella)) for texto in textos]
+    pendientes = [i for i, ids in enumerate(resultados) if ids is None]
+    if pendientes:
+        nlp, matcher = _recursos(ligero)
+        inicio = time.perf_counter() if instrumentacion.activa else None
+        tokens = 0
+        docs = nlp.pipe((textos[i].lower() for i in pendientes), batch_size=batch_size)
+        for i, doc in zip(pendientes, docs):
+            resultados[i] = _ids_de_doc(doc, matcher, base)
+            cache_sintomas.guardar((textos[i], variante, base.huella), resultados[i])
+            tokens += len(doc)
+        if inicio is not None:
+            instrumentacion.registrar("extraccion_lote", time.perf_counter() - inicio,
+                                      textos=len(pendientes), tokens=tokens)
+    return resultados
+
+def extraer_sintomas_lote(textos, batch_size=64, ligero=None, extractor=None):
+    """Como extraer_ids_lote, pero devuelve una lista de síntomas canónicos por texto"""
+    decodificar = obtener_base().simbolos.decodificar
+    return [decodificar(ids) for ids in extraer_ids_lote(textos, batch_size, ligero, extractor)]
+
+def _clave_paciente(ids, edad, historial, base):
+    """
+    Forma canónica de los hechos de un paciente, usada como clave de la cache de
+    diagnósticos: el tipo y los bytes del array de ids (ya ordenado) y la huella de
+    la base. Sin el tipo, dos ids "H" y uno "I" podrían dar los mismos bytes.
+    """
+    return (ids.typecode, ids.tobytes(), edad, tuple(sorted({id_sintoma(c) for c in historial})), base.huella)
+
+def cargar_hechos(env, sintomas, edad, historial):
+    """
+    Inserta los hechos de un paciente a través de los templates, sin generar ni
+    parsear código CLIPS. Así un valor con comillas o paréntesis no rompe la carga.
+    Los síntomas e historial se insertan como símbolos, en orden fijo para que el
+    resultado no dependa del orden de extracción; un síntoma calificado como
+    "fiebre:negado" se inserta con nombre fiebre y estado negado. Devuelve el número
+    de hechos insertados.
+    """
+    sintomas = sorted(set(sintomas))
+    plantilla_sintoma = env.find_template("sintoma")
     for sintoma in sintomas:
-        env.assert_string(f'(sintoma (nombre {sintoma}))')
+        nombre, estado = separar(sintoma)
+        plantilla_sintoma.assert_fact(nombre=clips.Symbol(nombre), estado=clips.Symbol(estado))
     
-    env.assert_string(f'(edad (valor {edad}))')
+    env.find_template("edad").assert_fact(valor=edad if isinstance(edad, (int, float)) else int(edad))
     
-    for condicion in historial:
-        env.assert_string(f'(historial (condicion {condicion.replace(" ", "_")}))')
+    condiciones = sorted({id_sintoma(c) for c in historial})
+    plantilla_historial = env.find_template("historial")
+    for condicion in condiciones:
+        plantilla_historial.assert_fact(condicion=clips.Symbol(condicion))
+    return len(sintomas) + 1 + len(condiciones)
+
+def cargar_paciente(env, sintomas, edad, historial):
+    """Vacía la memoria de trabajo de `env` y carga los hechos del paciente"""
+    inicio = time.perf_counter() if instrumentacion.activa else None
+    env.reset()
+    hechos = cargar_hechos(env, sintomas, edad, historial)
+    if inicio is not None:
+        instrumentacion.registrar("carga_hechos", time.perf_counter() - inicio, hechos=hechos)
+    return hechos
+
+def ejecutar_reglas(env, limite=None, traza=None):
+    """
+    Ejecuta el motor de inferencia (como máximo `limite` reglas) y devuelve las reglas
+    disparadas. Con una TrazaDisparos en `traza` se recogen después en ella los disparos.
+    """
+    if not instrumentacion.activa:
+        disparadas = env.run(limite)
+    else:
+        agenda = sum(1 for _ in env.activations())
+        inicio = time.perf_counter()
+        disparadas = env.run(limite)
+        instrumentacion.registrar("inferencia", time.perf_counter() - inicio, reglas_disparadas=disparadas,
+                                  agenda=agenda)
+    if traza is not None:
+        traza.recoger(env)
+    return disparadas
+
+def recoger_diagnosticos(env, certezas_sintomas=None):
+    """
+    Diagnósticos de la memoria de trabajo de `env` como tuplas (enfermedad, certeza,
+    recomendacion), una por enfermedad y ordenadas de mayor a menor certeza. Si varias
+    reglas concluyen la misma enfermedad, sus certezas se combinan como en MYCIN
+    (ver factores_certeza); `certezas_sintomas` pondera la evidencia de cada regla.
+    """
+    tabla = obtener_tabla_certezas()
+    return tabla.agregar(tabla.contribuciones(env, certezas_sintomas))
+
+def recoger_parciales(env, certezas_sintomas=None):
+    """
+    Coincidencias parciales con los síntomas de la memoria de trabajo de `env`: reglas
+    que no se dispararon pero cuya premisa se cumple en su mayor parte. Van aparte de
+    recoger_diagnosticos, como tuplas (enfermedad, certeza, recomendacion, regla,
+    faltantes); ver TablaCertezas.parciales.
+    """
+    sintomas = [calificar(str(fact["nombre"]), str(fact["estado"])) for fact in env.find_template("sintoma").facts()]
+    disparadas = {str(fact["regla"]) for fact in env.find_template("diagnostico").facts()}
+    return obtener_tabla_certezas().parciales(sintomas, disparadas, certezas_sintomas)
+
+def _inferir_compilado(motor, ids, edad, historial, certezas=None):
+    """
+    Diagnósticos de un paciente (ids de sus síntomas) con el motor compilado, con el
+    mismo formato que recoger_diagnosticos
+    """
+    inicio = time.perf_counter() if instrumentacion.activa else None
+    disparadas = motor.evaluar(ids, edad, historial)
+    tabla = obtener_tabla_certezas()
+    diagnosticos = tabla.agregar(tabla.contribuciones_reglas(disparadas, certezas))
+    if inicio is not None:
+        instrumentacion.registrar("inferencia_compilada", time.perf_counter() - inicio, reglas_disparadas=len(disparadas))
+    return diagnosticos
+
+
+def _inferir(sintomas, edad, historial, env=None, motor=None):
+    """
+    Carga los hechos de un paciente en CLIPS, ejecuta las reglas y devuelve los diagnósticos.
+    Sin `env` el resultado se guarda en la cache de diagnósticos y se calcula con el
+    motor elegido (`motor` o MOTOR): el compilado o un entorno prestado del pool.
+    Con `env` siempre se ejecuta en CLIPS, porque el llamador puede querer consultar
+    después la memoria de trabajo. `sintomas` puede ser una lista de cadenas o un
+    array de ids (de extraer_ids); las cadenas solo se generan para CLIPS. Los
+    síntomas inciertos ponderan la certeza de las reglas que los usan.
+    """
+    base = obtener_base()
+    if env is None:
+        motor = motor or MOTOR
+        if motor not in MOTORES:
+            raise ValueError(f"Motor desconocido: {motor!r} (opciones: {', '.join(MOTORES)})")
+        ids = _ids_simbolos(sintomas, base.simbolos)
+        clave = _clave_paciente(ids, edad, historial, base)
+        diagnosticos = cache_diagnosticos.obtener(clave)
+        if diagnosticos is None:
+            compilado = obtener_motor_compilado() if motor == "compilado" else None
+            if compilado is not None:
+                certezas = certezas_sintomas(base.simbolos.decodificar(ids))
+                diagnosticos = tuple(_inferir_compilado(compilado, ids, edad, historial, certezas))
+            else:
+                with obtener_pool().prestar() as prestado:
+                    diagnosticos = tuple(_inferir(ids, edad, historial, prestado))
+            cache_diagnosticos.guardar(clave, diagnosticos)
+        return list(diagnosticos)
+
+    if isinstance(sintomas, array):
+        sintomas = base.simbolos.decodificar(sintomas)
+    cargar_paciente(env, sintomas, edad, historial)
     
-    env.run()
+    ejecutar_reglas(env)
     
-    diagnosticos = []
-    for fact in env.facts():
-        if fact.template.name == "diagnostico":
-            diagnosticos.append((fact["enfermedad"], fact["certeza"], fact["recomendacion"]))
+    inicio = time.perf_counter() if instrumentacion.activa else None
+    diagnosticos = recoger_diagnosticos(env, certezas_sintomas(sintomas))
+    if inicio is not None:
+        instrumentacion.registrar("recoleccion", time.perf_counter() - inicio, diagnosticos=len(diagnosticos))
     
     return diagnosticos
 
+def diagnosticar(texto, edad, historial, env=None, extractor=None, motor=None):
+    """
+    Procesa el texto ingresado, extrae síntomas y ejecuta el motor de inferencia en CLIPS.
+    Es seguro llamarla desde varios hilos: cada llamada usa su propio entorno del pool.
+    """
+    inicio = time.perf_counter() if instrumentacion.activa else None
+    ids = extraer_ids(texto, extractor=extractor)
+    diagnosticos = _inferir(ids, edad, historial, env, motor)
+    if inicio is not None:
+        instrumentacion.registrar("diagnostico", time.perf_counter() - inicio)
+    return diagnosticos
+
+def _desempaquetar_registro(registro):
+    """Acepta un registro como dict (texto, edad, historial) o como tupla en ese orden"""
+    if isinstance(registro, dict):
+        return registro["texto"], registro["edad"], registro.get("historial", [])
+    texto, edad, historial = registro
+    return texto, edad, historial
+
+def _ids_de_registros(registros, batch_size, n_process, extractor):
+    """Genera (registro, ids de síntomas) con el extractor pedido; con spaCy, en lotes de nlp.pipe"""
+    if _variante(extractor=extractor) == "rapido":
+        rapido = obtener_extractor_rapido()
+        for registro in registros:
+            yield registro, rapido.extraer_ids(_desempaquetar_registro(registro)[0])
+        return
+
+    nlp, matcher = _recursos()
+    base = obtener_base()
+    pares = ((_desempaquetar_registro(registro)[0].lower(), registro) for registro in registros)
+    for doc, registro in nlp.pipe(pares, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield registro, _ids_de_doc(doc, matcher, base)
+
+def diagnosticar_lote(registros, batch_size=64, n_process=1, estadisticas=None, extractor=None, motor=None):
+    """
+    Diagnostica un flujo de registros de pacientes.
+
+    Los textos se procesan en lotes con nlp.pipe (o con el extractor rápido si
+    extractor="rapido") y cada paciente pasa una sola vez por el motor de inferencia.
+    Los resultados se generan a medida que se completan como tuplas
+    (registro, sintomas, diagnosticos). Si se pasa un dict en `estadisticas`, se
+    actualiza con las notas procesadas, los segundos transcurridos y el rendimiento
+    en notas por segundo.
+    """
+    if estadisticas is None:
+        estadisticas = {}
+    estadisticas.update(notas=0, segundos=0.0, notas_por_segundo=0.0)
+    inicio = time.perf_counter()
+
+    decodificar = obtener_base().simbolos.decodificar
+    for registro, ids in _ids_de_registros(registros, batch_size, n_process, extractor):
+        _, edad, historial = _desempaquetar_registro(registro)
+        diagnosticos = _inferir(ids, edad, historial, motor=motor)
+        sintomas = decodificar(ids)
+
+        transcurrido = time.perf_counter() - inicio
+        estadisticas["notas"] += 1
+        estadisticas["segundos"] = transcurrido
+        estadisticas["notas_por_segundo"] = estadisticas["notas"] / transcurrido if transcurrido else 0.0
+        yield registro, sintomas, diagnosticos
+
 # Prueba del sistema
-texto_usuario = "Tengo fiebre alta, tos persistente y me cuesta respirar."
-edad_usuario = 65
-historial_usuario = ["asma"]
-
-diagnosticos = diagnosticar(texto_usuario, edad_usuario, historial_usuario)
-print("Diagnóstico:")
-for enfermedad, certeza, recomendacion in diagnosticos:
-    print(f"- {enfermedad} ({certeza}%) → {recomendacion}")
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+
+    # Con argumentos actúa como línea de órdenes: python -m sistema_experto diagnose --input ... --output ...
+    if len(sys.argv) > 1:
+        from diagnostico_masivo import main
+
+        sys.exit(main(sys.argv[1:]))
+
+    texto_usuario = "Tengo fiebre alta, tos persistente y me cuesta respirar."
+    edad_usuario = 65
+    historial_usuario = ["asma"]
+
+    diagnosticos = diagnosticar(texto_usuario, edad_usuario, historial_usuario)
+    print("Diagnóstico:")
+    for enfermedad, certeza, recomendacion in diagnosticos:
+        print(f"- {enfermedad} ({certeza}%) → {recomendacion}")
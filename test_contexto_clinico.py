@@ -0,0 +1,17 @@
+import pytest
+
+from sistema_experto import obtener_extractor_rapido
+
+
+@pytest.mark.parametrize("texto, esperados", [
+    ("No tengo fiebre, tengo tos seca", {"fiebre:negado", "tos_seca"}),
+    ("No tengo fiebre y tengo tos seca", {"fiebre:negado", "tos_seca"}),
+    ("Sin fiebre pero con tos seca", {"fiebre:negado", "tos_seca"}),
+    ("No tengo fiebre ni tos seca", {"fiebre:negado", "tos_seca:negado"}),
+    ("No hay fiebre", {"fiebre:negado"}),
+    ("Creo que tengo fiebre", {"fiebre:incierto"}),
+    ("Tuve fiebre alta", {"fiebre:pasado", "fiebre_alta:pasado"}),
+    ("Tengo fiebre y dolor muscular, no tengo congestión nasal.", {"fiebre", "dolor_muscular", "congestion_nasal:negado"}),
+])
+def test_alcance_de_los_disparadores(texto, esperados):
+    assert set(obtener_extractor_rapido().extraer(texto)) == esperados
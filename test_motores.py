@@ -0,0 +1,34 @@
+import pytest
+
+from benchmark_diagnostico import (
+    comparar_motores,
+    generar_notas_contexto,
+    notas_motores,
+)
+from sistema_experto import (
+    _inferir,
+    cache_diagnosticos,
+    obtener_extractor_rapido,
+    obtener_motor_compilado,
+)
+
+pytestmark = pytest.mark.skipif(obtener_motor_compilado() is None, reason="la base actual no se puede compilar")
+
+
+def test_motor_compilado_equivale_a_clips():
+    resultado = comparar_motores(notas_motores(600, semilla=1))
+    assert resultado["diferencias"] == 0, resultado["ejemplos_diferencias"]
+
+
+def test_corpus_cubre_negados_inciertos_y_parciales():
+    # Sin estos casos la equivalencia no prueba la ponderación por certezas ni los negados
+    rapido = obtener_extractor_rapido()
+    sintomas = [rapido.extraer(nota["texto"]) for nota in generar_notas_contexto(300, semilla=1)]
+    assert any(s.endswith(":negado") for lista in sintomas for s in lista)
+    assert any(s.endswith(":incierto") for lista in sintomas for s in lista)
+    certezas = set()
+    for lista in sintomas:
+        cache_diagnosticos.limpiar()
+        certezas.update(certeza for _, certeza, _ in _inferir(lista, 40, [], motor="compilado"))
+    # Certezas de regla (90, 80...) y también ponderadas por síntomas inciertos
+    assert len(certezas) > 2